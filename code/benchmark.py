@@ -0,0 +1,233 @@
+"""Benchmarks for the analysis pipeline in data_postprocessing.py.
+
+Each stage (loading, cleaning, standardizing, epoching, spectrograms, ML
+dataset preparation and CSP fitting) is timed (wall clock and CPU) and, unless
+turned off, memory-profiled with tracemalloc. Stages are run on the bundled
+data/BCIproject_trial-*_raw.fif.gz files and on synthetic sessions of any
+length, sample rate and channel count. Results are saved as JSON, and can be
+compared to a stored baseline to flag regressions.
+
+Examples
+--------
+    python benchmark.py --output benchmark.json
+    python benchmark.py --no-bundled --sfreq 125 250 1000 --minutes 30 --baseline benchmark.json
+"""
+import os
+import sys
+import json
+import glob
+import argparse
+import platform
+import tempfile
+import datetime
+from contextlib import contextmanager
+
+import numpy as np
+import mne
+from mne.decoding import CSP
+
+from profiling import stageProfiler
+from synthetic_data import save_session
+from data_postprocessing import eegData, crop_windows, SPECTROGRAM_VARIABLES
+
+DATA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', '')
+ML_DATASETS = ['SSVEP', 'LMI_a', 'LMI_i']
+CSP_EPOCHS = ['MA', 'MI', 'LA', 'LI']
+
+
+@contextmanager
+def stage(profiler, name, filename=None):
+    """Profiles a stage, recording and printing any error instead of stopping the benchmark."""
+    try:
+        with profiler.stage(name, filename) as record:
+            yield record
+    except Exception as e:
+        print(f'{name} failed: {e!r}')
+
+
+def benchmark_pipeline(filenames, trace_memory=True):
+    """Runs every pipeline stage on some files and times it.
+
+    Returns
+    -------
+    dict
+        'stages' with every stage record and 'summary' with the totals per stage.
+    """
+    profiler = stageProfiler(trace_memory=trace_memory)
+    eeg = eegData(os.path.dirname(filenames[0]) + os.sep)
+    list_of_data = []
+    for filename in filenames:
+        name = os.path.basename(filename)
+        with stage(profiler, 'load_data', name) as record:
+            data = eeg.load_data(filename)
+            record['n_samples'] = data.n_times
+
+        with stage(profiler, 'clean_data', name) as record:
+            data = eeg.clean_data(data)
+            record['n_samples'] = data.n_times
+
+        with stage(profiler, 'standardize_all_channels', name) as record:
+            eeg.standardize_all_channels(data)
+            record['n_samples'] = data.n_times
+
+        list_of_data.append(data)
+
+    with stage(profiler, 'concatenate') as record:
+        eeg.data = mne.concatenate_raws(list_of_data)
+        eeg.drop_lazy_attributes()
+        record['n_samples'] = eeg.data.n_times
+
+    sfreq = eeg.data.info['sfreq']
+    with stage(profiler, 'get_all_epochs') as record:
+        eeg.get_all_epochs()
+        record['n_epochs'] = eeg.epochs_array.shape[0]
+
+    # 2 second segments keep the 0.5 Hz frequency bins prepare_data_for_ml expects at any sample rate
+    with stage(profiler, 'get_all_spectrograms') as record:
+        record['n_spectrograms'] = 0
+        for spect_var, (annotation_regexp, channels) in SPECTROGRAM_VARIABLES.items():
+            try:
+                spectrograms = eeg.get_spectrograms(annotation_regexp,
+                                                    spect_var,
+                                                    nperseg=int(2 * sfreq),
+                                                    noverlap=int(sfreq),
+                                                    channels=None if channels == 'viz' else 'all')
+            except ValueError:
+                continue
+
+            record['n_spectrograms'] += spectrograms.spectrograms.shape[0]
+
+    for name in ML_DATASETS:
+        with stage(profiler, f'prepare_{name}_data_for_ml') as record:
+            dataset = eeg.prepare_data_for_ml(name)
+            record['n_samples'] = dataset.features.shape[0]
+            record['n_features'] = dataset.features.shape[1]
+
+    for name in CSP_EPOCHS:
+        with stage(profiler, f'fit_{name}_csp') as record:
+            epochs = getattr(eeg, name + '_epochs')
+            labels = epochs.events[:, -1] == 2
+            window = int(sfreq)
+            crops, _ = crop_windows(epochs.get_data(), window)
+            num_windows = crops.shape[1]
+            CSP().fit_transform(crops.reshape(-1, *crops.shape[2:]), np.repeat(labels, num_windows))
+            record['n_crops'] = crops.shape[0] * num_windows
+
+    profiler.close()
+    return {'stages': profiler.records, 'summary': profiler.summary()}
+
+
+def compare_to_baseline(results, baseline, threshold=0.2, min_seconds=0.05):
+    """Flags stages that got slower or used more memory than in a baseline.
+
+    Parameters
+    ----------
+    results, baseline : dict
+        Results from run_benchmarks (or loaded from their JSON files).
+    threshold : float
+        Fraction a stage's wall time or peak memory may grow by before it is flagged.
+    min_seconds : float
+        Stages faster than this in the baseline are not timed precisely enough to compare.
+
+    Returns
+    -------
+    list of str
+        One message per regression.
+    """
+    regressions = []
+    for dataset, dataset_results in results['datasets'].items():
+        if dataset not in baseline['datasets']:
+            continue
+
+        baseline_summary = baseline['datasets'][dataset]['summary']
+        for stage, stats in dataset_results['summary'].items():
+            if stage not in baseline_summary:
+                continue
+
+            old = baseline_summary[stage]
+            if old['wall_seconds'] >= min_seconds and stats['wall_seconds'] > old['wall_seconds'] * (1 + threshold):
+                regressions.append(f"{dataset} {stage}: {old['wall_seconds']:.2f}s -> {stats['wall_seconds']:.2f}s")
+
+            if old['peak_mb'] and stats['peak_mb'] and stats['peak_mb'] > old['peak_mb'] * (1 + threshold):
+                regressions.append(f"{dataset} {stage}: {old['peak_mb']:.1f}MB -> {stats['peak_mb']:.1f}MB peak memory")
+
+            if 'error' in stats and 'error' not in old:
+                regressions.append(f"{dataset} {stage}: now fails with {stats['error']}")
+
+    return regressions
+
+
+def run_benchmarks(bundled=True, sfreqs=(125, 250, 1000), minutes=10, n_channels=16, trace_memory=True):
+    """Benchmarks the bundled data and one synthetic session per sample rate.
+
+    Returns
+    -------
+    dict
+        'meta' describing the run, and 'datasets' with the results of benchmark_pipeline for each dataset.
+    """
+    results = {'meta': {'date': datetime.datetime.now().isoformat(),
+                        'python': sys.version,
+                        'platform': platform.platform(),
+                        'numpy': np.__version__,
+                        'mne': mne.__version__,
+                        'trace_memory': trace_memory},
+                'datasets': {}}
+
+    if bundled:
+        filenames = sorted(glob.glob(DATA_PATH + 'BCIproject_trial-*_raw.fif.gz'))
+        print(f'benchmarking {len(filenames)} bundled files')
+        results['datasets']['bundled'] = benchmark_pipeline(filenames, trace_memory=trace_memory)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for sfreq in sfreqs:
+            name = f'synthetic-{sfreq}Hz-{n_channels}ch-{minutes}min'
+            print(f'benchmarking {name}')
+            filename = save_session(os.path.join(tmp_dir, f'BCIproject_trial-{name}_raw.fif.gz'),
+                                    minutes=minutes,
+                                    sfreq=sfreq,
+                                    n_channels=n_channels)
+            results['datasets'][name] = benchmark_pipeline([filename], trace_memory=trace_memory)
+
+    return results
+
+
+def print_summary(results):
+    for dataset, dataset_results in results['datasets'].items():
+        print(dataset)
+        for stage, stats in dataset_results['summary'].items():
+            peak = '' if stats['peak_mb'] is None else f"{stats['peak_mb']:9.1f}MB"
+            error = f"  {stats['error']}" if 'error' in stats else ''
+            print(f"  {stage:32s} {stats['wall_seconds']:8.2f}s {stats['cpu_seconds']:8.2f}s cpu {peak}{error}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', default='benchmark.json', help='JSON file to save the results to')
+    parser.add_argument('--baseline', help='JSON file of earlier results to flag regressions against')
+    parser.add_argument('--threshold', type=float, default=0.2, help='fraction a stage may slow down by before it is flagged')
+    parser.add_argument('--no-bundled', action='store_true', help="don't benchmark the files in data/")
+    parser.add_argument('--sfreq', type=int, nargs='*', default=[125, 250, 1000], help='sample rates of synthetic sessions')
+    parser.add_argument('--minutes', type=float, default=10, help='length of synthetic sessions')
+    parser.add_argument('--channels', type=int, default=16, help='channels in synthetic sessions')
+    parser.add_argument('--no-memory', action='store_true', help="don't trace memory (tracemalloc slows everything down)")
+    args = parser.parse_args()
+
+    results = run_benchmarks(bundled=not args.no_bundled,
+                                sfreqs=args.sfreq,
+                                minutes=args.minutes,
+                                n_channels=args.channels,
+                                trace_memory=not args.no_memory)
+    print_summary(results)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+        regressions = compare_to_baseline(results, baseline, threshold=args.threshold)
+        for regression in regressions:
+            print('regression: ' + regression)
+
+        if regressions:
+            sys.exit(1)
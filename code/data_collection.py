@@ -2,7 +2,7 @@ import time
 import datetime
 import sys
 import os
-import pickle
+import threading
 
 import mne
 import numpy as np
@@ -16,9 +16,58 @@ from psychopy.visual import Window
 from psychopy import gui
 from PyQt5 import QtCore
 
+from montages import SENSOR_LOCATIONS
+from session_store import sessionStore, align_trials, BLOCK_ORDER
+from signal_quality import signalQualityMonitor
+
 # elephant image and mask
 EL_IMG = "media/lemmling-2D-cartoon-elephant.jpg"
 EL_MASK = "media/lemmling-2D-cartoon-elephant-transparency-mask.jpg"
+# stimulus cache of each window, see getStimuli
+_stimulusCaches = {}
+# flip intervals longer than this many frame periods count as dropped frames
+DROPPED_FRAME_FACTOR = 1.5
+# fraction an SSVEP's achieved flicker frequency may be off by before its trial is flagged
+FREQUENCY_TOLERANCE = 0.01
+# showMIinstructions/miPrompt types of the motor and laryngeal trial labels
+MI_TYPES = {'TMI-a': 'm-a', 'TMI-i': 'm-i', 'LMI-a': 'l-a', 'LMI-i': 'l-i'}
+# instructions shown before each block of trials, keyed by trial label
+BLOCK_INSTRUCTIONS = {
+    'SSVEP': """
+    We will now move to SSVEP.
+    The elephant stimuli will be presented.
+    If the elephant is in the box, press the right arrow key
+    and look at the flashing box on the right.
+    If the elephant is out of the box, press the left arrow key,
+    then look at the flashing box on the left.
+    """,
+    'TMI-a': """
+    We will now move to motor activity.
+    The same stimuli will be presented.
+    If the elephant is in the box, press the right arrow key
+    and lift up your right arm until 'done' displays.
+    """,
+    'TMI-i': """
+    We will now move to motor imagery.
+    The same stimuli will be presented.
+    If the elephant is in the box, press the right arrow key
+    and imagine lifting your right arm until 'done' displays.
+    """,
+    'LMI-a': """
+    We will now move to larnygeal activity.
+    The same stimuli will be presented.
+    If the elephant is in the box, press the right arrow key
+    and make an actual humming sound until 'done' displays.
+    If the elephant is not in the box, simply rest.
+    """,
+    'LMI-i': """
+    We will now move to larnygeal imagery.
+    The same stimuli will be presented.
+    If the elephant is in the box, press the right arrow key
+    and imagine making a humming sound until 'done' displays.
+    If the elephant is not in the box, simply rest.
+    """}
+
 
 class trialData:
     """ This is a class that stores trial data.
@@ -37,6 +86,11 @@ class trialData:
             "TMI-i" - for traditional motor imagery (imagined)
             "LMI-a" - for laryngeal activity (actual)
             "LMI-i" - for laryngeal motor imagery (imagined)
+    timing : dict
+        Flip timing statistics of the trial's stimulus (see flipRecorder.timing), or None.
+    flipTimes : np.array
+        Times of every flip during the trial in seconds from its first flip, or None.
+        Saved in the session store's flips/ directory (see session_store.load_flip_times).
     """
     def __init__(self, onset, duration, description, label, flag=""):
         # self.startTime = startTime
@@ -48,6 +102,149 @@ class trialData:
         self.description = description
         self.label = label
         self.flag = flag
+        self.timing = None
+        self.flipTimes = None
+
+
+class acquisitionThread(threading.Thread):
+    """ Background thread that drains the BrainFlow ring buffer while recording.
+
+    The board is polled every poll_interval seconds and new samples are copied
+    into pre-allocated chunks, so the board's ring buffer never overflows on
+    long sessions and there is no single huge pull at the end of the session.
+
+    Attributes
+    ----------
+    n_samples : int
+        Total number of samples collected so far.
+    buffer_fill : int
+        Number of samples that were waiting in the board's ring buffer at the last poll.
+    max_buffer_fill : int
+        Largest ring buffer fill seen so far; should stay far below the buffer size.
+    drain_rate : float
+        Samples per second drained at the last poll.
+    store : obj
+        Optional sessionStore that every drained batch of samples is also written to.
+    """
+    def __init__(self, board, board_id, poll_interval=0.25, chunk_seconds=60, store=None):
+        super().__init__(daemon=True)
+        self.board = board
+        self.store = store
+        self.poll_interval = poll_interval
+        self.n_rows = BoardShim.get_num_rows(board_id)
+        self.chunk_size = int(chunk_seconds * BoardShim.get_sampling_rate(board_id))
+        self.chunks = []
+        self.chunk_fill = self.chunk_size  # forces a new chunk on the first append
+        self.n_samples = 0
+        self.buffer_fill = 0
+        self.max_buffer_fill = 0
+        self.drain_rate = 0.
+        self.n_polls = 0
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.last_poll = None
+
+    def _append(self, new_data):
+        """Copies new samples into the pre-allocated chunks."""
+        start = 0
+        n_new = new_data.shape[1]
+        with self.lock:
+            while start < n_new:
+                if self.chunk_fill == self.chunk_size:
+                    self.chunks.append(np.empty((self.n_rows, self.chunk_size)))
+                    self.chunk_fill = 0
+
+                n_copy = min(self.chunk_size - self.chunk_fill, n_new - start)
+                self.chunks[-1][:, self.chunk_fill:self.chunk_fill + n_copy] = new_data[:, start:start + n_copy]
+                self.chunk_fill += n_copy
+                start += n_copy
+
+            self.n_samples += n_new
+
+        if self.store is not None:
+            self.store.append(new_data)
+
+    def drain(self):
+        """Pulls everything currently in the board's ring buffer.
+
+        Returns
+        -------
+        int
+            The number of samples drained.
+        """
+        now = time.time()
+        count = self.board.get_board_data_count()
+        self.buffer_fill = count
+        self.max_buffer_fill = max(self.max_buffer_fill, count)
+        if count > 0:
+            self._append(self.board.get_board_data())
+
+        if self.last_poll is not None and now > self.last_poll:
+            self.drain_rate = count / (now - self.last_poll)
+
+        self.last_poll = now
+        self.n_polls += 1
+        return count
+
+    def run(self):
+        while not self.stop_event.wait(self.poll_interval):
+            self.drain()
+
+        # one last drain so nothing left in the ring buffer is lost
+        self.drain()
+
+    def stop(self):
+        """Stops polling after a final drain of the ring buffer."""
+        self.stop_event.set()
+        if self.is_alive():
+            self.join()
+        else:
+            # never started; something else (e.g. an experimentScheduler task) was calling drain
+            self.drain()
+
+    def get_samples(self, start, stop=None, rows=None):
+        """Returns a copy of the collected samples between two sample numbers.
+
+        Parameters
+        ----------
+        start : int
+            Number of the first sample (counting from the start of the session).
+        stop : int
+            Number of the sample after the last one; defaults to everything collected so far.
+        rows : list of ints
+            Board data rows to return; defaults to all rows.
+        """
+        with self.lock:
+            if stop is None:
+                stop = self.n_samples
+
+            start = max(start, 0)
+            stop = min(stop, self.n_samples)
+            chunk_rows = slice(None) if rows is None else rows
+            n_rows = self.n_rows if rows is None else len(rows)
+            samples = np.empty((n_rows, max(stop - start, 0)))
+            position = start
+            while position < stop:
+                i_chunk, offset = divmod(position, self.chunk_size)
+                n_copy = min(self.chunk_size - offset, stop - position)
+                samples[:, position - start:position - start + n_copy] = self.chunks[i_chunk][chunk_rows, offset:offset + n_copy]
+                position += n_copy
+
+            return samples
+
+    def get_latest(self, n_samples, rows=None):
+        """Returns a copy of the newest n_samples samples (fewer if not collected yet)."""
+        stop = self.n_samples
+        return self.get_samples(stop - n_samples, stop, rows=rows)
+
+    def stats(self):
+        """Returns a dictionary of buffer-fill and drain-rate counters."""
+        return {'n_samples': self.n_samples,
+                'n_chunks': len(self.chunks),
+                'n_polls': self.n_polls,
+                'buffer_fill': self.buffer_fill,
+                'max_buffer_fill': self.max_buffer_fill,
+                'drain_rate': self.drain_rate}
 
 
 class expData:
@@ -80,6 +277,17 @@ class expData:
         self.dataTrials = []
         self.frstOnset = None
         self.ID = None
+        self.store = None
+        self.responses = []
+        self.board = None
+        # markers inserted into the data stream, with the host time of each
+        self.markers = []
+        self.nMarkers = 0
+        # flipRecorder of the experiment window, for the flip timing of each trial
+        self.flips = None
+        self.quality = None
+        # prints per-trial details like the flip timing
+        self.debug = False
 
     def addTrial(self, onset, duration, description, label):
         if hasattr(self, "dataTrials") != True:
@@ -89,10 +297,114 @@ class expData:
             print("appended dataTrials")
             self.dataTrials.append(trialData(onset, duration, description, label))
 
+        # write the trial to the session log right away so it survives a crash
+        if self.store is not None:
+            self.store.add_trial(onset, duration, description, label)
+
+        if self.flips is not None:
+            self.addTiming(len(self.dataTrials) - 1)
+
+    def addTiming(self, iTrial):
+        """Attaches and saves the flip timing of the trial that just ended, flagging dropped frames and frequency drift."""
+        trial = self.dataTrials[iTrial]
+        trial.timing, trial.flipTimes = self.flips.popTrial()
+        if self.store is not None and len(trial.flipTimes) > 0:
+            self.store.add_flip_times(iTrial, trial.flipTimes)
+
+        if trial.timing is None:
+            return
+
+        if self.debug:
+            print(f"flip timing: {trial.timing}")
+
+        if self.store is not None:
+            self.store.update_trial(iTrial, timing=trial.timing)
+
+        if trial.timing.get('dropped_frames', 0) > 0:
+            self.flagTrial(iTrial, "dropped frames")
+
+        drift = [abs(achieved / nominal - 1) for achieved, nominal in zip(trial.timing.get('frequencies', []),
+                                                                            trial.timing.get('nominal_frequencies', []))]
+        if any(d > FREQUENCY_TOLERANCE for d in drift):
+            self.flagTrial(iTrial, "frequency drift")
+
+    def flagTrial(self, iTrial, flag):
+        """Adds a flag to a trial and records the change in the session log.
+
+        A trial can have several flags, e.g. "dropped frames, too long".
+        """
+        trial = self.dataTrials[iTrial]
+        trial.flag = ', '.join(f for f in [trial.flag, flag] if f)
+        if self.store is not None:
+            self.store.update_trial(iTrial, flag=trial.flag)
+
+    def addResponse(self, key, correct, rt, pressTime, label=None):
+        """Records a participant's answer to a trial's question.
+
+        Parameters
+        ----------
+        key : str
+            Key that was pressed.
+        correct : bool
+            Whether it was the correct answer.
+        rt : float
+            Response time in seconds from when waiting for the answer started.
+        pressTime : float
+            Time of the key press in seconds since the epoch, like trial onsets.
+        label : str
+            Type of the trial, e.g. 'SSVEP'.
+        """
+        response = {'key': key,
+                    'correct': correct,
+                    'rt': rt,
+                    'press_time': pressTime,
+                    'label': label,
+                    'trial': len(self.dataTrials)}
+        self.responses.append(response)
+        if self.store is not None:
+            self.store.log(dict(event='response', **response))
+
+    def _insertMarker(self, code):
+        hostTime = time.time()
+        if self.board is not None:
+            self.board.insert_marker(code)
+
+        self.markers.append({'code': code, 'time': hostTime})
+        if self.store is not None:
+            self.store.add_marker(code, hostTime)
+
+    def markOnFlip(self, window):
+        """Inserts a marker into the board's data stream right after the window's next flip.
+
+        stopBCI places trial starts and stops at the samples of the markers
+        inserted closest to them, so call this before the flip that starts or
+        stops a stimulus.
+
+        Returns
+        -------
+        int
+            The marker's code, unique in the session.
+        """
+        self.nMarkers += 1
+        window.callOnFlip(self._insertMarker, self.nMarkers)
+        return self.nMarkers
+
+    def markNow(self):
+        """Inserts a marker into the board's data stream now, e.g. when a sound is played.
+
+        Returns
+        -------
+        int
+            The marker's code, unique in the session.
+        """
+        self.nMarkers += 1
+        self._insertMarker(self.nMarkers)
+        return self.nMarkers
+
     def addFrstOnset(self, frstOnset):
         self.frstOnset = frstOnset
 
-    def startBCI(self, brd, serialPort):
+    def startBCI(self, brd, serialPort, sensor_locations='LMI2', startAcquisition=True):
         """Starts the connection/stream of the openBCI headset
 
         Parameters
@@ -109,101 +421,119 @@ class expData:
                 COM4
                 COM3
                 /dev/ttyUSB0
+        sensor_locations : str
+            Determines the sensor location dictionary to use. One of
+            'default', 'LMI1', 'LMI2'
+        startAcquisition : bool
+            If True, self.acquisition drains the board and self.quality (a
+            signalQualityMonitor) checks the channels in their own threads; if
+            False, their drain and update methods have to be called periodically instead.
         """
         #connect to headset
         params = BrainFlowInputParams()
+        board_id = None
 
         # cyton/daisy wifi is 6 https://brainflow.readthedocs.io/en/stable/SupportedBoards.html
         # bluetooth is 2
         if brd == "WiFi":
             params.ip_address = '192.168.4.1'#'10.0.0.220'
             params.ip_port = 6229
-            board = BoardShim(6, params)
+            board_id = 6
             self.sfreq = 1000
         elif brd == "Synthetic":
-            board = BoardShim(-1, params)
+            board_id = -1
             self.sfreq = 250
         elif brd == "Bluetooth":
             params.serial_port = serialPort
-            board = BoardShim(2, params)
+            board_id = 2
             self.sfreq = 125
 
+        board = BoardShim(board_id, params)
+
 
         board.prepare_session()
         # by default stores 7.5 minutes of data; change num_samples higher for more
         # sampling rate of 1k/s, so 450k samples in buffer
         board.start_stream()
-        time.sleep(3)
         self.board = board
+        self.board_id = board_id
+        self.sensor_locations = sensor_locations
+        # samples and trials are written to disk as they come in
+        self.store = sessionStore(f"data/BCIproject_trial-{self.ID}",
+                                n_rows=BoardShim.get_num_rows(board_id),
+                                sfreq=self.sfreq,
+                                timestamp_row=BoardShim.get_timestamp_channel(board_id),
+                                marker_row=BoardShim.get_marker_channel(board_id),
+                                sensor_locations=sensor_locations,
+                                board_id=board_id)
+        # drain the ring buffer in the background so long sessions don't lose data
+        self.acquisition = acquisitionThread(board, board_id, store=self.store)
+        # live per-channel signal quality, logged to the session
+        self.quality = signalQualityMonitor(self, store=self.store)
+        if startAcquisition:
+            self.acquisition.start()
+            self.quality.start()
+        time.sleep(3)
 
-    def stopBCI(self, sensor_locations='LMI2'):
+    def stopBCI(self, sensor_locations=None, save_fif=True):
         """Stops the openBCI datastream and disconnects the headset
 
             Parameters
             ----------
             sensor_locations : str
                 Determines the sensor location dictionary to use. One of
-                'default', 'LMI1'
-
+                'default', 'LMI1', 'LMI2'. Defaults to the one given to startBCI.
+            save_fif : bool
+                If True, also saves the session as an MNE .fif.gz file. The raw
+                samples and trials are already on disk in the session store
+                (data/BCIproject_trial-<ID>/), which session_store.session_to_raw
+                can convert later.
+
+            Trial onsets and durations are taken from the samples of the markers
+            inserted at the flips that started and stopped them (see markOnFlip),
+            falling back to host times for any without a marker. The offsets
+            between the two are printed and kept in self.alignment.
+
+            Channels self.quality found bad in more than 20% of its updates
+            are saved as the raw object's info['bads'].
         """
         # wait a few seconds to have extra data padded at the end for filtering
         time.sleep(3)
-        rawData = self.board.get_board_data()
+        # the acquisition thread has already collected the data; just finalize it
+        self.acquisition.stop()
+        print(f"acquisition stats: {self.acquisition.stats()}")
+        self.quality.stop()
+        bads = self.quality.bad_channels()
+        print(f"bad channels: {bads}, bad fractions: {dict(zip(self.quality.ch_names, self.quality.bad_fractions().round(2)))}")
+        self.store.log({'event': 'bads', 'bads': bads})
         self.board.stop_stream()
         # this is for disconnecting the headset
         self.board.release_session()
 
-        if sensor_locations == 'default':
-            number_to_1020 = {1: 'Fp1',
-                                2: 'Fp2',
-                                3: 'C3',
-                                4: 'C4',
-                                5: 'T5',
-                                6: 'T6',
-                                7: 'O1',
-                                8: 'O2',
-                                9: 'F7',
-                                10: 'F8',
-                                11: 'F3',
-                                12: 'F4',
-                                13: 'T3',
-                                14: 'T4',
-                                15: 'P3',
-                                16: 'P4'}
-        elif sensor_locations == 'LMI1':
-            number_to_1020 = {1: 'FC1',
-                                2: 'FC2',
-                                3: 'C3',
-                                4: 'C4',
-                                5: 'FC5',
-                                6: 'FC6',
-                                7: 'O1',
-                                8: 'O2',
-                                9: 'F7',
-                                10: 'F8',
-                                11: 'F3',
-                                12: 'F4',
-                                13: 'T3',
-                                14: 'T4',
-                                15: 'PO3',
-                                16: 'PO4'}
-        elif sensor_locations == 'LMI2':
-            number_to_1020 = {1: 'Fp1',
-                                2: 'Fp2',
-                                3: 'CP1',
-                                4: 'CP2',
-                                5: 'FC1', #change to FC1
-                                6: 'FC2', #change to FC2
-                                7: 'O1',
-                                8: 'O2',
-                                9: 'F7',
-                                10: 'F8',
-                                11: 'Fz',
-                                12: 'Cz',
-                                13: 'T3',
-                                14: 'T4',
-                                15: 'P3',
-                                16: 'P4'}
+        # place trials at the samples of their markers instead of at host times
+        timestampRow = BoardShim.get_timestamp_channel(self.board_id)
+        markerRow = BoardShim.get_marker_channel(self.board_id)
+        timestamps, markerChannel = self.acquisition.get_samples(0, rows=[timestampRow, markerRow])
+        onsets_list, durations_list, self.alignment = align_trials(timestamps,
+                                                                   markerChannel,
+                                                                   self.sfreq,
+                                                                   self.markers,
+                                                                   [t.onset for t in self.dataTrials],
+                                                                   [t.duration for t in self.dataTrials])
+        print(f"marker alignment: {self.alignment}")
+        self.store.log(dict(event='alignment', **self.alignment))
+
+        # write the last partial block; everything else is already on disk
+        self.store.close()
+        if not save_fif:
+            return
+
+        # only the EEG rows, copied once out of the chunks
+        eegData = self.acquisition.get_samples(0, rows=list(range(1, 17)))
+        if sensor_locations is None:
+            sensor_locations = self.sensor_locations
+
+        number_to_1020 = SENSOR_LOCATIONS[sensor_locations]
 
         ch_types = ['eeg'] * 16
         ch_names = list(number_to_1020.values())
@@ -212,11 +542,11 @@ class expData:
                             sfreq=self.sfreq,
                             ch_types=ch_types)
 
-        raw = mne.io.RawArray(rawData[1:17], info)
+        raw = mne.io.RawArray(eegData, info)
+        # channels the signal quality monitor found bad for much of the session
+        raw.info['bads'] = bads
 
         # create annotations MNE object and attach to data
-        onsets_list = [(t.onset - rawData[-1,0]) for t in self.dataTrials]
-        durations_list = [t.duration for t in self.dataTrials]
         desc_list = ['-'.join([str(t.description), t.label, t.flag]) for t in self.dataTrials]
         annot = mne.Annotations(onsets_list, durations_list, desc_list)
 
@@ -226,10 +556,8 @@ class expData:
         montage = mne.channels.make_standard_montage('standard_1020')
         raw.set_montage(montage)
 
-        # save MNE fif file and raw data as pickle file
+        # save MNE fif file
         raw.save(f"data/BCIproject_trial-{self.ID}_raw.fif.gz")
-        with open(f"data/BCIproject_trial-{self.ID}.pk", "wb") as f:
-            pickle.dump(rawData, f)
 
 
 def chkDur(window, data, iTrials, threshold=.1):
@@ -255,16 +583,316 @@ def chkDur(window, data, iTrials, threshold=.1):
     """
     if data.dataTrials[iTrials].duration > 5 + threshold:
         status = "WARNING: The SSVEP was too long"
-        data.dataTrials[iTrials].flag = "too long"
+        data.flagTrial(iTrials, "too long")
         print(data.dataTrials[iTrials].flag)
         return status
     elif data.dataTrials[iTrials].duration < 5 - threshold:
         status = "WARNING: The SSVEP was too short"
-        data.dataTrials.flag = "too short"
-        print(data.dataTrials.flag)
+        data.flagTrial(iTrials, "too short")
+        print(data.dataTrials[iTrials].flag)
         return status
 
 
+class flipRecorder:
+    """ Records the time of every flip of a window, and the timing of each trial's stimulus.
+
+    Flip times go into a preallocated array, so recording doesn't allocate
+    while a stimulus is drawn. Stimulus functions mark which flips are their
+    stimulus with startStimulus and stopStimulus; popTrial returns the
+    flips and timing statistics of the trial since startTrial.
+
+    Attributes
+    ----------
+    window : obj
+        Psychopy window object.
+    times : np.array
+        Flip times in seconds (psychopy's clock); only the first nFlips are used.
+    nFlips : int
+        Number of flips recorded.
+    """
+    def __init__(self, window, size=2**16):
+        self.window = window
+        self.times = np.empty(size)
+        self.nFlips = 0
+        self.trialFirst = 0
+        self.stimulusFirst = 0
+        self.stimulus = None
+
+    def flip(self, **kwargs):
+        """Flips the window (kwargs are passed to window.flip) and records the time of the flip."""
+        flipTime = self.window.flip(**kwargs)
+        if self.nFlips == len(self.times):
+            self.times = np.concatenate([self.times, np.empty(len(self.times))])
+
+        self.times[self.nFlips] = flipTime
+        self.nFlips += 1
+        return flipTime
+
+    def startTrial(self):
+        """Starts recording a new trial's flips."""
+        self.trialFirst = self.nFlips
+        self.stimulus = None
+
+    def startStimulus(self):
+        """Marks the next flip as the first of the trial's stimulus."""
+        self.stimulusFirst = self.nFlips
+
+    def stopStimulus(self, refreshRate=None, frequencies=None):
+        """Marks the last flip as the last of the trial's stimulus.
+
+        Parameters
+        ----------
+        refreshRate : float
+            Display refresh rate in Hz the stimulus was drawn for, if it was
+            animated; frame interval statistics are only computed if given.
+        frequencies : list of floats
+            Flicker frequencies of a flicker locked to the frame count, for
+            which the achieved frequencies are computed.
+        """
+        self.stimulus = (self.stimulusFirst, self.nFlips, refreshRate, frequencies)
+
+    def timing(self, first, stop, refreshRate=None, frequencies=None):
+        """Computes timing statistics of some recorded flips.
+
+        Returns
+        -------
+        dict
+            The number of flips and seconds from the first to the last; for
+            animated stimuli also the mean, standard deviation (jitter) and
+            maximum frame intervals in milliseconds, the achieved refresh rate,
+            the number of dropped frames, and the nominal and achieved flicker
+            frequencies.
+        """
+        times = self.times[first:stop]
+        timing = {'n_flips': int(len(times)),
+                  'duration': float(times[-1] - times[0]) if len(times) > 1 else 0.}
+        if refreshRate is None or len(times) < 2:
+            return timing
+
+        intervals = np.diff(times)
+        framePeriod = 1 / refreshRate
+        late = intervals > DROPPED_FRAME_FACTOR * framePeriod
+        # a late flip missed every frame period it spans but one
+        dropped = np.round(intervals[late] / framePeriod) - 1
+        achievedRate = (len(times) - 1) / timing['duration']
+        timing.update({'mean_interval': float(intervals.mean() * 1000),
+                       'jitter': float(intervals.std() * 1000),
+                       'max_interval': float(intervals.max() * 1000),
+                       'refresh_rate': float(achievedRate),
+                       'dropped_frames': int(dropped.sum())})
+        if frequencies is not None:
+            # each frame steps the flicker's phase by the same amount, so the
+            # frequency scales with the rate frames were actually shown at
+            timing['nominal_frequencies'] = [float(f) for f in frequencies]
+            timing['frequencies'] = [float(f * achievedRate / refreshRate) for f in frequencies]
+
+        return timing
+
+    def popTrial(self):
+        """Returns the timing of the trial's stimulus and its flip times, and starts a new trial.
+
+        Returns
+        -------
+        timing : dict
+            See timing(); None if the trial had no stimulus flips.
+        flipTimes : np.array
+            Times of all of the trial's flips in seconds from its first flip, as float32.
+        """
+        flipTimes = self.times[self.trialFirst:self.nFlips]
+        flipTimes = (flipTimes - flipTimes[:1]).astype(np.float32)
+        timing = None
+        if self.stimulus is not None:
+            first, stop, refreshRate, frequencies = self.stimulus
+            timing = self.timing(first, stop, refreshRate=refreshRate, frequencies=frequencies)
+
+        self.startTrial()
+        return timing, flipTimes
+
+
+class stimulusCache:
+    """ Preloads the experiment's stimuli for one window and hands out reusable objects.
+
+    Images, boxes, tones and the SSVEP squares are created once, when the
+    window is; texts, flicker patches and movies are created the first time
+    they are asked for and reused after that, so nothing is re-read from disk
+    or re-uploaded to the GPU between trials. Use getStimuli(window) to get
+    the cache of a window.
+
+    Attributes
+    ----------
+    window : obj
+        Psychopy window object.
+    elephant : obj
+        Elephant ImageStim.
+    boxes : dict
+        Red box Rects, keyed by whether the elephant is in the box (True) or not (False).
+    tones : dict
+        Sounds keyed by note.
+    ssvepSquares : list
+        The two squares drawn behind the SSVEP stimuli.
+    flips : obj
+        flipRecorder of the window's flips.
+    """
+    def __init__(self, window, movieFrequencies=None):
+        self.window = window
+        self.refreshRate = None
+        self.flips = flipRecorder(window)
+        self.elephant = visual.ImageStim(win=window,
+                                    pos=((0, 0.25)),
+                                    image=EL_IMG,
+                                    mask=EL_MASK,
+                                    size=0.4)
+        self.boxes = {True: visual.Rect(win=window, pos=((0, 0.25)), lineColor="red"),
+                        False: visual.Rect(win=window, pos=((0, -0.25)), lineColor="red")}
+        self.tones = {note: sound.Sound(note, 1) for note in ['C', 'G']}
+        self.ssvepSquares = [visual.Rect(win=window,
+                                        size=(0.5, 0.5),
+                                        pos=pos,
+                                        fillColor='white',
+                                        opacity=0)
+                                for pos in [(-0.6, 0), (0.6, 0)]]
+        self.texts = {}
+        self.patches = {}
+        self.movies = {}
+        if movieFrequencies is not None:
+            size, positions = ssvepLayout(window)
+            for frequency, pos in zip(movieFrequencies, positions):
+                self.movie(frequency, size, pos)
+
+    def text(self, key, text, **kwargs):
+        """Returns the TextStim stored under key, with its text set to text.
+
+        The TextStim is created with kwargs (e.g. pos, color) the first time;
+        its text is only changed (and re-rendered) when it is different.
+        """
+        if key not in self.texts:
+            self.texts[key] = visual.TextStim(win=self.window, text=text, **kwargs)
+        elif self.texts[key].text != text:
+            self.texts[key].text = text
+
+        return self.texts[key]
+
+    def flickerPatches(self, positions, size):
+        """Returns black background and white flicker Rects (in pixels) at each position."""
+        key = (tuple(map(tuple, positions)), tuple(size))
+        if key not in self.patches:
+            backgrounds = [visual.Rect(win=self.window, units='pix', size=size, pos=pos, fillColor='black', lineColor=None)
+                            for pos in positions]
+            patches = [visual.Rect(win=self.window, units='pix', size=size, pos=pos, fillColor='white', lineColor=None)
+                        for pos in positions]
+            self.patches[key] = (backgrounds, patches)
+
+        return self.patches[key]
+
+    def movie(self, frequency, size, pos):
+        """Returns the SSVEP movie for a frequency, rewound to the start if it was played before."""
+        key = (frequency, tuple(size), tuple(pos))
+        if key not in self.movies:
+            self.movies[key] = visual.MovieStim3(self.window,
+                                                f'media/{frequency}Hz.avi',
+                                                size=size,
+                                                pos=pos)
+        else:
+            self.movies[key].seek(0)
+            self.movies[key].play()
+
+        return self.movies[key]
+
+    def tone(self, note):
+        """Returns a preloaded tone, stopped so it can be played again from the start."""
+        tone = self.tones[note]
+        tone.stop()
+        return tone
+
+    def getRefreshRate(self):
+        """Measures the window's refresh rate in Hz the first time it is needed."""
+        if self.refreshRate is None:
+            self.refreshRate = self.window.getActualFrameRate()
+            if self.refreshRate is None:
+                # measurement was too unstable; fall back to the nominal frame period
+                self.refreshRate = 1 / self.window.monitorFramePeriod
+
+        return self.refreshRate
+
+
+def getStimuli(window, movieFrequencies=None):
+    """Returns the window's stimulusCache, creating it the first time.
+
+    Parameters
+    ----------
+    window : obj
+        Psychopy window object.
+    movieFrequencies : list of ints
+        If given when the cache is created, the SSVEP movies for these
+        frequencies (right, then left) are preloaded too.
+    """
+    if window not in _stimulusCaches:
+        _stimulusCaches[window] = stimulusCache(window, movieFrequencies=movieFrequencies)
+
+    return _stimulusCaches[window]
+
+
+def flip(window, **kwargs):
+    """Flips the window, recording the time of the flip in its flipRecorder."""
+    return getStimuli(window).flips.flip(**kwargs)
+
+
+def releaseStimuli(window):
+    """Drops a window's stimulusCache, e.g. once the window is closed."""
+    _stimulusCaches.pop(window, None)
+
+
+class blockingClock:
+    """ Waits for the protocol's holds, pauses and key checks with plain blocking sleeps.
+
+    The trial coroutines (trialsAsync, trialByTypeAsync, miPromptAsync, ...)
+    await their waits on a clock. With this one they never suspend, so the
+    synchronous functions (trials, trialByType, ...) run them to completion
+    with runBlocking, without an event loop; scheduler.experimentScheduler has
+    the same methods, but suspends to run its other tasks while waiting.
+    """
+    async def sleep_until(self, deadline, name):
+        """Sleeps until a deadline in time.time() seconds; name is unused. Returns how late it woke up."""
+        time.sleep(max(deadline - time.time(), 0))
+        return time.time() - deadline
+
+    async def sleep(self, seconds, name):
+        """Sleeps for some seconds."""
+        return await self.sleep_until(time.time() + seconds, name)
+
+    async def next_frame(self):
+        """Called after each flip of an animation; there is nothing else to run."""
+        pass
+
+
+def getClock(clock):
+    """Returns clock, or a blockingClock if it is None."""
+    return blockingClock() if clock is None else clock
+
+
+def runBlocking(coroutine):
+    """Runs a protocol coroutine on a blockingClock to completion and returns its result.
+
+    No event loop is needed, so this also works where one is already running (e.g. IPython).
+    """
+    try:
+        coroutine.send(None)
+    except StopIteration as stop:
+        return stop.value
+
+    coroutine.close()
+    raise RuntimeError('the coroutine suspended; only coroutines awaiting a blockingClock can be run with runBlocking')
+
+
+def ssvepLayout(window):
+    """Returns the size and the right and left positions (in pixels) of the SSVEP stimuli."""
+    win_size = window.size
+    # size and location of movies
+    dim = 0.5 * win_size[1]
+    placement = 0.3 * win_size[0]
+    return (dim, dim), [(placement, 0), (-placement, 0)]
+
+
 def showMIinstructions(window, miType, holdTime):
     """Presents instructions for the traditional motor imagery (TMI) response.
 
@@ -295,13 +923,14 @@ def showMIinstructions(window, miType, holdTime):
 
     #present a prompt that asks the participant to think about raising their right arm for yes and left arm for no
     tmiPromptText_1 = f"For YES, {responseInstr[0]} for {str(holdTime)} seconds."
-    tmiPromptStim_1 = visual.TextStim(win=window,
-                                    text=tmiPromptText_1,
+    stimuli = getStimuli(window)
+    tmiPromptStim_1 = stimuli.text('miInstructionsYes',
+                                    tmiPromptText_1,
                                     pos=(0.5, 0),
                                     wrapWidth=0.5)
     tmiPromptText_2 = f"For NO, {responseInstr[1]} for {str(holdTime)} seconds."
-    tmiPromptStim_2 = visual.TextStim(win=window,
-                                    text=tmiPromptText_2,
+    tmiPromptStim_2 = stimuli.text('miInstructionsNo',
+                                    tmiPromptText_2,
                                     pos=(-0.5, 0),
                                     wrapWidth=0.5)
 
@@ -309,11 +938,27 @@ def showMIinstructions(window, miType, holdTime):
     tmiPromptStim_2.draw()
 
 
-def miPrompt(window, miType, holdTime):
+def miPromptText(miType):
+    """Returns the prompt text for a type of motor imagery ('m-i', 'l-i', 'm-a' or 'l-a')."""
+    if miType == 'm-i':
+        text = "Imagine raising right arm or rest."
+    elif miType == 'l-i':
+        text = "Imagine making a noise or rest."
+    elif miType == 'm-a':
+        text = "Raise right arm or rest."
+    elif miType == 'l-a':
+        text = "Make a humming sound or rest."
+
+    return text
+
+
+async def miPromptAsync(clock, window, miType, holdTime, data=None):
     """Presents the prompt for the traditional motor imagery (TMI) response.
 
     Parameters
     ----------
+    clock : obj
+        blockingClock or experimentScheduler the hold is awaited on; a blockingClock if None.
     window : obj
         Psychopy window object.
     miType : string
@@ -323,44 +968,159 @@ def miPrompt(window, miType, holdTime):
             l-i - laryngeal imagery
             m-a - motor movement
             l-a - laryngeal actuation
+    holdTime : float or int
+        Number of seconds for the time the prompt is shown.
+    data : obj
+        expData object; if given, markers are inserted at the start and stop of the prompt.
 
     Returns
     -------
     list of floats
         the times the TMI response started and time it ended
     """
-    if miType == 'm-i':
-        text = "Imagine raising right arm or rest."
-    elif miType == 'l-i':
-        text = "Imagine making a noise or rest."
-    elif miType == 'm-a':
-        text = "Raise right arm or rest."
-    elif miType == 'l-a':
-        text = "Make a humming sound or rest."
-
-    tStim = visual.TextStim(window, text=text)
+    clock = getClock(clock)
+    stimuli = getStimuli(window)
+    tStim = stimuli.text('miPrompt', miPromptText(miType))
     tStim.draw()
-    window.flip()
+    if data is not None:
+        data.markOnFlip(window)
+    stimuli.flips.startStimulus()
+    flip(window)
 
     start = time.time()
-    time.sleep(holdTime)
+    await clock.sleep_until(start + holdTime, 'hold')
     stop = time.time()
 
-    window.flip()
+    if data is not None:
+        data.markOnFlip(window)
+    flip(window)
+    stimuli.flips.stopStimulus()
     text = "Done."
-    tStim = visual.TextStim(window, text=text)
+    tStim = stimuli.text('done', text)
     tStim.draw()
-    window.flip()
-    time.sleep(1)
+    flip(window)
+    await clock.sleep(1, 'pause')
 
 
     return start, stop
 
 
-def ssvepVideo(window, frequency_1=10, frequency_2=15, ansWinOnly=True, ansSide=None):
-    """Checks to see if the duration of the ssvep stimulus is the correct length.
+def miPrompt(window, miType, holdTime, data=None):
+    """Presents the prompt for the motor imagery response; see miPromptAsync."""
+    return runBlocking(miPromptAsync(None, window, miType, holdTime, data=data))
+
+
+def getRefreshRate(window):
+    """Measures the window's refresh rate in Hz the first time it is needed.
+
     Parameters
     ----------
+    window : obj
+        Psychopy window object.
+    """
+    return getStimuli(window).getRefreshRate()
+
+
+def flickerTable(frequencies, refreshRate, duration):
+    """Precomputes the luminance of each flickering patch for every frame.
+
+    Uses the same waveform as make_video.py, starting at 0 luminance.
+
+    Parameters
+    ----------
+    frequencies : list of floats
+        Flicker frequency of each patch in Hz.
+    refreshRate : float
+        Display refresh rate in Hz.
+    duration : float
+        Seconds of flicker.
+
+    Returns
+    -------
+    np.array
+        Luminance from 0 to 1 with shape (patches, frames).
+    """
+    frames = np.arange(int(round(duration * refreshRate)))
+    phases = 2 * np.pi * np.outer(frequencies, frames) / refreshRate - (np.pi / 2)
+    return (np.sin(phases) + 1) / 2
+
+
+async def ssvepFlickerAsync(clock, window, frequencies, positions, size, duration=5, refreshRate=None, data=None):
+    """Draws flickering SSVEP patches, setting their opacity from a luminance table each frame.
+
+    Nothing is decoded while flickering, and the luminance depends only on the
+    frame number, so the flicker frequency is exact at the display refresh rate.
+    Other tasks on the clock's event loop run after each flip, in the rest of the frame.
+
+    Parameters
+    ----------
+    clock : obj
+        blockingClock or experimentScheduler the flicker runs on; a blockingClock if None.
+    window : obj
+        Psychopy window object.
+    frequencies : list of floats
+        Flicker frequency of each patch in Hz.
+    positions : list of tuples
+        Position of each patch in pixels.
+    size : tuple
+        Size of the patches in pixels.
+    duration : float
+        Seconds of flicker.
+    refreshRate : float
+        Display refresh rate in Hz; measured from the window if not given.
+    data : obj
+        expData object; if given, markers are inserted at the first and last flips.
+
+    Returns
+    -------
+        start : flt
+            The time of the first flip of the flicker.
+        end : flt
+            The time of the last flip.
+    """
+    clock = getClock(clock)
+    if refreshRate is None:
+        refreshRate = getRefreshRate(window)
+
+    luminance = flickerTable(frequencies, refreshRate, duration)
+    # white patches over black backgrounds, so opacity scales from black to white like the videos
+    stimuli = getStimuli(window)
+    backgrounds, patches = stimuli.flickerPatches(positions, size)
+
+    stimuli.flips.startStimulus()
+    start = None
+    nFrames = luminance.shape[1]
+    for frame in range(nFrames):
+        for background, patch, opacity in zip(backgrounds, patches, luminance[:, frame]):
+            background.draw()
+            patch.opacity = opacity
+            patch.draw()
+
+        if data is not None and frame in (0, nFrames - 1):
+            data.markOnFlip(window)
+        flip(window)
+        if start is None:
+            start = time.time()
+
+        # flip returns at the start of the frame, so other tasks get the rest of it
+        await clock.next_frame()
+
+    end = time.time()
+    stimuli.flips.stopStimulus(refreshRate=refreshRate, frequencies=frequencies)
+    return start, end
+
+
+def ssvepFlicker(window, frequencies, positions, size, duration=5, refreshRate=None, data=None):
+    """Draws flickering SSVEP patches; see ssvepFlickerAsync."""
+    return runBlocking(ssvepFlickerAsync(None, window, frequencies, positions, size, duration=duration, refreshRate=refreshRate, data=data))
+
+
+async def ssvepVideoAsync(clock, window, frequency_1=10, frequency_2=15, ansWinOnly=True, ansSide=None, mode='procedural', duration=5, data=None):
+    """Presents the SSVEP stimulus, as a procedural flicker or as videos.
+    Parameters
+    ----------
+        clock : obj
+            blockingClock or experimentScheduler the stimulus runs on; a blockingClock if None.
         window : obj
             Psychopy window object.
         frequency_1 : int
@@ -371,6 +1131,13 @@ def ssvepVideo(window, frequency_1=10, frequency_2=15, ansWinOnly=True, ansSide=
             If true, only the correct answer flashing window shows.
         ansSide : str
             If ansSide is left, the left video is displayed. If ansSide is right, the right video is displayed
+        mode : str
+            'procedural' draws the flicker frame by frame with ssvepFlickerAsync, at
+            any frequencies; 'video' plays media/{frequency}Hz.avi made by make_video.py.
+        duration : float
+            Seconds of procedural flicker (videos are 5 seconds long).
+        data : obj
+            expData object; if given, markers are inserted at the start and end of the stimulus.
     Returns
     -------
         start : flt
@@ -378,123 +1145,192 @@ def ssvepVideo(window, frequency_1=10, frequency_2=15, ansWinOnly=True, ansSide=
         end : flt
             The end time of the SSVEP video
     """
+    clock = getClock(clock)
     # 10 Hz (used to be 7 Hz) is on the right so it represents yes or True
     # 15Hz on the left (used to be 12 Hz)
-    win_size = window.size
-    # size and location of movies
-    dim = 0.5 * win_size[1]
-    placement = 0.3 * win_size[0]
+    size, (right, left) = ssvepLayout(window)
+    if mode == 'procedural':
+        if ansSide == 'left':
+            frequencies, positions = [frequency_2], [left]
+        elif ansSide == 'right':
+            frequencies, positions = [frequency_1], [right]
+        else:
+            frequencies, positions = [frequency_1, frequency_2], [right, left]
 
-    ssvep_right = visual.MovieStim3(window,
-                            f'media/{frequency_1}Hz.avi',
-                            size=(dim, dim),
-                            pos=[placement, 0])
-    ssvep_left = visual.MovieStim3(window,
-                            f'media/{frequency_2}Hz.avi',
-                            size=(dim, dim),
-                            pos=[-placement, 0])
+        return await ssvepFlickerAsync(clock, window, frequencies, positions, size, duration=duration, data=data)
 
-    start = time.time()
+    # only the movies that are shown are rewound
+    stimuli = getStimuli(window)
+    movies = []
+    if ansSide != 'left':
+        movies.append(stimuli.movie(frequency_1, size, right))
+    if ansSide != 'right':
+        movies.append(stimuli.movie(frequency_2, size, left))
 
-    if ansSide == 'left':
-        while ssvep_left.status != -1:
-            ssvep_left.draw()
-            window.flip()
+    if data is not None:
+        data.markOnFlip(window)
+    stimuli.flips.startStimulus()
+    start = time.time()
 
-    if ansSide == 'right':
-        while ssvep_right.status != -1:
-            ssvep_right.draw()
-            window.flip()
+    while movies[-1].status != -1:
+        for movie in movies:
+            movie.draw()
 
-    if ansSide == None:
-        while ssvep_left.status != -1:
-            ssvep_left.draw()
-            ssvep_right.draw()
-            window.flip() #this is a potential source of error in the frequency of the SSVEP signal
+        flip(window) #this is a potential source of error in the frequency of the SSVEP signal
+        await clock.next_frame()
 
+    if data is not None:
+        # the last frame has already been flipped
+        data.markNow()
     end = time.time()
+    # movies are decoded by time, not frame count, so only the frame intervals are checked
+    stimuli.flips.stopStimulus(refreshRate=getRefreshRate(window))
 
     return start, end
 
 
-def ssvepStim(window, corAnsSide=None):
+def ssvepVideo(window, frequency_1=10, frequency_2=15, ansWinOnly=True, ansSide=None, mode='procedural', duration=5, data=None):
+    """Presents the SSVEP stimulus; see ssvepVideoAsync."""
+    return runBlocking(ssvepVideoAsync(None,
+                                        window,
+                                        frequency_1=frequency_1,
+                                        frequency_2=frequency_2,
+                                        ansWinOnly=ansWinOnly,
+                                        ansSide=ansSide,
+                                        mode=mode,
+                                        duration=duration,
+                                        data=data))
+
+
+async def ssvepStimAsync(clock, window, corAnsSide=None, ssvep_mode='procedural', data=None):
     """Presents the SSVEP flashing stimuli
 
     Parameters
     ----------
+    clock : obj
+        blockingClock or experimentScheduler the stimulus runs on; a blockingClock if None.
     window : obj
         Psychopy window object.
     corAnsSide: str
         The side the correct answer response is on.
+    ssvep_mode : str
+        'procedural' or 'video'; see ssvepVideoAsync.
+    data : obj
+        expData object the stimulus' start and end markers are inserted through.
 
     Returns
     -------
     list of floats
         the times the ssvep stimulus started and time it ended
     """
-    # win_size = window.size
-    square1 = visual.Rect(win=window,
-                        size=(0.5, 0.5),
-                        pos=(-0.6, 0),
-                        fillColor='white',
-                        opacity=0,
-                        autoDraw=True)
-    square2 = visual.Rect(win=window,
-                        size=(0.5, 0.5),
-                        pos=(0.6, 0),
-                        fillColor='white',
-                        opacity=0,
-                        autoDraw=True)
-
-    if corAnsSide != None:
-        start, end = ssvepVideo(window, ansSide=corAnsSide)
-    else:
-        start, end = ssvepVideo(window)
+    # the same two squares every trial, so autoDraw stimuli don't pile up
+    squares = getStimuli(window).ssvepSquares
+    for square in squares:
+        square.autoDraw = True
+
+    start, end = await ssvepVideoAsync(clock, window, ansSide=corAnsSide, mode=ssvep_mode, data=data)
 
-    # square1.autoDraw = False
-    # square2.autoDraw = False
-    window.flip()
+    for square in squares:
+        square.autoDraw = False
+
+    flip(window)
     return start, end
 
 
-def checkAns(window, yes):
+def ssvepStim(window, corAnsSide=None, ssvep_mode='procedural', data=None):
+    """Presents the SSVEP flashing stimuli; see ssvepStimAsync."""
+    return runBlocking(ssvepStimAsync(None, window, corAnsSide, ssvep_mode=ssvep_mode, data=data))
+
+
+async def waitForKeysAsync(clock, window, keyList=None, timeout=None, pollInterval=0.005):
+    """Waits for one of the keys in keyList, sleeping between checks instead of spinning.
+
+    Parameters
+    ----------
+    clock : obj
+        blockingClock or experimentScheduler the checks are spaced out on; a blockingClock if None.
+    window : obj
+        Psychopy window object.
+    keyList : list of str
+        Keys to wait for; any key if None.
+    timeout : float
+        Seconds to wait before giving up; waits forever if None.
+    pollInterval : float
+        Seconds to sleep between checks for key presses.
+
+    Returns
+    -------
+    key : str
+        The key pressed, or None if the wait timed out.
+    rt : float
+        Seconds from the start of the wait to the key press. Keys are
+        timestamped when the window's events are dispatched, on each check,
+        so rt is only accurate to pollInterval.
+    pressTime : float
+        Time of the key press in seconds since the epoch, the same clock as
+        trial onsets and BrainFlow timestamps.
+
+    Keys pressed before the wait started (e.g. during the stimulus) are discarded.
+    """
+    clock = getClock(clock)
+    event.clearEvents('keyboard')
+    start = time.time()
+    keyClock = core.Clock()
+    while timeout is None or keyClock.getTime() < timeout:
+        keys = getKeys(keyList=keyList, timeStamped=keyClock)
+        if keys:
+            key, rt = keys[0]
+            return key, rt, start + rt
+
+        await clock.sleep(pollInterval, 'key_wait')
+        # lets the window process events while waiting
+        window.dispatchAllWindowEvents()
+
+    return None, None, None
+
+
+def waitForKeys(window, keyList=None, timeout=None, pollInterval=0.005):
+    """Waits for one of the keys in keyList; see waitForKeysAsync."""
+    return runBlocking(waitForKeysAsync(None, window, keyList=keyList, timeout=timeout, pollInterval=pollInterval))
+
+
+async def checkAnsAsync(clock, window, yes, data=None, label=None):
     """Checks to see if the correct answer was given to the primary stage of the experimental trial.
     Parameters
     ----------
+    clock : obj
+        blockingClock or experimentScheduler the key wait runs on; a blockingClock if None.
     window : obj
         Psychopy window object.
     yes : Boolean
         T or F if response to stimulus should be yes or no
+    data : obj
+        expData object; if given, the answer and its response time are recorded in it.
+    label : str
+        Type of the trial, recorded with the answer.
     Returns
     -------
     bool
         Returns True if the answer was correct and False if the answer was incorrect
     """
-    users_answer = None
-
     #present instructions for keypress responses: -> for yes and <- for no
+    key, rt, pressTime = await waitForKeysAsync(clock, window, keyList=['right', 'left', 'p'])
+    if key == 'p':
+        window.close()
+        sys.exit(0)
 
-    #while loop for getting keys
-        #
-    while True:
-        keys = getKeys()
+    users_answer = key == 'right'
+    correct = users_answer == yes
+    if data is not None:
+        data.addResponse(key, correct, rt, pressTime, label=label)
 
-        if 'right' in keys:
-            users_answer = True
-        if 'left' in keys:
-            users_answer = False
+    event.clearEvents()
+    return correct
 
-        if 'q' and 'p' in keys:
-            window.close()
-            sys.exit(0)
 
-        if users_answer != None:
-            if users_answer == yes:
-                event.clearEvents()
-                return True
-            else:
-                event.clearEvents()
-                return False
+def checkAns(window, yes, data=None, label=None):
+    """Checks the answer to a trial's question; see checkAnsAsync."""
+    return runBlocking(checkAnsAsync(None, window, yes, data=data, label=label))
 
 
 def makeYesnos(nYes, nNos):
@@ -514,31 +1350,52 @@ def makeYesnos(nYes, nNos):
     return yes_nos
 
 
-def eyes_closed(holdTime):
+async def eyesClosedAsync(clock, holdTime, window=None, data=None):
     """
     Parameters
     ----------
+    clock : obj
+        blockingClock or experimentScheduler the hold is awaited on; a blockingClock if None.
     holdTime : int or float
         number of seconds to wait
+    window : obj
+        Psychopy window object; if given, its preloaded tones are used.
+    data : obj
+        expData object; if given, markers are inserted when each sound is played.
 
     Plays a sound, then waits for holdTime, then plays another sound.
     Returns the start time and end time (floats) in seconds UTC since the epoch.
     """
-    g = sound.Sound('C', 1)
+    clock = getClock(clock)
+    stimuli = getStimuli(window) if window is not None else None
+    g = stimuli.tone('C') if stimuli is not None else sound.Sound('C', 1)
     g.play()
+    if data is not None:
+        data.markNow()
     start = time.time()
-    time.sleep(holdTime)
-    g = sound.Sound('G', 1)
+    await clock.sleep_until(start + holdTime, 'hold')
+    g = stimuli.tone('G') if stimuli is not None else sound.Sound('G', 1)
     end = time.time()
     g.play()
+    if data is not None:
+        data.markNow()
     return start, end
 
 
-def trialByType(window, yes, type, holdTime=5, SSVEP_one_win=False):
+def eyes_closed(holdTime, window=None, data=None):
+    """Plays a sound, waits for holdTime and plays another sound; see eyesClosedAsync."""
+    return runBlocking(eyesClosedAsync(None, holdTime, window=window, data=data))
+
+
+async def trialByTypeAsync(clock, window, yes, type, holdTime=5, SSVEP_one_win=False, ssvep_mode='procedural', data=None):
     """Depending on the type argument given, runs the correct type of experimental trial.
 
+    The question is asked again until it is answered correctly.
+
     Parameters
     ----------
+    clock : obj
+        blockingClock or experimentScheduler the trial runs on; a blockingClock if None.
     window : obj
         Psychopy window object.
     yes : boolean
@@ -546,7 +1403,7 @@ def trialByType(window, yes, type, holdTime=5, SSVEP_one_win=False):
     type : string
         What type of experimental trial is this
         Could be one of:
-            "Alpha" - for alpha wave detection
+            "alpha" - for alpha wave detection
             "S" - for SSVEP
             "TMI-a" - for motor activity (actual)
             "TMI-i" - for traditional motor imagery (imagined)
@@ -555,235 +1412,101 @@ def trialByType(window, yes, type, holdTime=5, SSVEP_one_win=False):
 
     holdTime : float or int
         Number of seconds for the time the stimulus is shown.
+    ssvep_mode : str
+        'procedural' or 'video' SSVEP flicker; see ssvepVideoAsync.
+    data : obj
+        expData object the participant's answers are recorded in, and the
+        stimulus' start and stop markers are inserted through.
+
+    Returns
+    -------
+    start, stop : floats
+        The times the stimulus started and ended.
 
     Notes
     -------
         Press q and p during the trial to exit
     """
-    elephantStim = visual.ImageStim(win=window,
-                                pos=((0, 0.25)),
-                                image=EL_IMG,
-                                mask=EL_MASK,
-                                size=0.4)
-    # for debug
-    if type == "S":
-        fulType = "SSVEP"
-    elif type == "TMI-a":
-        fulType = "Actual Motor Movement"
-    elif type == "LMI-i":
-        fulType = "Laryngeal Motor Imagery"
-    elif type == "TMI-i":
-        fulType = "Traditional Motor Imagery"
-    elif type == "LMI-i":
-        fulType = "Laryngeal Motor Imagery"
-
-
+    clock = getClock(clock)
+    stimuli = getStimuli(window)
     if type == "alpha":
-        start, end = eyes_closed(holdTime)
-        return start, end
-
-
-    text = f'Is the Elephant in the box?'
-
-    window.flip()
-    trialNumStim = visual.TextStim(win=window,
-                                text=text,
-                                pos=(-.3, .8))
-    trialNumStim.draw()
-
-
-    if type == "S":
-        #present the stimulus
-        if yes:
-            boxStim = visual.Rect(win=window, pos=((0, 0.25)), lineColor="red")
-            corAnsSide = 'right'
-        else:
-            boxStim = visual.Rect(win=window, pos=((0, -0.25)), lineColor="red")
-            corAnsSide = 'left'
-
-        elephantStim.draw()
-        boxStim.draw()
-        window.flip()
-        check = checkAns(window, yes)
-
-        if check == True:
-            window.flip()
-            if SSVEP_one_win == True:
-                print(SSVEP_one_win)
-                ssvepStart, ssvepStop = ssvepStim(window, corAnsSide) # here is wehre I need a parameter for one window view
-            else:
-                ssvepStart, ssvepStop = ssvepStim(window) # this is where the none on SSVEP_one_win is coming from
-            window.flip()
-            return ssvepStart, ssvepStop
-        else:
-            retryText = "Please enter the correct answer before continuing"
-            retryStim = visual.TextStim(win=window, text=retryText, color="red")
-            retryStim.draw()
-            window.flip()
-            time.sleep(2)
-            window.flip()
-            event.clearEvents()
-            ssvepStart, ssvepStop = trialByType(window, yes, "S", SSVEP_one_win=SSVEP_one_win)
-
-
-    if type == "TMI-a":
-        #present the stimulus
-        if yes:
-            boxStim = visual.Rect(win=window, pos=((0, 0.25)), lineColor="red")
-        else:
-            boxStim = visual.Rect(win=window, pos=((0, -0.25)), lineColor="red")
-
-        elephantStim.draw()
-        boxStim.draw()
-
-        showMIinstructions(window, 'm-a', holdTime)
-
-        window.flip()
-        check = checkAns(window, yes)
-
-        if check == True:
-            window.flip()
-            tmiStart, tmiStop = miPrompt(window, "m-a", holdTime)
-            window.flip()
-        else:
-            retryText = "Please enter the correct answer before continuing"
-            retryStim = visual.TextStim(win=window, text=retryText, color="red")
-            retryStim.draw()
-            window.flip()
-            time.sleep(2)
-            window.flip()
-            event.clearEvents()
-            tmiStart, tmiStop = trialByType(window, yes, "TMI-a")
-            window.flip()
-
-        return tmiStart, tmiStop
-
-
-    if type == "TMI-i":
-        #present the stimulus
-        if yes:
-            boxStim = visual.Rect(win=window, pos=((0, 0.25)), lineColor="red")
-        else:
-            boxStim = visual.Rect(win=window, pos=((0, -0.25)), lineColor="red")
-
-        elephantStim.draw()
-        boxStim.draw()
-
-        showMIinstructions(window, "m-i", holdTime)
-
-        window.flip()
-        check = checkAns(window, yes)
-
-        if check == True:
-            window.flip()
-            tmiStart, tmiStop = miPrompt(window, "m-i", holdTime)
-            window.flip()
-        else:
-            retryText = "Please enter the correct answer before continuing"
-            retryStim = visual.TextStim(win=window, text=retryText, color="red")
-            retryStim.draw()
-            window.flip()
-            time.sleep(2)
-            window.flip()
-            event.clearEvents()
-            tmiStart, tmiStop = trialByType(window, yes, "TMI-i")
-            window.flip()
-
-        return tmiStart, tmiStop
+        stimuli.flips.startTrial()
+        return await eyesClosedAsync(clock, holdTime, window, data=data)
 
+    while True:
+        stimuli.flips.startTrial()
+        flip(window)
+        text = f'Is the Elephant in the box?'
+        stimuli.text('question', text, pos=(-.3, .8)).draw()
 
-    if type == "LMI-a":
         #present the stimulus
-        if yes:
-            boxStim = visual.Rect(win=window, pos=((0, 0.25)), lineColor="red")
-        else:
-            boxStim = visual.Rect(win=window, pos=((0, -0.25)), lineColor="red")
-
-        elephantStim.draw()
-        boxStim.draw()
-
-        showMIinstructions(window, "l-a", holdTime)
-
-        window.flip()
-        check = checkAns(window, yes)
-
-        if check == True:
-            window.flip()
-            lmiStart, lmiStop = miPrompt(window, "l-a", holdTime)
-            window.flip()
-        else:
-            retryText = "Please enter the correct answer before continuing"
-            retryStim = visual.TextStim(win=window, text=retryText, color="red")
-            retryStim.draw()
-            window.flip()
-            time.sleep(2)
-            window.flip()
-            event.clearEvents()
-            lmiStart, lmiStop = trialByType(window, yes, "LMI-a")
-            window.flip()
-
-        return lmiStart, lmiStop
+        stimuli.elephant.draw()
+        stimuli.boxes[yes].draw()
+        if type in MI_TYPES:
+            showMIinstructions(window, MI_TYPES[type], holdTime)
 
+        flip(window)
+        if await checkAnsAsync(clock, window, yes, data=data, label=type):
+            break
 
-    if type == "LMI-i":
-        #present the stimulus
-        if yes:
-            boxStim = visual.Rect(win=window, pos=((0, 0.25)), lineColor="red")
-        else:
-            boxStim = visual.Rect(win=window, pos=((0, -0.25)), lineColor="red")
+        retryText = "Please enter the correct answer before continuing"
+        stimuli.text('retry', retryText, color="red").draw()
+        flip(window)
+        await clock.sleep(2, 'pause')
+        flip(window)
+        event.clearEvents()
 
-        elephantStim.draw()
-        boxStim.draw()
+    flip(window)
+    if type == "S":
+        corAnsSide = ('right' if yes else 'left') if SSVEP_one_win else None
+        start, stop = await ssvepStimAsync(clock, window, corAnsSide, ssvep_mode=ssvep_mode, data=data)
+    else:
+        start, stop = await miPromptAsync(clock, window, MI_TYPES[type], holdTime, data=data)
 
-        showMIinstructions(window, "l-i", holdTime,)
+    flip(window)
+    return start, stop
 
-        window.flip()
-        check = checkAns(window, yes)
 
-        if check == True:
-            window.flip()
-            lmiStart, lmiStop = miPrompt(window, "l-i", holdTime)
-            window.flip()
-        else:
-            retryText = "Please enter the correct answer before continuing"
-            retryStim = visual.TextStim(win=window, text=retryText, color="red")
-            retryStim.draw()
-            window.flip()
-            time.sleep(2)
-            window.flip()
-            event.clearEvents()
-            lmiStart, lmiStop = trialByType(window, yes, "LMI-i")
-            window.flip()
+def trialByType(window, yes, type, holdTime=5, SSVEP_one_win=False, ssvep_mode='procedural', data=None):
+    """Runs one experimental trial; see trialByTypeAsync."""
+    return runBlocking(trialByTypeAsync(None,
+                                        window,
+                                        yes,
+                                        type,
+                                        holdTime=holdTime,
+                                        SSVEP_one_win=SSVEP_one_win,
+                                        ssvep_mode=ssvep_mode,
+                                        data=data))
 
-        return lmiStart, lmiStop
 
-
-def waitForArrow(window):
+async def waitForArrowAsync(clock, window):
     """Waits for input and flips the window when the arrow keys are pressed,
     or exits the program if X is pressed.
 
     Parameters
     ----------
+    clock : obj
+        blockingClock or experimentScheduler the key wait runs on; a blockingClock if None.
     window : obj
         Psychopy window object.
     """
     #draw stimuli on the bottom of the page to prompt the participant to move forward
     moveFrwdText = "To move on press the space bar or X to Exit"
-    moveFrwdStim = visual.TextStim(win=window, text=moveFrwdText, pos=(0, -.9), color="black")
+    moveFrwdStim = getStimuli(window).text('moveForward', moveFrwdText, pos=(0, -.9), color="black")
     moveFrwdStim.draw()
-    window.flip(clearBuffer=False)
+    flip(window, clearBuffer=False)
+
+    key, _, _ = await waitForKeysAsync(clock, window, keyList=['space', 'x'])
+    if key == 'space':
+        flip(window)
+    else:
+        window.close()
+        sys.exit(0)
 
-    while True:
-        keys = getKeys()
-        #if len(keys) > 0:
-        #     print(keys)
-        #     break
-        if 'space' in keys:
-            window.flip()
-            break
-        if 'x' in keys:
-            window.close()
-            sys.exit(0)
+
+def waitForArrow(window):
+    """Waits for space to move on, or exits if X is pressed; see waitForArrowAsync."""
+    runBlocking(waitForArrowAsync(None, window))
 
 
 def getKeypress(window):
@@ -803,21 +1526,25 @@ def getKeypress(window):
         return None
 
 
-def trials(window,
-            nAlphaTrials,
-            nSsvepTrials,
-            nMiTrials_a,
-            nMiTrials_i,
-            nLmiTrials_a,
-            nLmiTrials_i,
-            data,
-            holdTime=5,
-            debug=False,
-            SSVEP_one_win=False):
+async def trialsAsync(clock,
+                        window,
+                        nAlphaTrials,
+                        nSsvepTrials,
+                        nMiTrials_a,
+                        nMiTrials_i,
+                        nLmiTrials_a,
+                        nLmiTrials_i,
+                        data,
+                        holdTime=5,
+                        debug=False,
+                        SSVEP_one_win=False,
+                        ssvep_mode='procedural'):
     """Runs the experimental protocol for the trial section of the experiment.
 
     Parameters
     ----------
+    clock : obj
+        blockingClock or experimentScheduler the trials run on; a blockingClock if None.
     window : obj
         Psychopy window object.
     nAlphaTrials : int
@@ -844,195 +1571,135 @@ def trials(window,
         time to collect data for each exp
     debug : bool
         True for printing debug statements.
+    ssvep_mode : str
+        'procedural' or 'video' SSVEP flicker; see ssvepVideoAsync.
     """
+    clock = getClock(clock)
     text = f"""
     In the first part of the experiment, you should close your eyes when you hear the first low-pitched sound.
     When you hear the higher-pitched sound, open your eyes. This will repeat {nAlphaTrials} times.
     """
     text_Stim = visual.TextStim(win=window, text=text)
     text_Stim.draw()
-    waitForArrow(window)
+    await waitForArrowAsync(clock, window)
 
     for i in range(nAlphaTrials):
         text = f"""Close your eyes for {holdTime} seconds when you hear the low-pitched sound,
         then open them when you hear the high-pitched sound."""
-        textstim = visual.TextStim(win=window,
-                                    text=text)
+        stimuli = getStimuli(window)
+        textstim = stimuli.text('alphaPrompt', text)
 
+        # the prompt's flip belongs to the eyes open trial, which is added
+        # (and its flips popped) before the eyes closed trial starts
+        stimuli.flips.startTrial()
         textstim.draw()
-        window.flip()
+        data.markOnFlip(window)
+        flip(window)
         eyes_open_start = time.time()
-        time.sleep(holdTime)
+        await clock.sleep_until(eyes_open_start + holdTime, 'hold')
         eyes_open_stop = time.time()
-        start, stop = trialByType(window, yes=True, type='alpha')
-        data.addTrial(start, (stop - start), True, 'alpha')
+        data.markNow()
         data.addTrial(eyes_open_start, (eyes_open_stop - eyes_open_start), False, 'alpha')
+        start, stop = await trialByTypeAsync(clock, window, yes=True, type='alpha', holdTime=holdTime, data=data)
+        data.addTrial(start, (stop - start), True, 'alpha')
 
-    time.sleep(2)
-
-
-    yes_nos =  makeYesnos(nSsvepTrials//2, nSsvepTrials//2) + \
-                makeYesnos(nMiTrials_a//2, nMiTrials_a//2) + \
-                makeYesnos(nLmiTrials_a//2, nLmiTrials_a//2) + \
-                makeYesnos(nMiTrials_i//2, nMiTrials_i//2) + \
-                makeYesnos(nLmiTrials_i//2, nLmiTrials_i//2)
-    iTrials = i  # the current trial number intialized to 1
-
-
-    text = """
-    We will now move to SSVEP.
-    The elephant stimuli will be presented.
-    If the elephant is in the box, press the right arrow key
-    and look at the flashing box on the right.
-    If the elephant is out of the box, press the left arrow key,
-    then look at the flashing box on the left.
-    """
-    text_Stim = visual.TextStim(win=window, text=text)
-    text_Stim.draw()
-    waitForArrow(window)
-
-    # repeat the number of ssvep trials
-    for iTrial in range(nSsvepTrials):
-        yes = yes_nos[iTrial]
-        start, stop = trialByType(window, yes, "S", SSVEP_one_win=SSVEP_one_win)
-        data.addTrial(start, (stop - start), yes, "SSVEP")
-
-        if debug:
-            print("onset is: " + str(data.dataTrials[iTrials].onset))
-            print("duration is: " + str(data.dataTrials[iTrials].duration))
-            print("description is: " + str(data.dataTrials[iTrials].description))
-            print("label is: " + str(data.dataTrials[iTrials].label))
-
-        slowSsvepTxt = chkDur(window, data, iTrials)
-
-        if type(slowSsvepTxt) == str:
-            slowSsvepStim = visual.TextStim(win=window, text=slowSsvepTxt, color="red")
-            slowSsvepStim.draw()
-            window.flip()
-            time.sleep(2)
-
-        iTrials += 1
-
-    text = """
-    We will now move to motor activity.
-    The same stimuli will be presented.
-    If the elephant is in the box, press the right arrow key
-    and lift up your right arm until 'done' displays.
-    """
-    text_Stim = visual.TextStim(win=window, text=text)
-    text_Stim.draw()
-    waitForArrow(window)
-
-    # repeat the number of traditional motor activity trials
-    for iTrial in range(nMiTrials_a):
-        yes = yes_nos[iTrial]
-        start, stop = trialByType(window, yes, "TMI-a")
-        data.addTrial(start, (stop - start), yes, "TMI-a")
-        if debug:
-            print("onset is: " + str(data.dataTrials[iTrials].onset))
-            print("duration is: " + str(data.dataTrials[iTrials].duration))
-            print("description is: " + str(data.dataTrials[iTrials].description))
-            print("label is: " + str(data.dataTrials[iTrials].label))
-        iTrials += 1
-
-    text = """
-    We will now move to motor imagery.
-    The same stimuli will be presented.
-    If the elephant is in the box, press the right arrow key
-    and imagine lifting your right arm until 'done' displays.
-    """
-    text_Stim = visual.TextStim(win=window, text=text)
-    text_Stim.draw()
-    waitForArrow(window)
-
-    # repeat the number of traditional MI trials
-    for iTrial in range(nMiTrials_i):
-        yes = yes_nos[iTrial]
-        start, stop = trialByType(window, yes, "TMI-i")
-        data.addTrial(start, (stop - start), yes, "TMI-i")
-        if debug:
-            print("onset is: " + str(data.dataTrials[iTrials].onset))
-            print("duration is: " + str(data.dataTrials[iTrials].duration))
-            print("description is: " + str(data.dataTrials[iTrials].description))
-            print("label is: " + str(data.dataTrials[iTrials].label))
-        iTrials += 1
-
-    text = """
-    We will now move to larnygeal activity.
-    The same stimuli will be presented.
-    If the elephant is in the box, press the right arrow key
-    and make an actual humming sound until 'done' displays.
-    If the elephant is not in the box, simply rest.
-    """
-    text_Stim = visual.TextStim(win=window, text=text)
-    text_Stim.draw()
-    waitForArrow(window)
-
-    # repeat the number of laryngeal activity trials
-    for iTrial in range(nLmiTrials_a):
-        yes = yes_nos[iTrial]
-        start, stop = trialByType(window, yes, "LMI-a")
-        data.addTrial(start, (stop - start), yes, "LMI-a")
-        if debug:
-            print("onset is: " + str(data.dataTrials[iTrials].onset))
-            print("duration is: " + str(data.dataTrials[iTrials].duration))
-            print("description is: " + str(data.dataTrials[iTrials].description))
-            print("label is: " + str(data.dataTrials[iTrials].label))
-        iTrials = iTrials + 1
-
-    text = """
-    We will now move to larnygeal imagery.
-    The same stimuli will be presented.
-    If the elephant is in the box, press the right arrow key
-    and imagine making a humming sound until 'done' displays.
-    If the elephant is not in the box, simply rest.
-    """
-    text_Stim = visual.TextStim(win=window, text=text)
-    text_Stim.draw()
-    waitForArrow(window)
-
-    # repeat the number of laryngeal MI trials
-    for iTrial in range(nLmiTrials_i):
-        yes = yes_nos[iTrial]
-        start, stop = trialByType(window, yes, "LMI-i")
-        data.addTrial(start, (stop - start), yes, "LMI-i")
-        if debug:
-            print("onset is: " + str(data.dataTrials[iTrials].onset))
-            print("duration is: " + str(data.dataTrials[iTrials].duration))
-            print("description is: " + str(data.dataTrials[iTrials].description))
-            print("label is: " + str(data.dataTrials[iTrials].label))
-        iTrials = iTrials + 1
+    await clock.sleep(2, 'pause')
+
+    blockTrials = {'SSVEP': nSsvepTrials,
+                    'TMI-a': nMiTrials_a,
+                    'TMI-i': nMiTrials_i,
+                    'LMI-a': nLmiTrials_a,
+                    'LMI-i': nLmiTrials_i}
+    for label in BLOCK_ORDER:
+        nTrials = blockTrials[label]
+        text_Stim = visual.TextStim(win=window, text=BLOCK_INSTRUCTIONS[label])
+        text_Stim.draw()
+        await waitForArrowAsync(clock, window)
+
+        # each block gets its own shuffled yes/no sequence
+        for yes in makeYesnos(nTrials//2, nTrials//2):
+            start, stop = await trialByTypeAsync(clock,
+                                                window,
+                                                yes,
+                                                "S" if label == 'SSVEP' else label,
+                                                holdTime=holdTime,
+                                                SSVEP_one_win=SSVEP_one_win,
+                                                ssvep_mode=ssvep_mode,
+                                                data=data)
+            data.addTrial(start, (stop - start), yes, label)
+            iTrial = len(data.dataTrials) - 1
+
+            if debug:
+                print("onset is: " + str(data.dataTrials[iTrial].onset))
+                print("duration is: " + str(data.dataTrials[iTrial].duration))
+                print("description is: " + str(data.dataTrials[iTrial].description))
+                print("label is: " + str(data.dataTrials[iTrial].label))
+
+            if label == 'SSVEP':
+                slowSsvepTxt = chkDur(window, data, iTrial)
+                if type(slowSsvepTxt) == str:
+                    slowSsvepStim = getStimuli(window).text('ssvepWarning', slowSsvepTxt, color="red")
+                    slowSsvepStim.draw()
+                    flip(window)
+                    await clock.sleep(2, 'pause')
 
 
-def example(window):
+def trials(window,
+            nAlphaTrials,
+            nSsvepTrials,
+            nMiTrials_a,
+            nMiTrials_i,
+            nLmiTrials_a,
+            nLmiTrials_i,
+            data,
+            holdTime=5,
+            debug=False,
+            SSVEP_one_win=False,
+            ssvep_mode='procedural'):
+    """Runs the trial section of the experiment; see trialsAsync."""
+    runBlocking(trialsAsync(None,
+                            window,
+                            nAlphaTrials,
+                            nSsvepTrials,
+                            nMiTrials_a,
+                            nMiTrials_i,
+                            nLmiTrials_a,
+                            nLmiTrials_i,
+                            data,
+                            holdTime=holdTime,
+                            debug=debug,
+                            SSVEP_one_win=SSVEP_one_win,
+                            ssvep_mode=ssvep_mode))
+
+
+async def exampleAsync(clock, window):
     """Runs the experimental protocol for the example stimuli section of the experiment.
 
     Parameters
     ----------
+    clock : obj
+        blockingClock or experimentScheduler the key waits run on; a blockingClock if None.
     window : obj
         Psychopy window object.
     """
-    elephantStim = visual.ImageStim(win=window,
-                                pos=((0, 0.25)),
-                                image=EL_IMG,
-                                mask=EL_MASK,
-                                size=0.4)
+    stimuli = getStimuli(window)
+    elephantStim = stimuli.elephant
 
     exText1 = "The following is an example of how a trial will run"
     exText1_Stim = visual.TextStim(win=window, text=exText1)
     exText1_Stim.draw()
-    waitForArrow(window)
+    await waitForArrowAsync(clock, window)
 
     exText2 = "At the beginning of each trial you will be shown a stimulus like..."
     exText2_Stim = visual.TextStim(win=window, text=exText2)
     exText2_Stim.draw()
-    waitForArrow(window)
+    await waitForArrowAsync(clock, window)
 
     exText3 = "this"
     exText3_Stim = visual.TextStim(win=window, text=exText3, pos=(0, .7))
     exText3_Stim.draw()
 
-    boxStim = visual.Rect(win=window, pos=((0, 0.25)), lineColor="red")
+    boxStim = stimuli.boxes[True]
     boxStim.draw()
     elephantStim.draw()
 
@@ -1040,13 +1707,13 @@ def example(window):
     corAns_Stim = visual.TextStim(win=window, text=corAns, pos=(0, -0.5))
     corAns_Stim.draw()
 
-    waitForArrow(window)
+    await waitForArrowAsync(clock, window)
 
     exText4 = "or this"
     exText4_Stim = visual.TextStim(win=window, text=exText4, pos=(0, 0.7))
     exText4_Stim.draw()
 
-    boxStim = visual.Rect(win=window, pos=((0, -0.25)), lineColor="red")
+    boxStim = stimuli.boxes[False]
     boxStim.draw()
     elephantStim.draw()
 
@@ -1054,14 +1721,21 @@ def example(window):
     corAns_Stim = visual.TextStim(win=window, text=corAns, pos=(0, -0.7))
     corAns_Stim.draw()
 
-    waitForArrow(window)
+    await waitForArrowAsync(clock, window)
 
 
-def instructions(window):
+def example(window):
+    """Runs the example stimuli section of the experiment; see exampleAsync."""
+    runBlocking(exampleAsync(None, window))
+
+
+async def instructionsAsync(clock, window):
     """Runs the experimental protocol for the instructions section of the experiment.
 
     Parameters
     ----------
+    clock : obj
+        blockingClock or experimentScheduler the key waits run on; a blockingClock if None.
     window : obj
         Psychopy window object.
     """
@@ -1081,19 +1755,83 @@ def instructions(window):
     """
     instrct_stim = visual.TextStim(window, text=instrctsTxt_1)
     instrct_stim.draw()
-    waitForArrow(window)
+    await waitForArrowAsync(clock, window)
     instrct_stim.text = instrctsTxt_2
     instrct_stim.draw()
-    waitForArrow(window)
+    await waitForArrowAsync(clock, window)
     instrct_stim.text = instrctsTxt_3
     instrct_stim.draw()
-    waitForArrow(window)
+    await waitForArrowAsync(clock, window)
     instrct_stim.text = instrctsTxt_4
     instrct_stim.draw()
-    waitForArrow(window)
+    await waitForArrowAsync(clock, window)
+
+
+def instructions(window):
+    """Runs the instructions section of the experiment; see instructionsAsync."""
+    runBlocking(instructionsAsync(None, window))
 
 
-def run_experiment(debug=True, SSVEP_one_win=False):
+async def experimentAsync(clock, window, data, nTrials=2, debug=False, SSVEP_one_win=False, ssvep_mode='procedural'):
+    """Runs the instructions, example and trials of the experiment on a clock.
+
+    Parameters
+    ----------
+    clock : obj
+        blockingClock or experimentScheduler the experiment runs on; a blockingClock if None.
+    window : obj
+        Psychopy window object.
+    data : obj
+        expData object of the experiment, which has started streaming with startBCI.
+    nTrials : int
+        Number of trials of each type (must be even).
+    """
+    await instructionsAsync(clock, window)
+    await exampleAsync(clock, window)
+    await trialsAsync(clock, window, nTrials, nTrials, nTrials, nTrials, nTrials, nTrials, data, debug=debug, SSVEP_one_win=SSVEP_one_win, ssvep_mode=ssvep_mode)
+
+
+def setupExperiment(debug=True, ssvep_mode='procedural', startAcquisition=True):
+    """Asks for the experiment settings, starts the board, opens the window and preloads the stimuli.
+
+    Parameters
+    ----------
+    debug : bool
+        If True, makes the window non-fullscreen.
+    ssvep_mode : str
+        'procedural' or 'video'; the videos are preloaded in 'video' mode.
+    startAcquisition : bool
+        Passed to expData.startBCI.
+
+    Returns
+    -------
+    data : obj
+        expData object of the experiment, or None if the dialog was cancelled.
+    window : obj
+        Psychopy window object, or None.
+    """
+    data = expData()
+    data.debug = debug
+    settings = experimentDialog(data)
+    if settings is None:
+        return None, None
+
+    data.startBCI(settings[1], settings[2], startAcquisition=startAcquisition)
+
+    if debug:
+        window = visual.Window()
+    else:
+        window = visual.Window(fullscr=True)
+
+    # preload the stimuli before the experiment starts
+    stimuli = getStimuli(window, movieFrequencies=[10, 15] if ssvep_mode == 'video' else None)
+    # both the procedural flicker and the flip timing checks need the refresh rate
+    stimuli.getRefreshRate()
+    data.flips = stimuli.flips
+    return data, window
+
+
+def run_experiment(debug=True, SSVEP_one_win=False, ssvep_mode='procedural'):
     """
     Runs experiment for data collection.
 
@@ -1105,9 +1843,34 @@ def run_experiment(debug=True, SSVEP_one_win=False):
     SSVEP_one_win : bool
         If False, both SSVEP stimuli windows show up in the SSVEP section.
         If True, only one SSVEP stimulus window shows up in the SSVEP section.
+    ssvep_mode : str
+        'procedural' draws the SSVEP flicker frame by frame at any frequency;
+        'video' plays the AVI files made by make_video.py.
     """
-    data = expData()
+    data, window = setupExperiment(debug=debug, ssvep_mode=ssvep_mode)
+    if data is None:
+        return
+
+    n_trials = 2
+    runBlocking(experimentAsync(None, window, data, nTrials=n_trials, debug=debug, SSVEP_one_win=SSVEP_one_win, ssvep_mode=ssvep_mode))
+    window.close()
+    releaseStimuli(window)
+    data.stopBCI()
 
+
+def experimentDialog(data):
+    """Asks for the experiment ID, board type and serial port, and sets data.ID.
+
+    Parameters
+    ----------
+    data : obj
+        expData object of the experiment.
+
+    Returns
+    -------
+    list
+        The experiment ID, board type and serial port; None if the dialog was cancelled.
+    """
     while True:
         dlg = gui.Dlg(title="BCI Experiment")
         exp_id = dlg.addField('Experiment ID Number: ')
@@ -1122,7 +1885,9 @@ def run_experiment(debug=True, SSVEP_one_win=False):
         settings = dlg.show()  # show dialog and wait for OK or Cancel
         if dlg.OK:  # or if ok_data is not None
             data.ID = settings[0]
-            if f"BCIproject_trial-{data.ID}.pk" in os.listdir('data'):
+            # the session store directory, and the .fif.gz (or .pk of older sessions) saved at the end
+            existing = [f"BCIproject_trial-{data.ID}{ext}" for ext in ['', '_raw.fif.gz', '.pk']]
+            if any(name in os.listdir('data') for name in existing):
                 dlg = gui.Dlg(title="Error")
                 dlg.addText(f'Error: data with this trial number {data.ID} already exists.')
                 dlg.setWindowFlags(QtCore.Qt.WindowStaysOnTopHint)
@@ -1141,23 +1906,9 @@ def run_experiment(debug=True, SSVEP_one_win=False):
                 dlg.show()
         else:  # clicked cancel
             print('cancelling experiment')
-            return
-
-    data.startBCI(settings[1], settings[2])
+            return None
 
-    if debug:
-        window = visual.Window()
-    else:
-        window = visual.Window(fullscr=True)
-
-
-    instructions(window)
-    example(window)
-    n_trials = 2
-    trials(window, n_trials, n_trials, n_trials, n_trials, n_trials, n_trials, data, debug=debug, SSVEP_one_win=SSVEP_one_win)
-    # trials(window, 0, n_trials, 0, 0, 0, 0, data, debug=debug, SSVEP_one_win=SSVEP_one_win)
-    window.close()
-    data.stopBCI()
+    return settings
 
 
 if __name__ == '__main__':
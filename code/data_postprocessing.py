@@ -1,8 +1,16 @@
 #functions for data processing should include:
 #   a function for getting the epochs
 #   a function for making a spectrogram
+import os
 import re
 import glob
+import time
+import pickle
+import datetime
+from collections import OrderedDict
+from contextlib import nullcontext
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import matplotlib.pyplot as plt
 import pandas as pd
@@ -18,6 +26,57 @@ from sklearn.pipeline import Pipeline
 from sklearn.discriminant_analysis import LinearDiscriminantAnalysis
 import pycaret.classification as pyclf
 
+import epoch_store
+from disk_cache import diskCache, file_hash
+from profiling import stageProfiler
+
+
+# line noise and its harmonics, removed with a notch filter when cleaning
+NOTCH_FREQUENCIES = np.arange(60, 241, 60)
+
+# trial labels written by expData.addTrial in data_collection.py; annotation
+# descriptions are '-'.join([truth, label, flag]), e.g. 'True-SSVEP-dropped frames, too long'
+TRIAL_LABELS = ['alpha', 'SSVEP', 'TMI-a', 'TMI-i', 'LMI-a', 'LMI-i']
+TRIAL_DESCRIPTION_REGEXP = re.compile('^(True|False)-(' + '|'.join(re.escape(l) for l in TRIAL_LABELS) + ')-(.*)$')
+# attributes the epochs for each label are stored in
+EPOCHS_VARIABLES = {'alpha': 'alpha_epochs',
+                    'SSVEP': 'SSVEP_epochs',
+                    'TMI-a': 'MA_epochs',
+                    'TMI-i': 'MI_epochs',
+                    'LMI-a': 'LA_epochs',
+                    'LMI-i': 'LI_epochs'}
+# spectrogram attributes, with the annotation regexp and channels ('viz' for
+# eegData.viz_channels, 'all' for every channel) used to compute them
+SPECTROGRAM_VARIABLES = {'alpha_spectrograms_true': ('True-alpha-', 'viz'),
+                        'alpha_spectrograms_false': ('False-alpha-', 'viz'),
+                        'SSVEP_spectrograms_true': ('True-SSVEP-.*', 'viz'),
+                        'SSVEP_spectrograms_false': ('False-SSVEP-.*', 'viz'),
+                        'MA_spectrograms_true': ('True-TMI-a-', 'all'),
+                        'MA_spectrograms_false': ('False-TMI-a-', 'all'),
+                        'MI_spectrograms_true': ('True-TMI-i-', 'all'),
+                        'MI_spectrograms_false': ('False-TMI-i-', 'all'),
+                        'LA_spectrograms_true': ('True-LMI-a-', 'all'),
+                        'LA_spectrograms_false': ('False-LMI-a-', 'all'),
+                        'LI_spectrograms_true': ('True-LMI-i-', 'all'),
+                        'LI_spectrograms_false': ('False-LMI-i-', 'all'),
+                        'LMI_a_spectrograms_true': ('True-LMI-a-', 'all'),
+                        'LMI_a_spectrograms_false': ('False-LMI-a-', 'all'),
+                        'LMI_i_spectrograms_true': ('True-LMI-i-', 'all'),
+                        'LMI_i_spectrograms_false': ('False-LMI-i-', 'all')}
+# bad channels found by hand in sessions recorded before the live signal quality
+# monitor saved info['bads'], keyed by a regexp of the filename
+KNOWN_BAD_CHANNELS = {r'N-\d\.2-22-2021': ['P3'],
+                      r'S-1\.3-4-2021': ['F8'],
+                      r'S-2\.3-8-2021': ['Cz']}
+# bumped when the cached cleaned raw format changes, so older entries are not used
+CLEANED_RAW_CACHE_VERSION = 2
+ANNOTATION_INDEX_DTYPE = np.dtype([('onset', 'i8'),
+                                    ('duration', 'f8'),
+                                    ('truth', '?'),
+                                    ('label', 'U8'),
+                                    ('flag', 'U64'),
+                                    ('session', 'i4'),
+                                    ('description', 'U96')])
 
 SAMS_PATH = r"C:\Users\Owner\OneDrive - Regis University\laryngeal_bci\data\fifs\\"
 NATES_PATH = r"C:\Users\words\OneDrive - Regis University\laryngeal_bci\data\fifs\\"
@@ -33,10 +92,315 @@ class spectrogramData:
         self.times = times
 
 
+class mlDataset:
+    """ Features, targets and groups for training a classifier.
+
+    The arrays are kept as contiguous numpy arrays; train_df and test_df are
+    only built (once) when something needs a DataFrame, e.g. pycaret.
+
+    Attributes
+    ----------
+    features : np.array
+        Training features with shape (samples, features).
+    targets : np.array
+        Training targets, 1 for True and 0 for False.
+    groups : np.array
+        Cross-validation fold of each training sample.
+    test_features, test_targets, test_groups : np.array
+        The same for the test set (groups are trial numbers), or None if there is no test set.
+    """
+    def __init__(self, features, targets, groups, test_features=None, test_targets=None, test_groups=None):
+        self.features = features
+        self.targets = targets
+        self.groups = groups
+        self.test_features = test_features
+        self.test_targets = test_targets
+        self.test_groups = test_groups
+        self._train_df = None
+        self._test_df = None
+
+    @staticmethod
+    def to_df(features, targets, groups):
+        df = pd.DataFrame(features, copy=False)
+        return df.assign(target=targets, group=groups)
+
+    @property
+    def train_df(self):
+        if self._train_df is None:
+            self._train_df = self.to_df(self.features, self.targets, self.groups)
+
+        return self._train_df
+
+    @property
+    def test_df(self):
+        if self.test_features is None:
+            return None
+
+        if self._test_df is None:
+            self._test_df = self.to_df(self.test_features, self.test_targets, self.test_groups)
+
+        return self._test_df
+
+
+def spectrogram_features(f1_spectrograms, f2_spectrograms, trial_idxs, freq_slice=slice(None)):
+    """Turns True and False spectrograms into one sample per time bin.
+
+    Parameters
+    ----------
+    f1_spectrograms, f2_spectrograms : np.array
+        True and False spectrograms with shape (trials, frequencies, times).
+    trial_idxs : np.array
+        Trials to use, from both the True and False spectrograms.
+    freq_slice : slice
+        Frequencies to keep as features.
+
+    Returns
+    -------
+    features : np.array
+        Contiguous array with shape (2 * trials * times, frequencies); all the
+        True samples come first, trial by trial, then the False ones.
+    targets : np.array
+        1 for True samples and 0 for False ones.
+    groups : np.array
+        Trial number of each sample.
+    """
+    n_times = f1_spectrograms.shape[-1]
+    n_samples = trial_idxs.shape[0] * n_times
+    n_freqs = len(range(*freq_slice.indices(f1_spectrograms.shape[1])))
+    features = np.empty((2 * n_samples, n_freqs), dtype=f1_spectrograms.dtype)
+    for i, spectrograms in enumerate([f1_spectrograms, f2_spectrograms]):
+        # (trials, frequencies, times) -> (trials * times, frequencies)
+        trimmed = spectrograms[trial_idxs, freq_slice].transpose(0, 2, 1)
+        features[i * n_samples:(i + 1) * n_samples] = trimmed.reshape(n_samples, n_freqs)
+
+    targets = np.repeat([1, 0], n_samples)
+    groups = np.tile(np.repeat(trial_idxs, n_times), 2)
+    return features, targets, groups
+
+
+def crop_windows(epochs_data, window, stride=None):
+    """Crops epochs into (possibly overlapping) windows without copying them.
+
+    Parameters
+    ----------
+    epochs_data : np.array
+        Epochs with shape (epochs, channels, samples).
+    window : int
+        Number of samples per crop.
+    stride : int
+        Number of samples between the starts of consecutive crops; defaults to
+        window (no overlap). Samples after the last whole crop are left out.
+
+    Returns
+    -------
+    crops : np.array
+        Read-only strided view with shape (epochs, crops, channels, window).
+    groups : np.array
+        Epoch number of each crop, in the order of crops.reshape(-1, channels, window).
+    """
+    if stride is None:
+        stride = window
+
+    # (epochs, channels, positions, window) -> (epochs, crops, channels, window)
+    crops = np.lib.stride_tricks.sliding_window_view(epochs_data, window, axis=-1)[:, :, ::stride]
+    crops = crops.transpose(0, 2, 1, 3)
+    groups = np.repeat(np.arange(crops.shape[0]), crops.shape[1])
+    return crops, groups
+
+
+def split_folds(num_trials, experiments_per_group, num_groups):
+    """Returns the fold of each of num_trials (already shuffled) trials.
+
+    The trials are split into consecutive chunks of experiments_per_group, with
+    the last fold getting any left over.
+    """
+    if experiments_per_group == 0:
+        return np.full(num_trials, num_groups - 1)
+
+    return np.minimum(np.arange(num_trials) // experiments_per_group, num_groups - 1)
+
+
+def batch_spectrograms(epochs_data, sfreq, nperseg=2000, noverlap=1000, batch_size=None):
+    """Computes the channel-averaged spectrogram of many epochs in one vectorized call.
+
+    Parameters
+    ----------
+    epochs_data : np.array
+        Epochs with shape (epochs, channels, samples).
+    sfreq : float
+        Sampling frequency in Hz.
+    nperseg : int
+        Number of points per segment in the spectrogram FFT.
+    noverlap : int
+        Number of overlapping points between segments.
+    batch_size : int
+        If given, epochs are processed this many at a time, which caps the memory
+        used by the per-channel spectrograms before they are averaged.
+
+    Returns
+    -------
+    frequencies : np.array
+    times : np.array
+    spectrograms : np.array
+        Spectrograms averaged over channels, with shape (epochs, frequencies, times).
+    """
+    n_epochs = epochs_data.shape[0]
+    if n_epochs == 0:
+        raise ValueError('no epochs to compute spectrograms of')
+
+    if batch_size is None:
+        batch_size = max(n_epochs, 1)
+
+    spectrograms = None
+    for start in range(0, n_epochs, batch_size):
+        # frequency, time, intensity (shape epochs*channels*f*t)
+        frequencies, times, batch = spsig.spectrogram(epochs_data[start:start + batch_size],
+                                                    fs=int(sfreq),
+                                                    nperseg=nperseg,
+                                                    noverlap=noverlap,
+                                                    axis=-1)
+        if spectrograms is None:
+            spectrograms = np.empty((n_epochs,) + batch.shape[2:])
+
+        batch.mean(axis=1, out=spectrograms[start:start + batch_size])
+
+    return frequencies, times, spectrograms
+
+
+def _nbytes(value, shared=None):
+    """
+    Estimates the memory owned by a lazy attribute's value.
+
+    Arrays that are views into shared (e.g. the label epochs wrapping
+    epochs_array) are not counted, since dropping them frees nothing.
+    """
+    if isinstance(value, np.ndarray):
+        if shared is not None and value is not shared and np.may_share_memory(value, shared):
+            return 0
+
+        return value.nbytes
+    if isinstance(value, list):
+        return sum(_nbytes(v, shared) for v in value)
+    if isinstance(value, spectrogramData):
+        return _nbytes(value.spectrograms, shared)
+    if isinstance(value, mne.BaseEpochs):
+        return _nbytes(value._data, shared)
+
+    return 0
+
+
+def _compute_epochs(eeg, name):
+    label = {var: label for label, var in EPOCHS_VARIABLES.items()}[name]
+    if eeg.annotation_index is None:
+        eeg.extract_all_epochs()
+
+    if label not in eeg.label_slices:
+        print(f'no epochs found for {label}')
+        return None
+
+    return eeg.get_label_epochs(label)
+
+
+def _compute_spectrograms(eeg, name):
+    annotation_regexp, channels = SPECTROGRAM_VARIABLES[name]
+    try:
+        eeg.get_spectrograms(annotation_regexp, name, channels=None if channels == 'viz' else 'all')
+    except ValueError:
+        print(f'no epochs found for {annotation_regexp}')
+
+
+def _compute_epochs_array(eeg, name):
+    eeg.extract_all_epochs()
+
+
+class lazyAttribute:
+    """
+    An eegData attribute that is computed on first access and memoized.
+
+    compute(eeg, name) either returns the value or assigns it to the attribute
+    itself. Memoized values count towards eegData.memory_budget_mb; when the
+    budget is exceeded, the least recently used ones are dropped and will be
+    recomputed the next time they are used. Assigning None drops the value.
+    """
+    def __init__(self, compute):
+        self.compute = compute
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, eeg, owner):
+        if eeg is None:
+            return self
+
+        values = eeg.__dict__.setdefault('_lazy_values', OrderedDict())
+        if self.name not in values:
+            if eeg.data is None:
+                return None
+
+            value = self.compute(eeg, self.name)
+            if self.name not in values:
+                if value is None:
+                    return None
+
+                self.__set__(eeg, value)
+
+        values.move_to_end(self.name)
+        return values.get(self.name)
+
+    def __set__(self, eeg, value):
+        values = eeg.__dict__.setdefault('_lazy_values', OrderedDict())
+        if value is None:
+            eeg.drop_lazy_attribute(self.name)
+            return
+
+        values[self.name] = value
+        values.move_to_end(self.name)
+        eeg.enforce_memory_budget()
+
+
 class eegData:
-    def __init__(self, path):
+    # epochs and spectrograms are computed when first used, see lazyAttribute
+    epochs_array = lazyAttribute(_compute_epochs_array)
+    alpha_epochs = lazyAttribute(_compute_epochs)
+    SSVEP_epochs = lazyAttribute(_compute_epochs)
+    MA_epochs = lazyAttribute(_compute_epochs)
+    MI_epochs = lazyAttribute(_compute_epochs)
+    LA_epochs = lazyAttribute(_compute_epochs)
+    LI_epochs = lazyAttribute(_compute_epochs)
+    alpha_spectrograms_true = lazyAttribute(_compute_spectrograms)
+    alpha_spectrograms_false = lazyAttribute(_compute_spectrograms)
+    SSVEP_spectrograms_true = lazyAttribute(_compute_spectrograms)
+    SSVEP_spectrograms_false = lazyAttribute(_compute_spectrograms)
+    MA_spectrograms_true = lazyAttribute(_compute_spectrograms)
+    MA_spectrograms_false = lazyAttribute(_compute_spectrograms)
+    MI_spectrograms_true = lazyAttribute(_compute_spectrograms)
+    MI_spectrograms_false = lazyAttribute(_compute_spectrograms)
+    LA_spectrograms_true = lazyAttribute(_compute_spectrograms)
+    LA_spectrograms_false = lazyAttribute(_compute_spectrograms)
+    LI_spectrograms_true = lazyAttribute(_compute_spectrograms)
+    LI_spectrograms_false = lazyAttribute(_compute_spectrograms)
+    LMI_a_spectrograms_true = lazyAttribute(_compute_spectrograms)
+    LMI_a_spectrograms_false = lazyAttribute(_compute_spectrograms)
+    LMI_i_spectrograms_true = lazyAttribute(_compute_spectrograms)
+    LMI_i_spectrograms_false = lazyAttribute(_compute_spectrograms)
+
+    def __init__(self, path, cache_dir=None, cache_size_mb=2000, memory_budget_mb=None, profile=False):
         """
         Path sould be 'Nates', 'Sams', or the actual filepath to the data.
+
+        If cache_dir is given, cleaned data and spectrograms are cached there as
+        .npy files, keyed on the source files' contents and all the parameters
+        used to make them, and reused across runs. The cache is capped at
+        cache_size_mb, evicting the least recently used entries.
+
+        Epochs and spectrogram attributes (e.g. LI_epochs, SSVEP_spectrograms_true)
+        are computed the first time they are used. If memory_budget_mb is given,
+        the least recently used ones are dropped when they take more memory than
+        that, and recomputed if they are needed again.
+
+        If profile is True (or a stageProfiler), the time, CPU time, peak memory
+        and item counts of each loading, cleaning, epoching and spectrogram stage
+        are recorded in self.profiler; see profile_report.
         """
         if path == 'Nates':
             self.path = r"C:\Users\words\OneDrive - Regis University\laryngeal_bci\data\fifs\\"
@@ -45,28 +409,115 @@ class eegData:
         else:
             self.path = path
 
-        self.alpha_spectrograms_true = None
-        self.alpha_spectrograms_false = None
-        self.SSVEP_spectrograms_true = None
-        self.SSVEP_spectrograms_false = None
-        self.MA_spectrograms_true = None
-        self.MA_spectrograms_false = None
-        self.MI_spectrograms_true = None
-        self.MI_spectrograms_false = None
-        self.LA_spectrograms_true = None
-        self.LA_spectrograms_false = None
-        self.LI_spectrograms_true = None
-        self.LI_spectrograms_false = None
-        self.MA_epochs = None
-        self.MI_epochs = None
-        self.LA_epochs = None
-        self.LI_epochs = None
+        self.data = None
+        self.memory_budget_mb = memory_budget_mb
+        # dense (epochs x frequencies x times) spectrograms, keyed by the attribute name
+        self.spectrogram_arrays = {}
+        # built by extract_all_epochs
+        self.annotation_index = None
+        # bad channels of each loaded file, see get_bad_channels
+        self.bads = {}
+        self.epochs_info = None
+        self.label_slices = None
+        self.filenames = None
+        self.cleaning_params = None
+        self.cache_dir = cache_dir
+        self.cache_size_mb = cache_size_mb
+        self.cache = diskCache(cache_dir, cache_size_mb) if cache_dir is not None else None
+        if isinstance(profile, stageProfiler):
+            self.profiler = profile
+        else:
+            self.profiler = stageProfiler() if profile else None
 
         self.viz_channels = ['O1', 'O2', 'P3', 'P4']
 
 
+    def drop_lazy_attribute(self, name):
+        """
+        Drops the memoized value of a lazy attribute so it will be recomputed.
+        """
+        values = self.__dict__.setdefault('_lazy_values', OrderedDict())
+        values.pop(name, None)
+        self.spectrogram_arrays.pop(name, None)
+        if name == 'epochs_array':
+            self.annotation_index = None
+            # the label epochs are views of epochs_array, which would otherwise stay in memory
+            for var in EPOCHS_VARIABLES.values():
+                values.pop(var, None)
+
+
+    def drop_lazy_attributes(self):
+        """
+        Drops all memoized epochs and spectrograms, e.g. when new data is loaded.
+        """
+        for name in list(self.__dict__.get('_lazy_values', {})):
+            self.drop_lazy_attribute(name)
+
+        self.annotation_index = None
+
+
+    def enforce_memory_budget(self):
+        """
+        Drops the least recently used lazy attributes until the memoized ones
+        fit in memory_budget_mb. The most recently used one is always kept,
+        along with epochs_array if it is a label's epochs.
+
+        The label epochs are views of epochs_array, so they count nothing
+        themselves and are dropped along with it.
+        """
+        if self.memory_budget_mb is None:
+            return
+
+        values = self.__dict__.get('_lazy_values', {})
+        budget = self.memory_budget_mb * 2**20
+        shared = values.get('epochs_array')
+        sizes = {name: _nbytes(value, shared) for name, value in values.items()}
+        total = sum(sizes.values())
+        names = list(values)
+        keep_epochs_array = names[-1] in EPOCHS_VARIABLES.values()
+        for name in names[:-1]:
+            if total <= budget:
+                break
+
+            if name not in values or (name == 'epochs_array' and keep_epochs_array):
+                continue
+
+            self.drop_lazy_attribute(name)
+            total -= sizes[name]
+
+
+    def profile_stage(self, name, filename=None):
+        """
+        Returns a context manager that profiles a stage if profiling is on.
+
+        It yields a dict that item counts (keys starting with 'n_') can be added
+        to; when profiling is off it does nothing.
+        """
+        if self.profiler is None:
+            return nullcontext({})
+
+        return self.profiler.stage(name, filename)
+
+
+    def profile_report(self, by_file=False, filename=None):
+        """
+        Prints a table of the profiled stages, and saves them as JSON if filename is given.
+        """
+        if self.profiler is None:
+            print('profiling is off; use eegData(path, profile=True)')
+            return
+
+        print(self.profiler.report(by_file=by_file))
+        if filename is not None:
+            self.profiler.to_json(filename)
+
+
     def load_data(self, filename):
-        return mne.io.read_raw_fif(filename, preload=True, verbose=0)
+        with self.profile_stage('load_data', filename) as record:
+            data = mne.io.read_raw_fif(filename, preload=True, verbose=0)
+            record['n_samples'] = data.n_times
+
+        return data
 
 
     def clean_data(self, data, first_seconds_remove=2, bandpass_range=(5, 50)):
@@ -74,9 +525,15 @@ class eegData:
         Removes first 2 seconds and bandpass filters data.
         Takes MNE data object and tuple for bandpass filter range.
         """
+        filename = data.filenames[0] if len(data.filenames) > 0 else None
         # bandpass filter
-        data = data.filter(*bandpass_range)
-        data = data.notch_filter(np.arange(60, 241, 60))
+        with self.profile_stage('bandpass_filter', filename) as record:
+            data = data.filter(*bandpass_range)
+            record['n_samples'] = data.n_times
+
+        with self.profile_stage('notch_filter', filename) as record:
+            data = data.notch_filter(NOTCH_FREQUENCIES)
+            record['n_samples'] = data.n_times
 
         # print(f'removing first {first_seconds_remove} seconds')
         data.crop(first_seconds_remove)
@@ -84,6 +541,44 @@ class eegData:
         return data
 
 
+    def load_cleaned_data(self, filename, first_seconds_remove=2, bandpass_range=(5, 50)):
+        """
+        Loads and cleans one file, using the disk cache if there is one.
+
+        The cleaned, cropped data is cached uncompressed, keyed on the file's
+        contents, the cleaning parameters and the MNE version. Cached data is
+        memory-mapped copy-on-write, so nothing is re-filtered and pages are
+        only read (or copied) when they are used or modified.
+        """
+        key = None
+        if self.cache is not None:
+            key = self.cache.key('cleaned_raw',
+                                CLEANED_RAW_CACHE_VERSION,
+                                file_hash(filename),
+                                first_seconds_remove,
+                                bandpass_range,
+                                NOTCH_FREQUENCIES.tolist(),
+                                mne.__version__)
+            with self.profile_stage('cache_get', filename) as record:
+                cached = self.cache.get(key, mmap_mode='c')
+                record['n_hits'] = int(cached is not None)
+
+            if cached is not None:
+                return raw_from_arrays(*cached)
+
+        data = self.clean_data(self.load_data(filename),
+                                first_seconds_remove=first_seconds_remove,
+                                bandpass_range=bandpass_range)
+        if key is not None:
+            with self.profile_stage('cache_put', filename):
+                arrays, meta = raw_to_arrays(data)
+                # a later cache hit must epoch the same samples as this miss
+                check_round_trip(data, raw_from_arrays(arrays, meta))
+                self.cache.put(key, arrays, meta)
+
+        return data
+
+
     def flatten_bad_channels(self, data, channels):
         """
         Sets bad channels to 0s.
@@ -95,80 +590,205 @@ class eegData:
         data.apply_function(lambda x: x * 0, channels)
 
 
-    def standardize_all_channels(self, data):
+    def get_bad_channels(self, filename, data):
         """
-        Subtracts the mean from each channel, divide by the standard deviation.
+        Returns the bad channels of a file: the ones the signal quality monitor
+        saved in info['bads'] while recording, or for older sessions the ones in
+        KNOWN_BAD_CHANNELS.
+        """
+        if len(data.info['bads']) > 0:
+            return list(data.info['bads'])
+
+        for regexp, channels in KNOWN_BAD_CHANNELS.items():
+            if re.search(regexp, os.path.basename(filename)) is not None:
+                return channels
+
+        return []
+
+
+    def standardize_all_channels(self, data, robust=False):
         """
-        for channel in data.ch_names:
-            # get mean and std, subtract mean, divide by std
-            mean = data.get_data(channel)
-            std = np.std(data.get_data(channel))
-            mean = np.mean(data.get_data(channel))
-            data.apply_function(lambda x: (x - mean)/std, channel)
+        Subtracts the mean from each channel, divide by the standard deviation.
 
+        Works in place on the underlying data array, computing the statistics
+        for all channels at once. If robust is True, the median and the median
+        absolute deviation (scaled to match the standard deviation of normal
+        data) are used instead, which are less affected by artifacts.
+        """
+        array = data._data
+        if robust:
+            center = np.median(array, axis=1)
+            scale = np.empty_like(center)
+            # one channel at a time so only one channel-sized temporary array is made
+            for i in range(array.shape[0]):
+                scale[i] = 1.4826 * np.median(np.abs(array[i] - center[i]))
+        else:
+            center = array.mean(axis=1)
+            # mean of squares via einsum avoids a full-size temporary array
+            variance = np.einsum('ij,ij->i', array, array) / array.shape[1] - center ** 2
+            scale = np.sqrt(np.maximum(variance, 0))
+
+        # flattened (all zero) channels would otherwise be divided by 0
+        scale[scale == 0] = 1
+        array -= center[:, np.newaxis]
+        array /= scale[:, np.newaxis]
         return data
 
 
-    def load_clean_all_data(self, flatten=False, standardize=True):
+    def load_clean_file(self, filename, flatten=False, standardize=True, robust=False):
+        """
+        Loads and cleans one file for load_clean_all_data.
+
+        Returns the cleaned MNE data object and a dictionary of how many
+        seconds each step took.
+        """
+        times = {}
+        start = time.time()
+        data = self.load_cleaned_data(filename)
+        times['load_clean'] = time.time() - start
+
+        data.info['bads'] = self.get_bad_channels(filename, data)
+        if flatten and len(data.info['bads']) > 0:
+            self.flatten_bad_channels(data, data.info['bads'])
+
+        if standardize:
+            step_start = time.time()
+            with self.profile_stage('standardize', filename) as record:
+                self.standardize_all_channels(data, robust=robust)
+                record['n_samples'] = data.n_times
+
+            times['standardize'] = time.time() - step_start
+
+        times['total'] = time.time() - start
+        return data, times
+
+
+    def load_clean_all_data(self, flatten=False, standardize=True, n_jobs=1, robust=False, standardize_by='session', lazy=True):
         """
         Loads and cleans all current data.
+
+        If lazy is True, epochs and spectrograms are only computed when they are
+        used; otherwise they are all computed now.
+
+        With n_jobs > 1 (or -1 for all cores), files are loaded and cleaned in
+        parallel worker processes. Files are always concatenated in sorted
+        filename order, and the time each file took is stored in self.load_times.
+
+        standardize_by is 'session' to standardize each file with its own
+        statistics, or 'global' to standardize the concatenated data once with
+        statistics over all files. robust uses the median/MAD instead of mean/std.
+
+        The bad channels of each file (found while recording by the signal
+        quality monitor, see get_bad_channels) are stored in self.bads, and
+        zeroed if flatten is True.
         """
-        filenames = [f for f in glob.glob(self.path + '*_raw.fif.gz')]
+        filenames = sorted(glob.glob(self.path + '*_raw.fif.gz'))
+        if len(filenames) == 0:
+            raise ValueError(f'no *_raw.fif.gz files found in {self.path}')
+
         self.filenames = filenames
-        list_of_data = []
-        for f in filenames:
-            data = self.load_data(f)
-            data = self.clean_data(data)
-
-            if flatten:
-                if re.search('N-\d\.2-22-2021', f) is not None:
-                    clean_bad_channels(data, 'P3')
-                elif f == 'BCIproject_trial-S-1.3-4-2021_raw.fif.gz':
-                    clean_bad_channels(data, 'F8')
-                elif f == 'BCIproject_trial-S-2.3-8-2021_raw.fif.gz':
-                    clean_bad_channels(data, 'Cz')
-                elif f == 'BCIproject_trial-S-3.3-25-2021_raw.fif.gz':
-                    pass
-                    # clean_bad_channels(data, ['Cz', 'C1'])
-            if standardize:
-                self.standardize_all_channels(data)
-
-            list_of_data.append(data)
-
-        all_data = mne.concatenate_raws(list_of_data)
+        self.cleaning_params = {'first_seconds_remove': 2,
+                                'bandpass_range': (5, 50),
+                                'flatten': flatten,
+                                'standardize': standardize,
+                                'robust': robust,
+                                'standardize_by': standardize_by}
+        standardize_sessions = standardize and standardize_by == 'session'
+        if n_jobs == 1:
+            results = [self.load_clean_file(f, flatten=flatten, standardize=standardize_sessions, robust=robust) for f in filenames]
+            results = [r + ([],) for r in results]
+        else:
+            max_workers = os.cpu_count() if n_jobs == -1 else n_jobs
+            with ProcessPoolExecutor(max_workers=min(max_workers, len(filenames))) as executor:
+                # map returns results in the order of filenames, whichever finishes first
+                results = list(executor.map(_load_clean_file,
+                                            repeat(self.path),
+                                            filenames,
+                                            repeat(flatten),
+                                            repeat(standardize_sessions),
+                                            repeat(robust),
+                                            repeat(self.cache_dir),
+                                            repeat(self.cache_size_mb),
+                                            repeat(self.profiler is not None)))
+
+        list_of_data = [r[0] for r in results]
+        self.load_times = {f: r[1] for f, r in zip(filenames, results)}
+        # every file keeps all its channels (flattened if flatten is True), so
+        # they concatenate and epochs have the same channels whichever are bad
+        self.bads = {}
+        for f, data in zip(filenames, list_of_data):
+            self.bads[f] = data.info['bads']
+            data.info['bads'] = []
+
+        if self.profiler is not None:
+            # stages profiled in worker processes
+            for r in results:
+                self.profiler.add_records(r[2])
+
+        for f, times in self.load_times.items():
+            print(f'{os.path.basename(f)}: ' + ', '.join(f'{k} {v:.2f}s' for k, v in times.items()))
+
+        with self.profile_stage('concatenate_raws') as record:
+            all_data = mne.concatenate_raws(list_of_data)
+            record['n_samples'] = all_data.n_times
+
+        if standardize and standardize_by == 'global':
+            with self.profile_stage('standardize') as record:
+                self.standardize_all_channels(all_data, robust=robust)
+                record['n_samples'] = all_data.n_times
+
         self.annotation_descriptions = [i["description"] for i in all_data.annotations]
+        self.drop_lazy_attributes()
         self.data = all_data
-        self.get_all_epochs()
-        self.get_all_spectrograms()
+        if not lazy:
+            self.get_all_epochs()
+            self.get_all_spectrograms()
 
 
-    def load_clean_one_dataset(self, filename, flatten=False, standardize=True):
+    def load_clean_one_dataset(self, filename, flatten=False, standardize=True, robust=False, lazy=True):
         """
         Loads and cleans one dataset
+
+        If lazy is True, epochs and spectrograms are only computed when they are
+        used; otherwise they are all computed now.
         """
-        self.data = self.load_data(filename)
-
-        self.data = self.clean_data(self.data)
-
-        if flatten:
-            # clean_bad_channels(data, 'P3')
-            if re.search('N-\d\.2-22-2021', f) is not None:
-                clean_bad_channels(data, 'P3')
-            elif filename == 'BCIproject_trial-S-1.3-4-2021_raw.fif.gz':
-                clean_bad_channels(data, 'F8')
-            elif filename == 'BCIproject_trial-S-2.3-8-2021_raw.fif.gz':
-                clean_bad_channels(data, 'Cz')
-            elif filename == 'BCIproject_trial-S-3.3-25-2021_raw.fif.gz':
-                pass
-                # clean_bad_channels(data, ['Cz', 'C1'])
-            pass
+        self.filenames = [filename]
+        self.cleaning_params = {'first_seconds_remove': 2,
+                                'bandpass_range': (5, 50),
+                                'flatten': flatten,
+                                'standardize': standardize,
+                                'robust': robust}
+        self.data = self.load_cleaned_data(filename)
+        self.bads = {filename: self.get_bad_channels(filename, self.data)}
+        self.data.info['bads'] = []
+        if flatten and len(self.bads[filename]) > 0:
+            self.flatten_bad_channels(self.data, self.bads[filename])
 
         if standardize:
-            self.standardize_all_channels(self.data)
+            self.standardize_all_channels(self.data, robust=robust)
 
         self.annotation_descriptions = self.data.annotations
-        self.get_all_epochs()
-        self.get_all_spectrograms()
+        self.drop_lazy_attributes()
+        if not lazy:
+            self.get_all_epochs()
+            self.get_all_spectrograms()
+
+
+    def cache_key(self, kind, **params):
+        """
+        Returns the disk cache key for a computation on the loaded data, or None
+        if there is no cache or the source files are unknown.
+
+        The key covers the contents of the source files, the cleaning parameters
+        they were loaded with, and the parameters of the computation.
+        """
+        if self.cache is None or self.filenames is None:
+            return None
+
+        return self.cache.key(kind,
+                            [file_hash(f) for f in self.filenames],
+                            self.cleaning_params,
+                            params)
 
 
     def get_epochs(self, annotation_regexp):
@@ -181,85 +801,291 @@ class eegData:
         return epochs
 
 
+    def annotation_onset_samples(self):
+        """
+        Returns the onset sample of every annotation of the loaded data.
+        """
+        annotations = self.data.annotations
+        # the same conversion mne.events_from_annotations uses
+        onset_samples = self.data.time_as_index(annotations.onset,
+                                                use_rounding=True,
+                                                origin=annotations.orig_time)
+        if annotations.orig_time is not None:
+            onset_samples += self.data.first_samp
+
+        return onset_samples
+
+
+    def session_start_samples(self):
+        """
+        Returns the first sample of each concatenated file, in the frame of
+        annotation_onset_samples, so annotation_index['session'] indexes it.
+        """
+        annotations = self.data.annotations
+        onset_samples = self.annotation_onset_samples()
+        boundaries = np.sort(onset_samples[annotations.description == 'EDGE boundary'])
+        first = self.data.first_samp if annotations.orig_time is not None else 0
+        return np.concatenate([[first], boundaries])
+
+
+    def build_annotation_index(self):
+        """
+        Parses the trial annotations of the loaded data into a structured array.
+
+        Each row has the onset sample, duration, truth, label, flag and session
+        (the number of the concatenated file the trial came from) of one trial,
+        parsed from the descriptions written by expData.stopBCI. Other
+        annotations, like the boundaries between concatenated files, are skipped.
+        """
+        annotations = self.data.annotations
+        onset_samples = self.annotation_onset_samples()
+        boundaries = np.sort(onset_samples[annotations.description == 'EDGE boundary'])
+        rows = []
+        for onset, duration, description in zip(onset_samples, annotations.duration, annotations.description):
+            match = TRIAL_DESCRIPTION_REGEXP.match(description)
+            if match is None:
+                continue
+
+            truth, label, flag = match.groups()
+            session = np.searchsorted(boundaries, onset, side='right')
+            rows.append((onset, duration, truth == 'True', label, flag, session, description))
+
+        return np.array(rows, dtype=ANNOTATION_INDEX_DTYPE)
+
+
+    def extract_all_epochs(self, tmin=0, tmax=5):
+        """
+        Extracts every trial epoch from the data in a single pass.
+
+        The epochs are stored in one dense (epochs x channels x samples) array,
+        self.epochs_array, grouped by label (in TRIAL_LABELS order) and in time
+        order within each label. self.annotation_index holds the parsed
+        annotation of each epoch in the same order, and self.label_slices the
+        slice of each label, so epochs for a label are views, not copies.
+        """
+        with self.profile_stage('extract_all_epochs') as record:
+            index = self.build_annotation_index()
+            events = np.column_stack([index['onset'],
+                                        np.zeros(len(index), dtype=int),
+                                        np.ones(len(index), dtype=int)])
+            picks = mne.pick_types(self.data.info, eeg=True)
+            epochs = mne.Epochs(self.data, events, tmin=tmin, tmax=tmax, picks=picks, preload=True, baseline=None, verbose=0)
+            # epochs running past the end of the data are dropped
+            index = index[epochs.selection]
+            record['n_epochs'] = len(index)
+
+            label_order = np.array([TRIAL_LABELS.index(l) for l in index['label']], dtype=int)
+            order = np.lexsort((index['onset'], label_order))
+            self.epochs_array = np.take(epochs.get_data(), order, axis=0)
+
+        self.epochs_info = epochs.info
+        self.epochs_tmin = tmin
+        self.annotation_index = index[order]
+
+        label_order = label_order[order]
+        self.label_slices = {}
+        for i, label in enumerate(TRIAL_LABELS):
+            start, stop = np.searchsorted(label_order, [i, i + 1])
+            if stop > start:
+                self.label_slices[label] = slice(start, stop)
+
+
+    def export_epochs(self, store_dir, spectrograms=False, nperseg=2000, noverlap=1000):
+        """
+        Writes every extracted epoch to a store partitioned by session,
+        paradigm and truth label; see epoch_store.py.
+
+        Each session is written whole, replacing any earlier export of it, so
+        sessions can be exported as they are recorded. epoch_store.load_epochs
+        then reads only the partitions it needs, e.g. paradigms=['LMI-i'].
+
+        If spectrograms is True, each epoch's channel-averaged spectrogram
+        (see batch_spectrograms) is stored next to it.
+
+        Returns the IDs of the exported sessions.
+        """
+        if self.annotation_index is None:
+            self.extract_all_epochs()
+
+        sfreq = self.epochs_info['sfreq']
+        montage = self.epochs_info.get_montage()
+        positions = None
+        if montage is not None:
+            positions = {k: v.tolist() for k, v in montage.get_positions()['ch_pos'].items()}
+
+        session_starts = self.session_start_samples()
+        index = self.annotation_index
+        session_ids = []
+        with self.profile_stage('export_epochs') as record:
+            for session in np.unique(index['session']):
+                if self.filenames is not None and session < len(self.filenames):
+                    filename = self.filenames[session]
+                    session_name = epoch_store.session_id(filename)
+                    source = {'filename': os.path.basename(filename), 'hash': file_hash(filename)}
+                    bads = self.bads.get(filename, [])
+                else:
+                    session_name = str(session)
+                    source = None
+                    bads = []
+
+                partitions = {}
+                for label in TRIAL_LABELS:
+                    for truth in [True, False]:
+                        idxs = np.flatnonzero((index['session'] == session) & (index['label'] == label) & (index['truth'] == truth))
+                        if idxs.shape[0] == 0:
+                            continue
+
+                        epochs_data = self.epochs_array[idxs]
+                        arrays = {'epochs': epochs_data}
+                        meta = {'sfreq': sfreq,
+                                'tmin': self.epochs_tmin,
+                                'ch_names': self.epochs_info.ch_names,
+                                'montage': positions,
+                                'bads': bads,
+                                'cleaning_params': self.cleaning_params,
+                                'source': source,
+                                'n_epochs': int(idxs.shape[0]),
+                                'onsets': ((index['onset'][idxs] - session_starts[session]) / sfreq).tolist(),
+                                'durations': index['duration'][idxs].tolist(),
+                                'flags': index['flag'][idxs].tolist()}
+                        if spectrograms:
+                            frequencies, times, spectrogram_data = batch_spectrograms(epochs_data,
+                                                                                    sfreq,
+                                                                                    nperseg=nperseg,
+                                                                                    noverlap=noverlap)
+                            arrays.update(spectrograms=spectrogram_data, frequencies=frequencies, times=times)
+                            meta.update(nperseg=nperseg, noverlap=noverlap)
+
+                        partitions[(label, truth)] = (arrays, meta)
+
+                epoch_store.write_session(store_dir, session_name, partitions)
+                session_ids.append(session_name)
+
+            record['n_epochs'] = len(index)
+            record['n_sessions'] = len(session_ids)
+
+        return session_ids
+
+
+    def get_epochs_data(self, annotation_regexp, channels=None):
+        """
+        Returns the epochs whose annotation matches annotation_regexp as a
+        (epochs x channels x samples) array, plus their rows of the annotation index.
+
+        The match works like mne.events_from_annotations. When the matching
+        epochs are contiguous (e.g. all epochs of one label) and all channels
+        are used, the array is a view into self.epochs_array.
+        """
+        if self.annotation_index is None:
+            self.extract_all_epochs()
+
+        pattern = re.compile(annotation_regexp)
+        mask = np.array([pattern.match(d) is not None for d in self.annotation_index['description']], dtype=bool)
+        idxs = np.flatnonzero(mask)
+        if idxs.shape[0] == 0:
+            raise ValueError(f'no epochs found for {annotation_regexp}')
+
+        if idxs[-1] - idxs[0] + 1 == idxs.shape[0]:
+            epochs_data = self.epochs_array[idxs[0]:idxs[-1] + 1]
+        else:
+            epochs_data = self.epochs_array[idxs]
+
+        if channels is not None:
+            channel_idxs = [self.epochs_info.ch_names.index(c) for c in channels]
+            epochs_data = epochs_data[:, channel_idxs]
+
+        return epochs_data, self.annotation_index[idxs]
+
+
+    def get_label_epochs(self, label):
+        """
+        Returns an MNE epochs object for one trial label (e.g. 'LMI-i') that
+        wraps a view of self.epochs_array. The event id is 2 for True trials
+        and 1 for False trials.
+        """
+        if self.annotation_index is None:
+            self.extract_all_epochs()
+
+        label_slice = self.label_slices[label]
+        index = self.annotation_index[label_slice]
+        events = np.column_stack([index['onset'],
+                                    np.zeros(len(index), dtype=int),
+                                    np.where(index['truth'], 2, 1)])
+        event_id = {f'False-{label}': 1, f'True-{label}': 2}
+        event_id = {k: v for k, v in event_id.items() if v in events[:, -1]}
+        return mne.EpochsArray(self.epochs_array[label_slice],
+                                self.epochs_info,
+                                events=events,
+                                tmin=self.epochs_tmin,
+                                event_id=event_id,
+                                baseline=None,
+                                verbose=0)
+
+
     def get_all_epochs(self):
         """
         Stores all epochs for separate events in attributes.
+
+        All epochs are extracted once; each attribute wraps a view of its label's epochs.
         """
-        epochs_variables = ['alpha_epochs',
-                            'SSVEP_epochs',
-                            'MA_epochs',
-                            'MI_epochs',
-                            'LA_epochs',
-                            'LI_epochs']
-        epochs_regexps = ['.*alpha', '.*SSVEP.*', '.*-TMI-a', '.*-TMI-i', '.*-LMI-a', '.*-LMI-i']
-        for var, regexp in zip(epochs_variables, epochs_regexps):
-            try:
-                epochs = self.get_epochs(regexp)
-                setattr(self, var, epochs)
-            except:
-               print(f'no epochs found for {regexp}')
+        self.extract_all_epochs()
+        for var in EPOCHS_VARIABLES.values():
+            getattr(self, var)
 
 
     def get_spectrograms(self, annotation_regexp, variable_for_storing_spectrogram, nperseg=2000, noverlap=1000, channels=None):
+        """
+        Computes channel-averaged spectrograms for all epochs matching annotation_regexp.
+
+        The list of per-epoch spectrogramData objects is stored in the
+        variable_for_storing_spectrogram attribute; the spectrograms in it are
+        views into one dense (epochs x frequencies x times) array, which is
+        stored in self.spectrogram_arrays and returned.
+        """
         if channels is None:
             channels = self.viz_channels
-        elif channels is 'all':
+        elif channels == 'all':
             channels = self.data.ch_names
 
-        epochs = self.get_epochs(annotation_regexp=annotation_regexp)
-        spectData = []
-
-        # adjusts times so they match the spectrograms
-        time_add = nperseg / self.data.info['sfreq'] - 1
-
-        for i in range(len(epochs)):
-            spectrograms = []
-            channel_data = epochs[i].pick_channels(channels).get_data()[0]
-            for k in range(channel_data.shape[0]):
-                # frequency, time, intensity (shape f*t)
-                frequencies, times, spectrogram = spsig.spectrogram(channel_data[k, :],
-                                                            fs=int(self.data.info['sfreq']),
-                                                            nperseg=nperseg,
-                                                            noverlap=noverlap)
-                spectrograms.append(spectrogram)
-
-            average_spectogram = np.mean(np.array(spectrograms), axis=0)
-            spectData.append(spectrogramData(average_spectogram, frequencies, times))
-
+        cache_key = self.cache_key('spectrograms',
+                                    annotation_regexp=annotation_regexp,
+                                    channels=list(channels),
+                                    nperseg=nperseg,
+                                    noverlap=noverlap)
+        with self.profile_stage('spectrograms') as record:
+            cached = self.cache.get(cache_key) if cache_key is not None else None
+            if cached is not None:
+                arrays, _ = cached
+                frequencies, times, spectrograms = arrays['frequencies'], arrays['times'], arrays['spectrograms']
+            else:
+                epochs_data, _ = self.get_epochs_data(annotation_regexp, channels=channels)
+                frequencies, times, spectrograms = batch_spectrograms(epochs_data,
+                                                                    self.data.info['sfreq'],
+                                                                    nperseg=nperseg,
+                                                                    noverlap=noverlap)
+                if cache_key is not None:
+                    self.cache.put(cache_key, {'frequencies': frequencies,
+                                                'times': times,
+                                                'spectrograms': spectrograms})
+
+            record['n_spectrograms'] = spectrograms.shape[0]
+            record['n_hits'] = int(cached is not None)
+
+        spectrogram_array = spectrogramData(spectrograms, frequencies, times)
+        self.spectrogram_arrays[variable_for_storing_spectrogram] = spectrogram_array
+        spectData = [spectrogramData(s, frequencies, times) for s in spectrograms]
         setattr(self, variable_for_storing_spectrogram, spectData)
+        return spectrogram_array
 
 
     def get_all_spectrograms(self):
-        spectrogram_variables = ['alpha_spectrograms_true',
-                                'alpha_spectrograms_false',
-                                'MA_spectrograms_true',
-                                'MA_spectrograms_false',
-                                'MI_spectrograms_true',
-                                'MI_spectrograms_false',
-                                'LA_spectrograms_true',
-                                'LA_spectrograms_false',
-                                'LI_spectrograms_true',
-                                'LI_spectrograms_false']
-        annotation_regular_expressions = ['True-alpha-',
-                                            'False-alpha-',
-                                            'True-SSVEP-.*',
-                                            'False-SSVEP-.*',
-                                            'True-TMI-a-',
-                                            'False-TMI-a-',
-                                            'True-TMI-i-',
-                                            'False-TMI-i-',
-                                            'True-LMI-a-',
-                                            'False-LMI-a-',
-                                            'True-LMI-i-',
-                                            'False-LMI-i-']
-        motor_channels = self.data.ch_names
-        channels = [self.viz_channels] * 4 + [motor_channels] * 8
-
-        for annot_regex, spect_var, chans in zip(annotation_regular_expressions, spectrogram_variables, channels):
-            try:
-                self.get_spectrograms(annot_regex, spect_var, channels=chans)
-            except:
-                print(f'no epochs found for {annot_regex}')
+        """
+        Computes all spectrogram attributes now instead of when they are first used.
+        """
+        for spect_var in SPECTROGRAM_VARIABLES:
+            # the LMI_ attributes hold the same spectrograms as LA_ and LI_
+            if not spect_var.startswith('LMI_'):
+                getattr(self, spect_var)
 
 
     def create_alpha_spectrograms(self, nperseg=2000, noverlap=1000, channels=None):
@@ -384,630 +1210,436 @@ class eegData:
             self.plot_spectrogram(self.SSVEP_spectrograms_true[i], vmax=vmax)
 
 
-    def prepare_SSVEP_data_for_ml(self, f1=None, f2=None, train_fraction=0.8, num_groups=3):
-        # indices for trimming data; frequencies are in 0.5Hz increments from 0 to 500
-        freq_idxs = (10, 101)
-        np.random.seed(42)
-        self.SSVEP_test_df = None
-        if f1 is None or f2 is None:
-            if self.SSVEP_spectrograms_true is None:
-                self.create_SSVEP_spectrograms()
-            f1_spectrograms, f1_frequencies, f1_times, f1_groups = [], [], [], []
-            f2_spectrograms, f2_frequencies, f2_times, f2_groups = [], [], [], []
-            for i in range(len(self.SSVEP_spectrograms_false)):
-                f1_spectrograms.append(self.SSVEP_spectrograms_true[i].spectrograms[freq_idxs[0]:freq_idxs[1]])
-                f1_frequencies.append(self.SSVEP_spectrograms_true[i].frequencies[freq_idxs[0]:freq_idxs[1]])
-                f1_times.append(self.SSVEP_spectrograms_true[i].times)
-                f1_groups.append(len(self.SSVEP_spectrograms_true[i].times) * [i])
-                f2_spectrograms.append(self.SSVEP_spectrograms_false[i].spectrograms[freq_idxs[0]:freq_idxs[1]])
-                f2_frequencies.append(self.SSVEP_spectrograms_false[i].frequencies[freq_idxs[0]:freq_idxs[1]])
-                f2_times.append(self.SSVEP_spectrograms_false[i].times)
-                f2_groups.append(len(self.SSVEP_spectrograms_false[i].times) * [i])
-
-            f1 = spectrogramData(f1_spectrograms, f1_frequencies, f1_times)
-            f2 = spectrogramData(f2_spectrograms, f2_frequencies, f2_times)
-
-        num_train_samples = int(train_fraction * len(f1.spectrograms))
-        idxs = list(range(len(f1.spectrograms)))
-        train_idxs = np.random.choice(idxs, num_train_samples, replace=False)
-        train_f1s = np.concatenate([f1.spectrograms[i] for i in train_idxs], axis=1)
-        train_f2s = np.concatenate([f2.spectrograms[i] for i in train_idxs], axis=1)
-        train_f1_groups = np.concatenate([f1_groups[i] for i in train_idxs])
-        train_f2_groups = np.concatenate([f2_groups[i] for i in train_idxs])
-        if train_fraction < 1:
-            test_idxs = list(set(idxs).difference(set(train_idxs)))
-            test_f1s = np.concatenate([f1.spectrograms[i] for i in test_idxs], axis=1)
-            test_f2s = np.concatenate([f2.spectrograms[i] for i in test_idxs], axis=1)
-            test_f1_groups = np.concatenate([f1_groups[i] for i in test_idxs])
-            test_f2_groups = np.concatenate([f1_groups[i] for i in test_idxs])
-
-
-        train_features = np.concatenate((train_f1s, train_f2s), axis=-1)
-        train_features = train_features.T
-        train_targets = np.array([1] * train_f1s.shape[1] + [0] * train_f2s.shape[1])
-        train_groups = np.concatenate((train_f1_groups, train_f2_groups))
-        if train_fraction < 1:
-            test_features = np.concatenate((test_f1s, test_f2s), axis=-1)
-            test_targets = np.array([1] * test_f1s.shape[1] + [0] * test_f2s.shape[1])
-            test_groups = np.concatenate((test_f1_groups, test_f2_groups))
-            test_features = test_features.T
-
-        self.SSVEP_train_df = pd.DataFrame(train_features)
-        self.SSVEP_train_df['target'] = train_targets
-        self.SSVEP_train_df['group'] = train_groups
-        # required for pycaret to work if targets are the actual frequencies
-        # self.SSVEP_train_df['target'] = self.SSVEP_train_df['target'].astype('category')
-        if train_fraction < 1:
-            self.SSVEP_test_df = pd.DataFrame(test_features)
-            self.SSVEP_test_df['target'] = test_targets
-            # self.SSVEP_test_df['target'] = self.SSVEP_test_df['target'].astype('category')
-            self.SSVEP_test_df['group'] = test_groups
-
-        experiments_per_group = self.SSVEP_train_df['group'].unique().shape[0] // num_groups
-        unique_groups = self.SSVEP_train_df['group'].unique()
-        np.random.shuffle(unique_groups)
-        group_idxs = []
-        for i in range(num_groups):
-            if i == num_groups - 1:  # if last group
-                experiments = unique_groups[i * experiments_per_group:]
-            else:
-                experiments = unique_groups[i * experiments_per_group:(i + 1) * experiments_per_group]
-
-            group_idxs.append(self.SSVEP_train_df.loc[self.SSVEP_train_df['group'].isin(experiments)].index)
-
-        for i, idxs in enumerate(group_idxs):
-            self.SSVEP_train_df.loc[idxs, 'group'] = i
-
-
-    def prepare_LMI_a_data_for_ml(self, f1=None, f2=None, train_fraction=0.8, num_groups=3):
-        # indices for trimming data; frequencies are in 0.5Hz increments from 0 to 500
-        freq_idxs = (10, 101)
-        np.random.seed(42)
-        self.LMI_a_test_df = None
-        if f1 is None or f2 is None:
-            if self.LMI_a_spectrograms_true is None:
-                self.create_LMI_a_spectrograms()
-            f1_spectrograms, f1_frequencies, f1_times, f1_groups = [], [], [], []
-            f2_spectrograms, f2_frequencies, f2_times, f2_groups = [], [], [], []
-            for i in range(len(self.LMI_a_spectrograms_false)):
-                f1_spectrograms.append(self.LMI_a_spectrograms_true[i].spectrograms[freq_idxs[0]:freq_idxs[1]])
-                f1_frequencies.append(self.LMI_a_spectrograms_true[i].frequencies[freq_idxs[0]:freq_idxs[1]])
-                f1_times.append(self.LMI_a_spectrograms_true[i].times)
-                f1_groups.append(len(self.LMI_a_spectrograms_true[i].times) * [i])
-                f2_spectrograms.append(self.LMI_a_spectrograms_false[i].spectrograms[freq_idxs[0]:freq_idxs[1]])
-                f2_frequencies.append(self.LMI_a_spectrograms_false[i].frequencies[freq_idxs[0]:freq_idxs[1]])
-                f2_times.append(self.LMI_a_spectrograms_false[i].times)
-                f2_groups.append(len(self.LMI_a_spectrograms_false[i].times) * [i])
-
-            f1 = spectrogramData(np.array(f1_spectrograms), np.array(f1_frequencies), np.array(f1_times))
-            f2 = spectrogramData(np.array(f2_spectrograms), np.array(f2_frequencies), np.array(f2_times))
-            f1 = spectrogramData(f1_spectrograms, f1_frequencies, f1_times)
-            f2 = spectrogramData(f2_spectrograms, f2_frequencies, f2_times)
-
-        num_train_samples = int(train_fraction * len(f1.spectrograms))
-        idxs = list(range(len(f1.spectrograms)))
-        train_idxs = np.random.choice(idxs, num_train_samples, replace=False)
-        train_f1s = np.concatenate([f1.spectrograms[i] for i in train_idxs], axis=1)
-        train_f2s = np.concatenate([f2.spectrograms[i] for i in train_idxs], axis=1)
-        train_f1_groups = np.concatenate([f1_groups[i] for i in train_idxs])
-        train_f2_groups = np.concatenate([f2_groups[i] for i in train_idxs])
-        if train_fraction < 1:
-            test_idxs = list(set(idxs).difference(set(train_idxs)))
-            test_f1s = np.concatenate([f1.spectrograms[i] for i in test_idxs], axis=1)
-            test_f2s = np.concatenate([f2.spectrograms[i] for i in test_idxs], axis=1)
-            test_f1_groups = np.concatenate([f1_groups[i] for i in test_idxs])
-            test_f2_groups = np.concatenate([f1_groups[i] for i in test_idxs])
-
-
-        train_features = np.concatenate((train_f1s, train_f2s), axis=-1)
-        train_features = train_features.T
-        train_targets = np.array([1] * train_f1s.shape[1] + [0] * train_f2s.shape[1])
-        train_groups = np.concatenate((train_f1_groups, train_f2_groups))
-        self.LMI_a_train_df = pd.DataFrame(train_features)
-        self.LMI_a_train_df['target'] = train_targets
-        self.LMI_a_train_df['group'] = train_groups
-        if train_fraction < 1:
-            test_features = np.concatenate((test_f1s, test_f2s), axis=-1)
-            test_targets = np.array([1] * test_f1s.shape[1] + [0] * test_f2s.shape[1])
-            test_groups = np.concatenate((test_f1_groups, test_f2_groups))
-            test_features = test_features.T
-            self.LMI_a_test_df = pd.DataFrame(test_features)
-            self.LMI_a_test_df['target'] = test_targets
-            self.LMI_a_test_df['group'] = test_groups
-
-
-        experiments_per_group = self.LMI_a_train_df['group'].unique().shape[0] // num_groups
-        unique_groups = self.LMI_a_train_df['group'].unique()
-        np.random.shuffle(unique_groups)
-        group_idxs = []
-        for i in range(num_groups):
-            if i == num_groups - 1:  # if last group
-                experiments = unique_groups[i * experiments_per_group:]
-            else:
-                experiments = unique_groups[i * experiments_per_group:(i + 1) * experiments_per_group]
-
-            group_idxs.append(self.LMI_a_train_df.loc[self.LMI_a_train_df['group'].isin(experiments)].index)
-
-        for i, idxs in enumerate(group_idxs):
-            self.LMI_a_train_df.loc[idxs, 'group'] = i
+    def prepare_data_for_ml(self, name, f1=None, f2=None, train_fraction=0.8, num_groups=3, freq_idxs=(10, 101)):
+        """
+        Builds the train/test dataset for a True vs False classification from spectrograms.
 
+        Each time bin of each trial's spectrogram is one sample, with the trimmed
+        frequencies as features. Trials are split into train and test sets, and
+        the training trials are split into num_groups folds for group k-fold
+        cross-validation, so time bins from one trial are never in two folds.
+        The dataset is stored in self.<name>_dataset; self.<name>_train_df and
+        self.<name>_test_df are built from it when first used.
 
-    def prepare_LMI_i_data_for_ml(self, f1=None, f2=None, train_fraction=0.8, num_groups=3):
-        # indices for trimming data; frequencies are in 0.5Hz increments from 0 to 500
-        freq_idxs = (10, 101)
+        Parameters
+        ----------
+        name : str
+            Dataset name, e.g. 'SSVEP', 'LMI_a' or 'LMI_i'.
+        f1, f2 : spectrogramData
+            True and False spectrograms; defaults to the <name>_spectrograms_true/false ones.
+        train_fraction : float
+            Fraction of trials in the training set.
+        num_groups : int
+            Number of cross-validation folds.
+        freq_idxs : tuple
+            Indices for trimming the frequencies; with the default spectrograms,
+            frequencies are in 0.5Hz increments from 0 to 500.
+
+        Returns
+        -------
+        mlDataset
+        """
         np.random.seed(42)
-        self.LMI_i_test_df = None
         if f1 is None or f2 is None:
-            if self.LMI_i_spectrograms_true is None:
-                self.create_LMI_i_spectrograms()
-            f1_spectrograms, f1_frequencies, f1_times, f1_groups = [], [], [], []
-            f2_spectrograms, f2_frequencies, f2_times, f2_groups = [], [], [], []
-            for i in range(len(self.LMI_i_spectrograms_false)):
-                f1_spectrograms.append(self.LMI_i_spectrograms_true[i].spectrograms[freq_idxs[0]:freq_idxs[1]])
-                f1_frequencies.append(self.LMI_i_spectrograms_true[i].frequencies[freq_idxs[0]:freq_idxs[1]])
-                f1_times.append(self.LMI_i_spectrograms_true[i].times)
-                f1_groups.append(len(self.LMI_i_spectrograms_true[i].times) * [i])
-                f2_spectrograms.append(self.LMI_i_spectrograms_false[i].spectrograms[freq_idxs[0]:freq_idxs[1]])
-                f2_frequencies.append(self.LMI_i_spectrograms_false[i].frequencies[freq_idxs[0]:freq_idxs[1]])
-                f2_times.append(self.LMI_i_spectrograms_false[i].times)
-                f2_groups.append(len(self.LMI_i_spectrograms_false[i].times) * [i])
-
-            f1 = spectrogramData(f1_spectrograms, f1_frequencies, f1_times)
-            f2 = spectrogramData(f2_spectrograms, f2_frequencies, f2_times)
-
-        num_train_samples = int(train_fraction * len(f1.spectrograms))
-        idxs = list(range(len(f1.spectrograms)))
-        train_idxs = np.random.choice(idxs, num_train_samples, replace=False)
-        train_f1s = np.concatenate([f1.spectrograms[i] for i in train_idxs], axis=1)
-        train_f2s = np.concatenate([f2.spectrograms[i] for i in train_idxs], axis=1)
-        train_f1_groups = np.concatenate([f1_groups[i] for i in train_idxs])
-        train_f2_groups = np.concatenate([f2_groups[i] for i in train_idxs])
-        if train_fraction < 1:
-            test_idxs = list(set(idxs).difference(set(train_idxs)))
-            test_f1s = np.concatenate([f1.spectrograms[i] for i in test_idxs], axis=1)
-            test_f2s = np.concatenate([f2.spectrograms[i] for i in test_idxs], axis=1)
-            test_f1_groups = np.concatenate([f1_groups[i] for i in test_idxs])
-            test_f2_groups = np.concatenate([f1_groups[i] for i in test_idxs])
-
-
-        train_features = np.concatenate((train_f1s, train_f2s), axis=-1)
-        train_features = train_features.T
-        train_targets = np.array([1] * train_f1s.shape[1] + [0] * train_f2s.shape[1])
-        train_groups = np.concatenate((train_f1_groups, train_f2_groups))
-        self.LMI_i_train_df = pd.DataFrame(train_features)
-        self.LMI_i_train_df['target'] = train_targets
-        self.LMI_i_train_df['group'] = train_groups
-        if train_fraction < 1:
-            test_features = np.concatenate((test_f1s, test_f2s), axis=-1)
-            test_targets = np.array([1] * test_f1s.shape[1] + [0] * test_f2s.shape[1])
-            test_groups = np.concatenate((test_f1_groups, test_f2_groups))
-            test_features = test_features.T
-            self.LMI_i_test_df = pd.DataFrame(test_features)
-            self.LMI_i_test_df['target'] = test_targets
-            self.LMI_i_test_df['group'] = test_groups
-
-        experiments_per_group = self.LMI_i_train_df['group'].unique().shape[0] // num_groups
-        unique_groups = self.LMI_i_train_df['group'].unique()
+            # computes them if needed
+            getattr(self, name + '_spectrograms_true')
+            getattr(self, name + '_spectrograms_false')
+            f1 = self.spectrogram_arrays[name + '_spectrograms_true']
+            f2 = self.spectrogram_arrays[name + '_spectrograms_false']
+
+        f1_spectrograms = np.asarray(f1.spectrograms)
+        f2_spectrograms = np.asarray(f2.spectrograms)
+        num_trials = min(f1_spectrograms.shape[0], f2_spectrograms.shape[0])
+        num_train_samples = int(train_fraction * num_trials)
+        train_idxs = np.random.choice(num_trials, num_train_samples, replace=False)
+        test_idxs = np.setdiff1d(np.arange(num_trials), train_idxs)
+
+        # each training trial gets its fold by shuffling the trials and splitting them into num_groups chunks
+        unique_groups = train_idxs.copy()
         np.random.shuffle(unique_groups)
-        group_idxs = []
-        for i in range(num_groups):
-            if i == num_groups - 1:  # if last group
-                experiments = unique_groups[i * experiments_per_group:]
-            else:
-                experiments = unique_groups[i * experiments_per_group:(i + 1) * experiments_per_group]
+        experiments_per_group = unique_groups.shape[0] // num_groups
+        trial_folds = np.empty(num_trials, dtype=int)
+        trial_folds[unique_groups] = split_folds(unique_groups.shape[0], experiments_per_group, num_groups)
 
-            group_idxs.append(self.LMI_i_train_df.loc[self.LMI_i_train_df['group'].isin(experiments)].index)
-
-        for i, idxs in enumerate(group_idxs):
-            self.LMI_i_train_df.loc[idxs, 'group'] = i
-
-
-    def fit_LMI_a_ML_and_report(self, num_groups=3, use_gpu=False):
-        groups = self.LMI_a_train_df.group
-        if self.LMI_a_test_df is None:
-            self.LMI_a_pycaret_setup = pyclf.setup(data=self.LMI_a_train_df.drop('group', axis=1),
-                                                    target='target',
-                                                    use_gpu=use_gpu,
-                                                    fold_strategy='groupkfold',
-                                                    fold_groups=groups,
-                                                    fold=num_groups,
-                                                    silent=True)
-        else:
-            self.LMI_a_pycaret_setup = pyclf.setup(data=self.LMI_a_train_df.drop('group', axis=1),
-                                                    test_data=self.LMI_a_test_df.drop('group', axis=1),
-                                                    target='target',
-                                                    use_gpu=use_gpu,
-                                                    fold_strategy='groupkfold',
-                                                    fold_groups=groups,
-                                                    fold=num_groups,
-                                                    silent=True)
-
-        models = pyclf.models()
-        fit_models = pyclf.compare_models(groups=groups, n_select=models.shape[0])
-        # now tune and select top model
-        tuned = [pyclf.tune_model(model, search_library='scikit-optimize', groups=groups) for model in fit_models]
-        self.best_LMI_a_clf = pyclf.compare_models(tuned, groups=groups)
-        self.LMI_a_score_grid = pyclf.pull()
-
-
-    def fit_LMI_i_ML_and_report(self, num_groups=3, use_gpu=False):
-        groups = self.LMI_i_train_df.group
-        if self.LMI_i_test_df is None:
-            self.LMI_i_pycaret_setup = pyclf.setup(data=self.LMI_i_train_df.drop('group', axis=1),
-                                                    target='target',
-                                                    use_gpu=use_gpu,
-                                                    fold_strategy='groupkfold',
-                                                    fold_groups=groups,
-                                                    fold=num_groups,
-                                                    silent=True)
-        else:
-            self.LMI_i_pycaret_setup = pyclf.setup(data=self.LMI_i_train_df.drop('group', axis=1),
-                                                    test_data=self.LMI_i_test_df.drop('group', axis=1),
-                                                    target='target',
-                                                    use_gpu=use_gpu,
-                                                    fold_strategy='groupkfold',
-                                                    fold_groups=groups,
-                                                    fold=num_groups,
-                                                    silent=True)
-
-        models = pyclf.models()
-        fit_models = pyclf.compare_models(groups=groups, n_select=models.shape[0])
-        # now tune and select top model
-        tuned = [pyclf.tune_model(model, search_library='scikit-optimize', groups=groups) for model in fit_models]
-        self.best_LMI_i_clf = pyclf.compare_models(tuned, groups=groups)
-        self.LMI_i_score_grid = pyclf.pull()
-
-
-    def fit_SSVEP_ML_and_report(self, num_groups=3, use_gpu=False):
-        groups = self.SSVEP_train_df.group
-        if self.SSVEP_test_df is None:
-            self.SSVEP_pycaret_setup = pyclf.setup(data=self.SSVEP_train_df.drop('group', axis=1),
-                                                    target='target',
-                                                    use_gpu=use_gpu,
-                                                    fold_strategy='groupkfold',
-                                                    fold_groups=groups,
-                                                    fold=num_groups,
-                                                    silent=True)
-        else:
-            self.SSVEP_pycaret_setup = pyclf.setup(data=self.SSVEP_train_df.drop('group', axis=1),
-                                                    test_data=self.SSVEP_test_df.drop('group', axis=1),
-                                                    target='target',
-                                                    use_gpu=use_gpu,
-                                                    fold_strategy='groupkfold',
-                                                    fold_groups=groups,
-                                                    fold=num_groups,
-                                                    silent=True)
-
-        models = pyclf.models()
-        fit_models = pyclf.compare_models(groups=groups, n_select=models.shape[0])
-        # now tune and select top model
-        tuned = [pyclf.tune_model(model, search_library='scikit-optimize', groups=groups) for model in fit_models]
-        self.best_SSVEP_clf = pyclf.compare_models(tuned, groups=groups)
-        self.SSVEP_score_grid = pyclf.pull()
-
-
-    def fit_motor_imagery_and_report(self, train_fraction=0.8, num_groups=3):
-        np.random.seed(42)
-        # True is 2, False 1
-        labels = self.MI_epochs.events[:, -1] == 2
-        # throw away last point so number of points is 5000
-        epochs_data = self.MI_epochs.get_data()[:, :, :-1]
-        # create extra expochs by splitting them into fifths
-        split_arrs = []
-        for i in range(epochs_data.shape[0]):
-            split_arrs.extend(np.split(epochs_data[i], 5, -1))
-
-        extra_epochs = np.stack(split_arrs)
-        extra_labels = []
-        for l in labels:
-            extra_labels.extend([int(l)] * 5)
-
-        extra_labels = np.array(extra_labels)
-
-        true_counter = 0
-        false_counter = 0
-        groups = []
-        for event in labels == 2:
-            if event is True:
-                groups.extend([true_counter] * 5)
-                true_counter += 1
-            else:
-                groups.extend([false_counter] * 5)
-                false_counter += 1
+        freq_slice = slice(*freq_idxs)
+        with self.profile_stage(f'prepare_{name}_data_for_ml') as record:
+            train_features, train_targets, train_groups = spectrogram_features(f1_spectrograms, f2_spectrograms, train_idxs, freq_slice)
+            dataset = mlDataset(train_features, train_targets, trial_folds[train_groups])
+            if train_fraction < 1:
+                dataset.test_features, dataset.test_targets, dataset.test_groups = spectrogram_features(f1_spectrograms,
+                                                                                                        f2_spectrograms,
+                                                                                                        test_idxs,
+                                                                                                        freq_slice)
 
-        groups = np.array(groups)
-        unique_groups = np.unique(groups)
-        np.random.shuffle(unique_groups)
-        train_groups = np.random.choice(unique_groups, size=int(train_fraction * unique_groups.shape[0]))
-        train_idxs = np.where(np.isin(groups, train_groups))
-        test_idxs = np.where(np.isin(groups, train_groups, invert=True))
+            record['n_samples'] = train_features.shape[0]
 
+        setattr(self, name + '_dataset', dataset)
+        return dataset
 
-        self.MI_csp = CSP()
-        csp_data_train = self.MI_csp.fit_transform(extra_epochs[train_idxs], extra_labels[train_idxs])
-        csp_data_test = self.MI_csp.transform(extra_epochs[test_idxs])
 
-        self.mi_csp_df_train = pd.DataFrame(csp_data_train)
-        self.mi_csp_df_train['target'] = extra_labels[train_idxs]
-        self.mi_csp_df_train['group'] = groups[train_idxs]
+    def prepare_SSVEP_data_for_ml(self, f1=None, f2=None, train_fraction=0.8, num_groups=3):
+        return self.prepare_data_for_ml('SSVEP', f1=f1, f2=f2, train_fraction=train_fraction, num_groups=num_groups)
 
-        self.mi_csp_df_test = pd.DataFrame(csp_data_test)
-        self.mi_csp_df_test['target'] = extra_labels[test_idxs]
-        self.mi_csp_df_test['group'] = groups[test_idxs]
 
-        experiments_per_group = train_groups.shape[0] // num_groups
-        unique_train_groups = self.mi_csp_df_train['group'].unique()
-        group_idxs = []
-        for i in range(num_groups):
-            if i == num_groups - 1:  # if last group
-                experiments = unique_train_groups[i * experiments_per_group:]
-            else:
-                experiments = unique_train_groups[i * experiments_per_group:(i + 1) * experiments_per_group]
+    def prepare_LMI_a_data_for_ml(self, f1=None, f2=None, train_fraction=0.8, num_groups=3):
+        return self.prepare_data_for_ml('LMI_a', f1=f1, f2=f2, train_fraction=train_fraction, num_groups=num_groups)
 
-            group_idxs.append(self.mi_csp_df_train.loc[self.mi_csp_df_train['group'].isin(experiments)].index)
 
-        for i, idxs in enumerate(group_idxs):
-            self.mi_csp_df_train.loc[idxs, 'group'] = i
+    def prepare_LMI_i_data_for_ml(self, f1=None, f2=None, train_fraction=0.8, num_groups=3):
+        return self.prepare_data_for_ml('LMI_i', f1=f1, f2=f2, train_fraction=train_fraction, num_groups=num_groups)
 
-        self.mi_csp_df_test['group'] = num_groups
 
-        groups = self.mi_csp_df_train.group
-        self.mi_setup = pyclf.setup(data=self.mi_csp_df_train.drop('group', axis=1),
-                                    test_data=self.mi_csp_df_test.drop('group', axis=1),
-                                    target='target',
-                                    use_gpu=True,
-                                    fold_strategy='groupkfold',
-                                    fold_groups=groups,
-                                    fold=num_groups,
-                                    silent=True)
-        models = pyclf.models()
-        fit_models = pyclf.compare_models(groups=groups, n_select=models.shape[0])
-        # now tune and select top model
-        tuned = [pyclf.tune_model(model, search_library='scikit-optimize', groups=groups) for model in fit_models]
-        self.best_mi_clf = pyclf.compare_models(tuned, groups=groups)
-        self.mi_score_grid = pyclf.pull()
+    def __getattr__(self, attribute):
+        # <name>_train_df and <name>_test_df are built from <name>_dataset when first used
+        for suffix in ['_train_df', '_test_df']:
+            if attribute.endswith(suffix):
+                dataset = self.__dict__.get(attribute[:-len(suffix)] + '_dataset')
+                if dataset is not None:
+                    return getattr(dataset, suffix[1:])
 
+        raise AttributeError(f"'eegData' object has no attribute '{attribute}'")
 
-    def fit_motor_actual_and_report(self, train_fraction=0.8, num_groups=3):
-        np.random.seed(42)
-        # True is 2, False 1
-        labels = self.MA_epochs.events[:, -1] == 2
-        # throw away last point so number of points is 5000
-        epochs_data = self.MA_epochs.get_data()[:, :, :-1]
-        # create extra expochs by splitting them into fifths
-        split_arrs = []
-        for i in range(epochs_data.shape[0]):
-            split_arrs.extend(np.split(epochs_data[i], 5, -1))
-
-        extra_epochs = np.stack(split_arrs)
-        extra_labels = []
-        for l in labels:
-            extra_labels.extend([int(l)] * 5)
-
-        extra_labels = np.array(extra_labels)
-
-        true_counter = 0
-        false_counter = 0
-        groups = []
-        for event in labels == 2:
-            if event is True:
-                groups.extend([true_counter] * 5)
-                true_counter += 1
-            else:
-                groups.extend([false_counter] * 5)
-                false_counter += 1
 
-        groups = np.array(groups)
-        unique_groups = np.unique(groups)
-        np.random.shuffle(unique_groups)
-        train_groups = np.random.choice(unique_groups, size=int(train_fraction * unique_groups.shape[0]))
-        train_idxs = np.where(np.isin(groups, train_groups))
-        test_idxs = np.where(np.isin(groups, train_groups, invert=True))
+    def _search_models(self, train_df, test_df=None, num_groups=3, use_gpu=False, search='full', tune=True,
+                        budget_seconds=None, screen_fraction=0.25, halving_factor=3, top_k=3, n_iter=10, n_jobs=-1):
+        """
+        Compares pycaret models on a training set and tunes the best ones.
 
-        self.MA_csp = CSP()
-        csp_data_train = self.MA_csp.fit_transform(extra_epochs[train_idxs], extra_labels[train_idxs])
-        csp_data_test = self.MA_csp.transform(extra_epochs[test_idxs])
+        With search='full', every model is compared and then tuned. With
+        search='budgeted', models are screened by successive halving: all of
+        them are compared on a subsample of screen_fraction of each fold, the
+        best 1/halving_factor of them on a subsample halving_factor times
+        bigger, and so on up to the full training set; then only the top_k are
+        tuned. If budget_seconds is given, the comparisons are limited to the
+        time left and tuning stops when the budget is spent.
 
-        self.ma_csp_df_train = pd.DataFrame(csp_data_train)
-        self.ma_csp_df_train['target'] = extra_labels[train_idxs]
-        self.ma_csp_df_train['group'] = groups[train_idxs]
+        Parameters
+        ----------
+        train_df : pd.DataFrame
+            Features, 'target' and 'group' (the cross-validation fold) columns.
+        test_df : pd.DataFrame
+            Hold-out data with the same columns, or None.
+        n_iter : int
+            Number of hyperparameter sets tried when tuning each model.
+        n_jobs : int
+            Number of cores pycaret uses to fit models and folds in parallel; -1 uses all of them.
+
+        Returns
+        -------
+        pycaret_setup : tuple
+            pycaret setup for the full training set.
+        best_clf
+            Best model.
+        score_grid : pd.DataFrame
+            Scores of the final comparison.
+        model_times : pd.DataFrame
+            Seconds spent comparing and tuning each model, and its score in each round.
+        """
+        start = time.time()
+
+        def time_left():
+            if budget_seconds is None:
+                return None
+
+            return max(budget_seconds - (time.time() - start), 0)
+
+        def setup(df):
+            return pyclf.setup(data=df.drop('group', axis=1),
+                                test_data=None if test_df is None else test_df.drop('group', axis=1),
+                                target='target',
+                                use_gpu=use_gpu,
+                                fold_strategy='groupkfold',
+                                fold_groups=df.group,
+                                fold=num_groups,
+                                n_jobs=n_jobs,
+                                silent=True)
+
+        def compare(df, include=None, n_select=1):
+            # pycaret treats a budget of 0 as no budget
+            budget_time = None if budget_seconds is None else max(time_left() / 60, 1e-3)
+            fit_models = pyclf.compare_models(include=include, groups=df.group, n_select=n_select, budget_time=budget_time)
+            grid = pyclf.pull()
+            for model_id, row in grid.iterrows():
+                # 'TT (Sec)' is the mean training time per fold
+                model_times.loc[model_id, 'model'] = row['Model']
+                model_times.loc[model_id, 'compare_seconds'] += row['TT (Sec)'] * num_groups
+                model_times.loc[model_id, f'accuracy_{fraction:g}'] = row['Accuracy']
+
+            return fit_models, grid
+
+        model_times = pd.DataFrame(columns=['model', 'compare_seconds', 'tune_seconds'])
+        model_times['compare_seconds'] = model_times['compare_seconds'].astype(float)
+        candidates = None
+        fraction = 1
+        if search == 'budgeted':
+            fraction = screen_fraction
+            while fraction < 1:
+                # subsample each fold so the folds stay separate
+                subsample = train_df.groupby('group', group_keys=False).sample(frac=fraction, random_state=42)
+                setup(subsample)
+                if candidates is None:
+                    candidates = list(pyclf.models().index)
+                    model_times = model_times.reindex(candidates, fill_value=0.)
+
+                _, grid = compare(subsample, include=candidates, n_select=len(candidates))
+                # grid is sorted best first
+                candidates = list(grid.index[:max(int(np.ceil(len(candidates) / halving_factor)), top_k)])
+                print(f'screened {grid.shape[0]} models on {fraction:.0%} of the data in {time.time() - start:.1f}s')
+                if len(candidates) <= top_k:
+                    break
+
+                fraction *= halving_factor
+
+            fraction = 1
+
+        pycaret_setup = setup(train_df)
+        if candidates is None:
+            candidates = list(pyclf.models().index)
+            model_times = model_times.reindex(candidates, fill_value=0.)
+
+        n_select = len(candidates) if search == 'full' else min(top_k, len(candidates))
+        fit_models, score_grid = compare(train_df, include=candidates, n_select=n_select)
+        if tune:
+            if not isinstance(fit_models, list):
+                fit_models = [fit_models]
+
+            tuned = []
+            for model_id, model in zip(score_grid.index, fit_models):
+                if budget_seconds is not None and time_left() == 0:
+                    print('model search budget spent, not tuning the remaining models')
+                    tuned.append(model)
+                    continue
+
+                tune_start = time.time()
+                tuned.append(pyclf.tune_model(model, search_library='scikit-optimize', n_iter=n_iter, groups=train_df.group))
+                model_times.loc[model_id, 'tune_seconds'] = time.time() - tune_start
+
+            best_clf = pyclf.compare_models(tuned, groups=train_df.group)
+            score_grid = pyclf.pull()
+        else:
+            best_clf = fit_models[0] if isinstance(fit_models, list) else fit_models
 
-        self.ma_csp_df_test = pd.DataFrame(csp_data_test)
-        self.ma_csp_df_test['target'] = extra_labels[test_idxs]
-        self.ma_csp_df_test['group'] = groups[test_idxs]
+        model_times['tune_seconds'] = model_times['tune_seconds'].fillna(0)
+        model_times['total_seconds'] = model_times['compare_seconds'] + model_times['tune_seconds']
+        model_times = model_times.sort_values('total_seconds', ascending=False)
+        print(f'model search took {time.time() - start:.1f}s')
+        print(model_times.to_string())
+        return pycaret_setup, best_clf, score_grid, model_times
 
-        experiments_per_group = train_groups.shape[0] // num_groups
-        unique_train_groups = self.ma_csp_df_train['group'].unique()
-        group_idxs = []
-        for i in range(num_groups):
-            if i == num_groups - 1:  # if last group
-                experiments = unique_train_groups[i * experiments_per_group:]
-            else:
-                experiments = unique_train_groups[i * experiments_per_group:(i + 1) * experiments_per_group]
 
-            group_idxs.append(self.ma_csp_df_train.loc[self.ma_csp_df_train['group'].isin(experiments)].index)
+    def fit_LMI_a_ML_and_report(self, num_groups=3, use_gpu=False, search='full', budget_seconds=None, top_k=3, n_jobs=-1):
+        """
+        Finds the best model for the LMI_a data from prepare_LMI_a_data_for_ml; see _search_models.
+        """
+        (self.LMI_a_pycaret_setup,
+            self.best_LMI_a_clf,
+            self.LMI_a_score_grid,
+            self.LMI_a_model_times) = self._search_models(self.LMI_a_train_df,
+                                                            self.LMI_a_test_df,
+                                                            num_groups=num_groups,
+                                                            use_gpu=use_gpu,
+                                                            search=search, budget_seconds=budget_seconds, top_k=top_k, n_jobs=n_jobs)
 
-        for i, idxs in enumerate(group_idxs):
-            self.ma_csp_df_train.loc[idxs, 'group'] = i
 
-        self.ma_csp_df_test['group'] = num_groups
+    def fit_LMI_i_ML_and_report(self, num_groups=3, use_gpu=False, search='full', budget_seconds=None, top_k=3, n_jobs=-1):
+        """
+        Finds the best model for the LMI_i data from prepare_LMI_i_data_for_ml; see _search_models.
+        """
+        (self.LMI_i_pycaret_setup,
+            self.best_LMI_i_clf,
+            self.LMI_i_score_grid,
+            self.LMI_i_model_times) = self._search_models(self.LMI_i_train_df,
+                                                            self.LMI_i_test_df,
+                                                            num_groups=num_groups,
+                                                            use_gpu=use_gpu,
+                                                            search=search, budget_seconds=budget_seconds, top_k=top_k, n_jobs=n_jobs)
 
-        groups = self.ma_csp_df_train.group
-        self.ma_setup = pyclf.setup(data=self.ma_csp_df_train.drop('group', axis=1),
-                                    test_data=self.ma_csp_df_test.drop('group', axis=1),
-                                    target='target',
-                                    use_gpu=True,
-                                    fold_strategy='groupkfold',
-                                    fold_groups=groups,
-                                    fold=num_groups,
-                                    silent=True)
-        models = pyclf.models()
-        fit_models = pyclf.compare_models(n_select=models.shape[0], groups=groups)
-        # now tune and select top model
-        tuned = [pyclf.tune_model(model, search_library='scikit-optimize', groups=groups) for model in fit_models]
-        self.best_ma_clf = pyclf.compare_models(tuned, groups=groups)
-        self.ma_score_grid = pyclf.pull()
 
+    def fit_SSVEP_ML_and_report(self, num_groups=3, use_gpu=False, search='full', budget_seconds=None, top_k=3, n_jobs=-1):
+        """
+        Finds the best model for the SSVEP data from prepare_SSVEP_data_for_ml; see _search_models.
+        """
+        (self.SSVEP_pycaret_setup,
+            self.best_SSVEP_clf,
+            self.SSVEP_score_grid,
+            self.SSVEP_model_times) = self._search_models(self.SSVEP_train_df,
+                                                            self.SSVEP_test_df,
+                                                            num_groups=num_groups,
+                                                            use_gpu=use_gpu,
+                                                            search=search, budget_seconds=budget_seconds, top_k=top_k, n_jobs=n_jobs)
+
+
+    def _fit_csp_and_report(self, name, train_fraction=0.8, num_groups=3, window_seconds=1., stride_seconds=None,
+                            tune=True, search='full', budget_seconds=None, top_k=3, n_jobs=-1):
+        """
+        Fits CSP to crops of the <name>_epochs and finds the best model for the CSP features.
 
-    def fit_laryngeal_actual_and_report(self, train_fraction=0.8, num_groups=3):
+        Each epoch is cropped into windows of window_seconds every stride_seconds
+        (no overlap by default; e.g. stride_seconds=0.5 with 1 second windows
+        gives 50% overlapping crops). The defaults split each 5 second epoch into
+        fifths. Trials are split into train and test sets and the training
+        trials into num_groups folds, so crops of one trial are never in two of them.
+        """
         np.random.seed(42)
+        epochs = getattr(self, name + '_epochs')
+        sfreq = epochs.info['sfreq']
+        window = int(round(window_seconds * sfreq))
+        stride = window if stride_seconds is None else int(round(stride_seconds * sfreq))
         # True is 2, False 1
-        labels = self.LA_epochs.events[:, -1] == 2
-        # throw away last point so number of points is 5000
-        epochs_data = self.LA_epochs.get_data()[:, :, :-1]
-        # create extra expochs by splitting them into fifths
-        split_arrs = []
-        for i in range(epochs_data.shape[0]):
-            split_arrs.extend(np.split(epochs_data[i], 5, -1))
-
-        extra_epochs = np.stack(split_arrs)
-        extra_labels = []
-        for l in labels:
-            extra_labels.extend([int(l)] * 5)
-
-        extra_labels = np.array(extra_labels)
-
-        true_counter = 0
-        false_counter = 0
-        groups = []
-        for event in labels == 2:
-            if event is True:
-                groups.extend([true_counter] * 5)
-                true_counter += 1
-            else:
-                groups.extend([false_counter] * 5)
-                false_counter += 1
+        labels = (epochs.events[:, -1] == 2).astype(int)
+        crops, _ = crop_windows(epochs.get_data(), window, stride)
+        num_trials, num_windows = crops.shape[:2]
 
-        groups = np.array(groups)
-        unique_groups = np.unique(groups)
+        unique_groups = np.arange(num_trials)
         np.random.shuffle(unique_groups)
-        train_groups = np.random.choice(unique_groups, size=int(train_fraction * unique_groups.shape[0]))
-        train_idxs = np.where(np.isin(groups, train_groups))
-        test_idxs = np.where(np.isin(groups, train_groups, invert=True))
-
-        self.LA_csp = CSP()
-        csp_data_train = self.LA_csp.fit_transform(extra_epochs[train_idxs], extra_labels[train_idxs])
-        csp_data_test = self.LA_csp.transform(extra_epochs[test_idxs])
-
-        self.la_csp_df_train = pd.DataFrame(csp_data_train)
-        self.la_csp_df_train['target'] = extra_labels[train_idxs]
-        self.la_csp_df_train['group'] = groups[train_idxs]
-
-        self.la_csp_df_test = pd.DataFrame(csp_data_test)
-        self.la_csp_df_test['target'] = extra_labels[test_idxs]
-        self.la_csp_df_test['group'] = groups[test_idxs]
+        train_groups = np.random.choice(unique_groups, size=int(train_fraction * num_trials))
+        # train_groups is drawn with replacement, as it always has been
+        train_trials = np.unique(train_groups)
+        test_trials = np.setdiff1d(np.arange(num_trials), train_trials)
+
+        csp = CSP()
+        # the crops are only copied here, for the trials that are used
+        csp_data_train = csp.fit_transform(crops[train_trials].reshape(-1, *crops.shape[2:]),
+                                            np.repeat(labels[train_trials], num_windows))
+        csp_data_test = csp.transform(crops[test_trials].reshape(-1, *crops.shape[2:]))
+        setattr(self, name + '_csp', csp)
 
         experiments_per_group = train_groups.shape[0] // num_groups
-        unique_train_groups = self.la_csp_df_train['group'].unique()
-        group_idxs = []
-        for i in range(num_groups):
-            if i == num_groups - 1:  # if last group
-                experiments = unique_train_groups[i * experiments_per_group:]
-            else:
-                experiments = unique_train_groups[i * experiments_per_group:(i + 1) * experiments_per_group]
-
-            group_idxs.append(self.la_csp_df_train.loc[self.la_csp_df_train['group'].isin(experiments)].index)
-
-        for i, idxs in enumerate(group_idxs):
-            self.la_csp_df_train.loc[idxs, 'group'] = i
-
-        self.la_csp_df_test['group'] = num_groups
-
-        groups = self.la_csp_df_train.group
-        self.la_setup = pyclf.setup(data=self.la_csp_df_train.drop('group', axis=1),
-                                    test_data=self.la_csp_df_test.drop('group', axis=1),
-                                    target='target',
-                                    use_gpu=True,
-                                    fold_strategy='groupkfold',
-                                    fold_groups=groups,
-                                    fold=num_groups,
-                                    silent=True)
-        models = pyclf.models()
-        self.best_la_clf = pyclf.compare_models(groups=groups)#, n_select=models.shape[0])
-        # now tune and select top model
-        # tuned = [pyclf.tune_model(model, search_library='scikit-optimize', groups=groups) for model in fit_models]
-        # self.best_la_clf = pyclf.compare_models(tuned, groups=groups)
-        self.la_score_grid = pyclf.pull()
-
+        trial_folds = np.empty(num_trials, dtype=int)
+        trial_folds[train_trials] = split_folds(train_trials.shape[0], experiments_per_group, num_groups)
+        trial_folds[test_trials] = num_groups
+
+        train_df = mlDataset.to_df(csp_data_train,
+                                    np.repeat(labels[train_trials], num_windows),
+                                    np.repeat(trial_folds[train_trials], num_windows))
+        test_df = mlDataset.to_df(csp_data_test,
+                                    np.repeat(labels[test_trials], num_windows),
+                                    np.repeat(trial_folds[test_trials], num_windows))
+        short = name.lower()
+        setattr(self, short + '_csp_df_train', train_df)
+        setattr(self, short + '_csp_df_test', test_df)
+
+        pycaret_setup, best_clf, score_grid, model_times = self._search_models(train_df,
+                                                                                test_df,
+                                                                                num_groups=num_groups,
+                                                                                use_gpu=True,
+                                                                                tune=tune,
+                                                                                search=search, budget_seconds=budget_seconds, top_k=top_k, n_jobs=n_jobs)
+        setattr(self, short + '_setup', pycaret_setup)
+        setattr(self, 'best_' + short + '_clf', best_clf)
+        setattr(self, short + '_score_grid', score_grid)
+        setattr(self, short + '_model_times', model_times)
+
+
+    def fit_motor_imagery_and_report(self, train_fraction=0.8, num_groups=3, window_seconds=1., stride_seconds=None,
+                            search='full', budget_seconds=None, top_k=3, n_jobs=-1):
+        self._fit_csp_and_report('MI',
+                                train_fraction=train_fraction,
+                                num_groups=num_groups,
+                                window_seconds=window_seconds,
+                                stride_seconds=stride_seconds,
+                                search=search, budget_seconds=budget_seconds, top_k=top_k, n_jobs=n_jobs)
+
+
+    def fit_motor_actual_and_report(self, train_fraction=0.8, num_groups=3, window_seconds=1., stride_seconds=None,
+                            search='full', budget_seconds=None, top_k=3, n_jobs=-1):
+        self._fit_csp_and_report('MA',
+                                train_fraction=train_fraction,
+                                num_groups=num_groups,
+                                window_seconds=window_seconds,
+                                stride_seconds=stride_seconds,
+                                search=search, budget_seconds=budget_seconds, top_k=top_k, n_jobs=n_jobs)
+
+
+    def fit_laryngeal_actual_and_report(self, train_fraction=0.8, num_groups=3, window_seconds=1., stride_seconds=None,
+                            search='full', budget_seconds=None, top_k=3, n_jobs=-1):
+        self._fit_csp_and_report('LA',
+                                train_fraction=train_fraction,
+                                num_groups=num_groups,
+                                window_seconds=window_seconds,
+                                stride_seconds=stride_seconds,
+                                tune=False,
+                                search=search, budget_seconds=budget_seconds, top_k=top_k, n_jobs=n_jobs)
+
+
+    def fit_laryngeal_imagery_and_report(self, train_fraction=0.8, num_groups=3, window_seconds=1., stride_seconds=None,
+                            search='full', budget_seconds=None, top_k=3, n_jobs=-1):
+        self._fit_csp_and_report('LI',
+                                train_fraction=train_fraction,
+                                num_groups=num_groups,
+                                window_seconds=window_seconds,
+                                stride_seconds=stride_seconds,
+                                search=search, budget_seconds=budget_seconds, top_k=top_k, n_jobs=n_jobs)
+
+
+def _load_clean_file(path, filename, flatten, standardize, robust=False, cache_dir=None, cache_size_mb=2000, profile=False):
+    """
+    Loads and cleans one file in a worker process for eegData.load_clean_all_data.
 
-    def fit_laryngeal_imagery_and_report(self, train_fraction=0.8, num_groups=3):
-        np.random.seed(42)
-        # True is 2, False 1
-        labels = self.LI_epochs.events[:, -1] == 2
-        # throw away last point so number of points is 5000
-        epochs_data = self.LI_epochs.get_data()[:, :, :-1]
-        # create extra expochs by splitting them into fifths
-        split_arrs = []
-        for i in range(epochs_data.shape[0]):
-            split_arrs.extend(np.split(epochs_data[i], 5, -1))
-
-        extra_epochs = np.stack(split_arrs)
-        extra_labels = []
-        for l in labels:
-            extra_labels.extend([int(l)] * 5)
-
-        extra_labels = np.array(extra_labels)
-
-        true_counter = 0
-        false_counter = 0
-        groups = []
-        for event in labels == 2:
-            if event is True:
-                groups.extend([true_counter] * 5)
-                true_counter += 1
-            else:
-                groups.extend([false_counter] * 5)
-                false_counter += 1
+    Returns the cleaned data, the time each step took, and the worker's
+    profiling records (empty unless profile is True).
+    """
+    eeg = eegData(path, cache_dir=cache_dir, cache_size_mb=cache_size_mb, profile=profile)
+    data, times = eeg.load_clean_file(filename, flatten=flatten, standardize=standardize, robust=robust)
+    records = eeg.profiler.records if profile else []
+    return data, times, records
 
-        groups = np.array(groups)
-        unique_groups = np.unique(groups)
-        np.random.shuffle(unique_groups)
-        train_groups = np.random.choice(unique_groups, size=int(train_fraction * unique_groups.shape[0]))
-        train_idxs = np.where(np.isin(groups, train_groups))
-        test_idxs = np.where(np.isin(groups, train_groups, invert=True))
 
-        self.LI_csp = CSP()
-        csp_data_train = self.LI_csp.fit_transform(extra_epochs[train_idxs], extra_labels[train_idxs])
-        csp_data_test = self.LI_csp.transform(extra_epochs[test_idxs])
+def raw_to_arrays(data):
+    """
+    Splits an MNE raw object into its data array and JSON-serializable metadata
+    (channels, sampling rate, first sample, bad channels and annotations), for
+    storing in the disk cache. raw_from_arrays reverses it.
+    """
+    meas_date = data.info['meas_date']
+    onsets = data.annotations.onset
+    # without an orig_time, MNE stores onsets shifted by first_time and shifts
+    # them again when they are set on a raw object, so store them unshifted
+    if data.annotations.orig_time is None:
+        onsets = onsets - data.first_time
+
+    meta = {'ch_names': data.ch_names,
+            'sfreq': data.info['sfreq'],
+            'first_samp': int(data.first_samp),
+            'meas_date': meas_date.isoformat() if meas_date is not None else None,
+            'bads': data.info['bads'],
+            'onsets': onsets.tolist(),
+            'durations': data.annotations.duration.tolist(),
+            'descriptions': data.annotations.description.tolist()}
+    return {'data': data._data}, meta
+
+
+def raw_from_arrays(arrays, meta):
+    """
+    Rebuilds an MNE raw object from raw_to_arrays output. The data array is
+    used as-is, so a memory-mapped array stays memory-mapped.
+    """
+    info = mne.create_info(ch_names=meta['ch_names'], sfreq=meta['sfreq'], ch_types='eeg')
+    data = mne.io.RawArray(arrays['data'], info, first_samp=meta['first_samp'], verbose=0)
+    if meta['meas_date'] is not None:
+        data.set_meas_date(datetime.datetime.fromisoformat(meta['meas_date']))
+
+    data.info['bads'] = meta['bads']
+    data.set_annotations(mne.Annotations(meta['onsets'],
+                                        meta['durations'],
+                                        meta['descriptions'],
+                                        orig_time=data.info['meas_date']))
+    data.set_montage(mne.channels.make_standard_montage('standard_1020'), on_missing='ignore')
+    return data
 
-        self.li_csp_df_train = pd.DataFrame(csp_data_train)
-        self.li_csp_df_train['target'] = extra_labels[train_idxs]
-        self.li_csp_df_train['group'] = groups[train_idxs]
 
-        self.li_csp_df_test = pd.DataFrame(csp_data_test)
-        self.li_csp_df_test['target'] = extra_labels[test_idxs]
-        self.li_csp_df_test['group'] = groups[test_idxs]
+def check_round_trip(data, rebuilt):
+    """
+    Raises a ValueError unless a raw object rebuilt with raw_from_arrays has
+    the same annotation onsets and events as the original.
+    """
+    if not np.allclose(data.annotations.onset, rebuilt.annotations.onset):
+        raise ValueError('annotation onsets changed when rebuilding the raw object')
 
-        experiments_per_group = train_groups.shape[0] // num_groups
-        unique_train_groups = self.li_csp_df_train['group'].unique()
-        group_idxs = []
-        for i in range(num_groups):
-            if i == num_groups - 1:  # if last group
-                experiments = unique_train_groups[i * experiments_per_group:]
-            else:
-                experiments = unique_train_groups[i * experiments_per_group:(i + 1) * experiments_per_group]
-
-            group_idxs.append(self.li_csp_df_train.loc[self.li_csp_df_train['group'].isin(experiments)].index)
-
-        for i, idxs in enumerate(group_idxs):
-            self.li_csp_df_train.loc[idxs, 'group'] = i
-
-        self.li_csp_df_test['group'] = num_groups
-        groups = self.li_csp_df_train.group
-        self.li_setup = pyclf.setup(data=self.li_csp_df_train.drop('group', axis=1),
-                                    test_data=self.li_csp_df_test.drop('group', axis=1),
-                                    target='target',
-                                    use_gpu=True,
-                                    fold_strategy='groupkfold',
-                                    fold_groups=groups,
-                                    fold=num_groups,
-                                    silent=True)
-        models = pyclf.models()
-        fit_models = pyclf.compare_models(groups=groups, n_select=models.shape[0])
-        # now tune and select top model
-        tuned = [pyclf.tune_model(model, search_library='scikit-optimize', groups=groups) for model in fit_models]
-        self.best_li_clf = pyclf.compare_models(tuned, groups=groups)
-        self.li_score_grid = pyclf.pull()
+    events, event_id = mne.events_from_annotations(data, verbose=0)
+    rebuilt_events, rebuilt_event_id = mne.events_from_annotations(rebuilt, verbose=0)
+    if event_id != rebuilt_event_id or not np.array_equal(events, rebuilt_events):
+        raise ValueError('events changed when rebuilding the raw object')
 
 
 def load_data(filename):
@@ -1313,7 +1945,7 @@ def setup_ssvep_spectrograms_for_ml(f1, f2, frequency_1=7, frequency_2=12, train
     return features, targets, max_train_indx
 
 
-def CSP_LDA(type, filename):
+def CSP_LDA(type, filename, model_filename=None):
     """Does machine learning on data using common spatial patterns and Linear Discriminant Analysis.
     Parameters
     ----------
@@ -1323,7 +1955,14 @@ def CSP_LDA(type, filename):
             LMI
     filename : str
         Name of file to load data from
+    model_filename : str
+        If given, the fitted pipeline is saved here with pickle so it can be
+        loaded by online_decoding.motorImageryDecoder.
 
+    Returns
+    -------
+    clf : obj
+        The fitted CSP+LDA sklearn Pipeline.
     """
     if filename is not None:
         raw = load_data(filename)
@@ -1385,3 +2024,9 @@ def CSP_LDA(type, filename):
     print(scores)
     print('train score:', clf.score(epochs_data_train, tr_labels))
     print('test score:', clf.score(epochs_data_test, te_labels))
+
+    if model_filename is not None:
+        with open(model_filename, 'wb') as f:
+            pickle.dump(clf, f)
+
+    return clf
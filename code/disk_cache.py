@@ -0,0 +1,146 @@
+"""Content-addressed on-disk cache for numpy arrays.
+
+Each entry is a directory named by the hash of its key, holding one .npy file
+per array and a meta.json file. Entries are evicted least recently used first
+once the cache grows past its size cap.
+"""
+import os
+import json
+import shutil
+import hashlib
+
+import numpy as np
+
+
+# file hashes, memoized by (path, size, modification time) so unchanged files are only read once
+_file_hashes = {}
+
+
+def file_hash(filename, block_size=2**20):
+    """Returns the sha1 hash of a file's contents."""
+    stat = os.stat(filename)
+    memo_key = (os.path.abspath(filename), stat.st_size, stat.st_mtime)
+    if memo_key not in _file_hashes:
+        sha = hashlib.sha1()
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                sha.update(block)
+
+        _file_hashes[memo_key] = sha.hexdigest()
+
+    return _file_hashes[memo_key]
+
+
+class diskCache:
+    """ Stores dictionaries of numpy arrays on disk under a hash of their key.
+
+    Attributes
+    ----------
+    cache_dir : str
+        Directory holding the cache entries.
+    max_size : int
+        Size cap in bytes; least recently used entries are deleted past it.
+    hits : int
+        Number of lookups that found an entry.
+    misses : int
+        Number of lookups that did not.
+    """
+    def __init__(self, cache_dir, max_size_mb=2000):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.max_size = int(max_size_mb * 2**20)
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, *parts):
+        """Hashes any JSON-serializable key parts into a cache key."""
+        text = json.dumps(parts, sort_keys=True, default=str)
+        return hashlib.sha1(text.encode()).hexdigest()
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def get(self, key, mmap_mode=None):
+        """Returns the arrays and metadata stored under key, or None if there aren't any.
+
+        Parameters
+        ----------
+        key : str
+            Cache key from key().
+        mmap_mode : str
+            Passed to np.load; e.g. 'r' to memory-map the arrays instead of reading them.
+
+        Returns
+        -------
+        arrays : dict of np.arrays
+        meta : dict
+        """
+        entry_dir = self._entry_dir(key)
+        meta_filename = os.path.join(entry_dir, 'meta.json')
+        if not os.path.exists(meta_filename):
+            self.misses += 1
+            return None
+
+        with open(meta_filename) as f:
+            meta = json.load(f)
+
+        arrays = {name: np.load(os.path.join(entry_dir, name + '.npy'), mmap_mode=mmap_mode)
+                    for name in meta['arrays']}
+        # mark as recently used for eviction
+        os.utime(entry_dir)
+        self.hits += 1
+        return arrays, meta['meta']
+
+    def put(self, key, arrays, meta=None):
+        """Stores a dictionary of arrays (and optional JSON-serializable metadata) under key."""
+        entry_dir = self._entry_dir(key)
+        # write to a temporary directory first so a crash never leaves a half-written entry
+        tmp_dir = entry_dir + '.tmp'
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+
+        os.makedirs(tmp_dir)
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_dir, name + '.npy'), array)
+
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+            json.dump({'arrays': list(arrays.keys()), 'meta': meta}, f, default=str)
+
+        if os.path.exists(entry_dir):
+            shutil.rmtree(entry_dir)
+
+        os.replace(tmp_dir, entry_dir)
+        self.evict()
+
+    def entries(self):
+        """Returns (last used time, size in bytes, directory) for every entry, oldest first."""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, name)
+            if name.endswith('.tmp') or not os.path.isdir(entry_dir):
+                continue
+
+            size = sum(os.path.getsize(os.path.join(entry_dir, f)) for f in os.listdir(entry_dir))
+            entries.append((os.path.getmtime(entry_dir), size, entry_dir))
+
+        return sorted(entries)
+
+    def size(self):
+        """Total size of the cache in bytes."""
+        return sum(e[1] for e in self.entries())
+
+    def evict(self):
+        """Deletes least recently used entries until the cache is under its size cap."""
+        entries = self.entries()
+        total = sum(e[1] for e in entries)
+        for _, size, entry_dir in entries:
+            if total <= self.max_size:
+                break
+
+            shutil.rmtree(entry_dir)
+            total -= size
+
+    def clear(self):
+        """Deletes every entry."""
+        for _, _, entry_dir in self.entries():
+            shutil.rmtree(entry_dir)
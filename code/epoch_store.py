@@ -0,0 +1,278 @@
+"""Partitioned on-disk store of extracted epochs.
+
+eegData.export_epochs writes every trial epoch (and optionally its
+spectrogram) into one directory per session, paradigm and truth label:
+
+    <store_dir>/session=<ID>/paradigm=<label>/truth=<True|False>/
+        epochs.npy          (epochs x channels x samples)
+        spectrograms.npy    (epochs x frequencies x times), if exported
+        frequencies.npy, times.npy
+        meta.json
+
+meta.json holds sfreq, tmin, channel names, montage positions, the session's
+bad channels, the cleaning parameters, and the onset, duration and flag of each
+epoch. load_epochs picks partitions by their directory names before opening
+any file, so e.g. every subject's LMI-i epochs are read without touching the
+other paradigms or decompressing any raw session.
+"""
+import os
+import re
+import json
+import shutil
+
+import numpy as np
+import pandas as pd
+import mne
+
+
+PARTITION_KEYS = ['session', 'paradigm', 'truth']
+STORE_INDEX_DTYPE = np.dtype([('session', 'U64'),
+                                ('label', 'U8'),
+                                ('truth', '?'),
+                                ('onset', 'f8'),
+                                ('duration', 'f8'),
+                                ('flag', 'U64')])
+SESSION_ID_REGEXP = re.compile(r'^BCIproject_trial-(.*)_raw\.fif(\.gz)?$')
+
+
+def session_id(filename):
+    """Returns the session ID in a filename like BCIproject_trial-<ID>_raw.fif.gz."""
+    name = os.path.basename(filename)
+    match = SESSION_ID_REGEXP.match(name)
+    if match is not None:
+        return match.group(1)
+
+    return name.split('.')[0]
+
+
+def partition_dir(store_dir, session, paradigm, truth):
+    return os.path.join(store_dir, f'session={session}', f'paradigm={paradigm}', f'truth={truth}')
+
+
+def write_session(store_dir, session, partitions):
+    """Writes all partitions of one session, replacing any earlier export of it.
+
+    Parameters
+    ----------
+    store_dir : str
+        Root directory of the store.
+    session : str
+        Session ID.
+    partitions : dict
+        (paradigm, truth) -> (arrays, meta), where arrays is a dict of np.arrays
+        saved as .npy files and meta is JSON-serializable.
+    """
+    session_dir = os.path.join(store_dir, f'session={session}')
+    # write to a temporary directory first so a crash never leaves a half-written session
+    tmp_dir = session_dir + '.tmp'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+
+    for (paradigm, truth), (arrays, meta) in partitions.items():
+        directory = os.path.join(tmp_dir, f'paradigm={paradigm}', f'truth={truth}')
+        os.makedirs(directory)
+        for name, array in arrays.items():
+            np.save(os.path.join(directory, name + '.npy'), array)
+
+        with open(os.path.join(directory, 'meta.json'), 'w') as f:
+            json.dump(dict(meta, arrays=list(arrays.keys())), f, default=str)
+
+    if os.path.exists(session_dir):
+        shutil.rmtree(session_dir)
+
+    os.replace(tmp_dir, session_dir)
+
+
+def _matches(value, wanted):
+    return wanted is None or value in wanted
+
+
+def _subdirs(directory, key):
+    """Values of the key=value subdirectories of a directory."""
+    prefix = key + '='
+    return sorted(name[len(prefix):] for name in os.listdir(directory)
+                    if name.startswith(prefix) and not name.endswith('.tmp'))
+
+
+def partitions(store_dir, sessions=None, paradigms=None, truths=None):
+    """Lists the partitions in a store, filtered by their directory names only.
+
+    Parameters
+    ----------
+    sessions, paradigms : list of str
+        Session IDs and paradigms (e.g. ['LMI-i']) to keep; None keeps all.
+    truths : list of bool
+        Truth labels to keep; None keeps both.
+
+    Returns
+    -------
+    list of tuples
+        (session, paradigm, truth, directory) of each partition.
+    """
+    if truths is not None:
+        truths = [str(bool(t)) for t in truths]
+
+    found = []
+    for session in _subdirs(store_dir, 'session'):
+        if not _matches(session, sessions):
+            continue
+
+        session_dir = os.path.join(store_dir, f'session={session}')
+        for paradigm in _subdirs(session_dir, 'paradigm'):
+            if not _matches(paradigm, paradigms):
+                continue
+
+            for truth in _subdirs(os.path.join(session_dir, f'paradigm={paradigm}'), 'truth'):
+                if _matches(truth, truths):
+                    found.append((session, paradigm, truth == 'True', partition_dir(store_dir, session, paradigm, truth)))
+
+    return found
+
+
+class epochStoreData:
+    """ Epochs loaded from a partitioned store by load_epochs.
+
+    Attributes
+    ----------
+    epochs : np.array
+        Epochs with shape (epochs, channels, samples), in partition order
+        (session, paradigm, truth) and time order within each partition.
+    index : np.array
+        Structured array (STORE_INDEX_DTYPE) with the session, label, truth,
+        onset (seconds from the start of the session), duration and flag of each epoch.
+    info : dict
+        sfreq, tmin, ch_names and montage positions, shared by all partitions.
+    bads : dict
+        Bad channels of each loaded session.
+    spectrograms : np.array
+        Spectrograms with shape (epochs, frequencies, times), or None if not loaded.
+    frequencies, times : np.array
+        Spectrogram axes, or None.
+    """
+    def __init__(self, epochs, index, info, bads, spectrograms=None, frequencies=None, times=None):
+        self.epochs = epochs
+        self.index = index
+        self.info = info
+        self.bads = bads
+        self.spectrograms = spectrograms
+        self.frequencies = frequencies
+        self.times = times
+
+    @property
+    def targets(self):
+        """1 for True trials and 0 for False trials."""
+        return self.index['truth'].astype(int)
+
+    @property
+    def groups(self):
+        """Number of each epoch's session, e.g. for leave-one-session-out cross-validation."""
+        return np.unique(self.index['session'], return_inverse=True)[1]
+
+    def to_mne(self):
+        """Returns the epochs as an MNE epochs object, with event id 2 for True trials and 1 for False trials.
+
+        Onsets are only unique within a session, so the event samples are
+        consecutive epoch lengths instead; each epoch's session, label, truth,
+        onset, duration and flag are in the epochs' metadata.
+        """
+        info = mne.create_info(ch_names=self.info['ch_names'], sfreq=self.info['sfreq'], ch_types='eeg')
+        positions = self.info.get('montage')
+        if positions is not None:
+            info.set_montage(mne.channels.make_dig_montage(ch_pos={k: np.array(v) for k, v in positions.items()},
+                                                            coord_frame='head'))
+
+        events = np.column_stack([np.arange(len(self.index)) * self.epochs.shape[-1],
+                                    np.zeros(len(self.index), dtype=int),
+                                    np.where(self.index['truth'], 2, 1)])
+        event_id = {'False': 1, 'True': 2}
+        event_id = {k: v for k, v in event_id.items() if v in events[:, -1]}
+        metadata = pd.DataFrame({name: self.index[name] for name in STORE_INDEX_DTYPE.names})
+        return mne.EpochsArray(self.epochs,
+                                info,
+                                events=events,
+                                tmin=self.info['tmin'],
+                                event_id=event_id,
+                                metadata=metadata,
+                                baseline=None,
+                                verbose=0)
+
+def load_epochs(store_dir, sessions=None, paradigms=None, truths=None, spectrograms=False, exclude_flagged=False, mmap_mode=None):
+    """Loads the epochs of the partitions matching the filters.
+
+    Only the matching partitions are read. For example, every session's
+    imagined laryngeal epochs are load_epochs(store_dir, paradigms=['LMI-i']).
+
+    Parameters
+    ----------
+    store_dir : str
+        Directory eegData.export_epochs wrote to.
+    sessions, paradigms, truths : list
+        Partition filters, see partitions.
+    spectrograms : bool
+        Also loads the spectrograms (they must have been exported).
+    exclude_flagged : bool
+        Drops epochs whose trial was flagged while recording, e.g. 'too long' or 'dropped frames'.
+    mmap_mode : str
+        Passed to np.load; 'r' memory-maps each partition, so only the epochs
+        kept are read when exclude_flagged drops some.
+
+    Returns
+    -------
+    epochStoreData
+    """
+    found = partitions(store_dir, sessions=sessions, paradigms=paradigms, truths=truths)
+    if len(found) == 0:
+        raise ValueError(f'no partitions in {store_dir} match sessions={sessions}, paradigms={paradigms}, truths={truths}')
+
+    info = None
+    bads = {}
+    epochs_list, index_list, spectrograms_list = [], [], []
+    frequencies, times = None, None
+    for session, paradigm, truth, directory in found:
+        with open(os.path.join(directory, 'meta.json')) as f:
+            meta = json.load(f)
+
+        partition_info = {k: meta[k] for k in ['sfreq', 'tmin', 'ch_names', 'montage']}
+        if info is None:
+            info = partition_info
+        elif any(info[k] != partition_info[k] for k in ['sfreq', 'tmin', 'ch_names']):
+            raise ValueError(f'{directory} has different channels, sample rate or tmin from the partitions before it')
+
+        bads[session] = meta['bads']
+        keep = np.ones(meta['n_epochs'], dtype=bool)
+        if exclude_flagged:
+            keep = np.array([flag == '' for flag in meta['flags']], dtype=bool)
+            if not keep.any():
+                continue
+
+        epochs = np.load(os.path.join(directory, 'epochs.npy'), mmap_mode=mmap_mode)
+        epochs_list.append(epochs if keep.all() else epochs[keep])
+        index = np.zeros(meta['n_epochs'], dtype=STORE_INDEX_DTYPE)
+        index['session'] = session
+        index['label'] = paradigm
+        index['truth'] = truth
+        index['onset'] = meta['onsets']
+        index['duration'] = meta['durations']
+        index['flag'] = meta['flags']
+        index_list.append(index[keep])
+        if spectrograms:
+            if 'spectrograms' not in meta['arrays']:
+                raise ValueError(f'{directory} has no spectrograms; export them with spectrograms=True')
+
+            partition_spectrograms = np.load(os.path.join(directory, 'spectrograms.npy'), mmap_mode=mmap_mode)
+            spectrograms_list.append(partition_spectrograms[keep])
+            frequencies = np.load(os.path.join(directory, 'frequencies.npy'))
+            times = np.load(os.path.join(directory, 'times.npy'))
+
+    if len(epochs_list) == 0:
+        raise ValueError('every matching epoch is flagged')
+
+    # one partition memory-mapped with nothing dropped stays memory-mapped
+    epochs = epochs_list[0] if len(epochs_list) == 1 else np.concatenate(epochs_list)
+    return epochStoreData(epochs,
+                            np.concatenate(index_list),
+                            info,
+                            bads,
+                            spectrograms=np.concatenate(spectrograms_list) if spectrograms else None,
+                            frequencies=frequencies,
+                            times=times)
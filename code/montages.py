@@ -0,0 +1,65 @@
+# sensor location dictionaries for the 16-channel Cyton+Daisy headset
+# keys are the board channel numbers (1-16), values are 10-20 locations
+SENSOR_LOCATIONS = {
+    'default': {1: 'Fp1',
+                2: 'Fp2',
+                3: 'C3',
+                4: 'C4',
+                5: 'T5',
+                6: 'T6',
+                7: 'O1',
+                8: 'O2',
+                9: 'F7',
+                10: 'F8',
+                11: 'F3',
+                12: 'F4',
+                13: 'T3',
+                14: 'T4',
+                15: 'P3',
+                16: 'P4'},
+    'LMI1': {1: 'FC1',
+             2: 'FC2',
+             3: 'C3',
+             4: 'C4',
+             5: 'FC5',
+             6: 'FC6',
+             7: 'O1',
+             8: 'O2',
+             9: 'F7',
+             10: 'F8',
+             11: 'F3',
+             12: 'F4',
+             13: 'T3',
+             14: 'T4',
+             15: 'PO3',
+             16: 'PO4'},
+    'LMI2': {1: 'Fp1',
+             2: 'Fp2',
+             3: 'CP1',
+             4: 'CP2',
+             5: 'FC1', #change to FC1
+             6: 'FC2', #change to FC2
+             7: 'O1',
+             8: 'O2',
+             9: 'F7',
+             10: 'F8',
+             11: 'Fz',
+             12: 'Cz',
+             13: 'T3',
+             14: 'T4',
+             15: 'P3',
+             16: 'P4'},
+}
+
+
+def get_ch_names(sensor_locations='LMI2'):
+    """Returns the list of 10-20 channel names in board channel order.
+
+    Parameters
+    ----------
+    sensor_locations : str
+        Determines the sensor location dictionary to use. One of
+        'default', 'LMI1', 'LMI2'
+    """
+    number_to_1020 = SENSOR_LOCATIONS[sensor_locations]
+    return [number_to_1020[n] for n in sorted(number_to_1020)]
@@ -0,0 +1,412 @@
+"""Online decoders that classify the live BrainFlow stream while recording.
+
+The decoders read the newest samples from the acquisition thread started by
+expData.startBCI, so they can run during the experiment without touching the
+board themselves.
+"""
+import time
+import pickle
+import threading
+
+import numpy as np
+from scipy import signal
+
+from montages import SENSOR_LOCATIONS
+
+
+def get_board_rows(channels, sensor_locations='LMI2'):
+    """Returns the board data rows holding a list of 10-20 channels.
+
+    The EEG channels are rows 1-16 of the board data, in the order of the
+    sensor location dictionary.
+    """
+    number_to_1020 = SENSOR_LOCATIONS[sensor_locations]
+    name_to_number = {v: k for k, v in number_to_1020.items()}
+    return [name_to_number[c] for c in channels]
+
+
+def timing_report(update_times, target=None):
+    """Summarizes per-update compute times (in seconds) as milliseconds.
+
+    Parameters
+    ----------
+    update_times : list of floats
+        Compute time of each update in seconds.
+    target : float
+        Latency target in seconds; if given, the fraction of updates over it is reported.
+    """
+    if len(update_times) == 0:
+        return {}
+
+    times_ms = np.array(update_times) * 1000
+    report = {'n_updates': times_ms.shape[0],
+              'mean_ms': times_ms.mean(),
+              'median_ms': np.median(times_ms),
+              'p95_ms': np.percentile(times_ms, 95),
+              'max_ms': times_ms.max()}
+    if target is not None:
+        report['fraction_over_target'] = np.mean(times_ms > target * 1000)
+
+    return report
+
+
+class ssvepDecoder(threading.Thread):
+    """ Classifies SSVEP frequencies on the live stream with canonical correlation analysis.
+
+    Every update takes a sliding window of the occipital channels and computes
+    its canonical correlation with a precomputed bank of sine/cosine references
+    for each stimulus frequency (and harmonics). The frequency with the largest
+    correlation is the decision: frequency_1 (10 Hz, on the right) means yes and
+    frequency_2 (15 Hz, on the left) means no, as in ssvepVideo.
+
+    Because the references are orthonormalized once up front, an update is a QR
+    decomposition of the (samples x channels) window and a few small matrix
+    products, rather than a full spectrogram.
+
+    Attributes
+    ----------
+    decisions : list of dicts
+        Every decision made, with its time, frequency, answer and correlations.
+    update_times : list of floats
+        Compute time of each update in seconds.
+    """
+    def __init__(self,
+                data,
+                frequency_1=10,
+                frequency_2=15,
+                channels=['O1', 'O2', 'P3', 'P4'],
+                window_seconds=2,
+                n_harmonics=2,
+                update_interval=0.2,
+                latency_target=0.25,
+                callback=None):
+        """
+        Parameters
+        ----------
+        data : obj
+            expData object which has started streaming with startBCI.
+        frequency_1 : int
+            The frequency of SSVEP displayed on the right as the YES response.
+        frequency_2 : int
+            The frequency of SSVEP displayed on the left as the NO response.
+        channels : list of str
+            Channels to use; defaults to the occipital channels in eegData.viz_channels.
+        window_seconds : float
+            Length of the sliding window used for each decision.
+        n_harmonics : int
+            Number of harmonics of each frequency in the reference bank.
+        update_interval : float
+            Seconds between decisions.
+        latency_target : float
+            Target for the time between an update being due and its decision, in seconds.
+        callback : function
+            Optional function called with each decision dictionary.
+        """
+        super().__init__(daemon=True)
+        self.acquisition = data.acquisition
+        self.sfreq = data.sfreq
+        self.frequencies = [frequency_1, frequency_2]
+        self.rows = get_board_rows(channels, data.sensor_locations)
+        self.window = int(window_seconds * self.sfreq)
+        self.update_interval = update_interval
+        self.latency_target = latency_target
+        self.callback = callback
+        self.decisions = []
+        self.update_times = []
+        self.stop_event = threading.Event()
+        # the newest data can be at most one acquisition poll old, so poll at
+        # least twice per update to stay within the latency target
+        self.acquisition.poll_interval = min(self.acquisition.poll_interval, update_interval / 2)
+
+        t = np.arange(self.window) / self.sfreq
+        # orthonormal basis for a constant and linear trend, removed from each window
+        self.trend_basis, _ = np.linalg.qr(np.column_stack([np.ones_like(t), t]))
+        # one orthonormal reference basis per frequency, stacked side by side
+        # so a single matrix product projects onto all of them
+        references = []
+        for f in self.frequencies:
+            harmonics = []
+            for h in range(1, n_harmonics + 1):
+                harmonics.extend([np.sin(2 * np.pi * h * f * t), np.cos(2 * np.pi * h * f * t)])
+
+            Y = np.column_stack(harmonics)
+            Y -= self.trend_basis @ (self.trend_basis.T @ Y)
+            Q, _ = np.linalg.qr(Y)
+            references.append(Q)
+
+        self.n_references = 2 * n_harmonics
+        self.reference_bank = np.concatenate(references, axis=1)
+
+    def correlations(self, window_data):
+        """Canonical correlations between a window and each frequency's references.
+
+        Parameters
+        ----------
+        window_data : np.array
+            Data with shape (channels, samples), where samples is the window length.
+        """
+        X = window_data.T
+        X = X - self.trend_basis @ (self.trend_basis.T @ X)
+        Q, _ = np.linalg.qr(X)
+        # (channels x all references); the largest singular value of each
+        # frequency's block is its canonical correlation with the data
+        projections = Q.T @ self.reference_bank
+        blocks = np.split(projections, len(self.frequencies), axis=1)
+        return np.array([np.linalg.svd(b, compute_uv=False)[0] for b in blocks])
+
+    def update(self):
+        """Makes one decision from the newest window of data.
+
+        Returns
+        -------
+        dict or None
+            The decision, or None if a full window has not been collected yet.
+        """
+        start = time.perf_counter()
+        window_data = self.acquisition.get_latest(self.window, rows=self.rows)
+        if window_data.shape[1] < self.window:
+            return None
+
+        correlations = self.correlations(window_data)
+        best = int(np.argmax(correlations))
+        compute_time = time.perf_counter() - start
+        self.update_times.append(compute_time)
+        decision = {'time': time.time(),
+                    'sample': self.acquisition.n_samples,
+                    'frequency': self.frequencies[best],
+                    'answer': best == 0,
+                    'correlations': correlations,
+                    'compute_time': compute_time}
+        self.decisions.append(decision)
+        if self.callback is not None:
+            self.callback(decision)
+
+        return decision
+
+    def run(self):
+        while not self.stop_event.wait(self.update_interval):
+            self.update()
+
+    def stop(self):
+        self.stop_event.set()
+        self.join()
+
+    def latest(self):
+        """Returns the most recent decision, or None if there isn't one yet."""
+        return self.decisions[-1] if len(self.decisions) > 0 else None
+
+    def timing_report(self):
+        """Summarizes per-update compute times against the latency target."""
+        return timing_report(self.update_times, self.latency_target)
+
+
+class motorImageryDecoder(threading.Thread):
+    """ Scores rolling windows of the live stream with a fitted CSP+LDA pipeline.
+
+    New samples are bandpass filtered causally as they arrive and the running
+    sum of outer products over the window is updated incrementally (new samples
+    added, samples leaving the window subtracted), so each update costs only the
+    new samples rather than recomputing the window covariance. The CSP features
+    are then the log average power of each spatial filter, diag(W C W^T), which
+    is what CSP.transform computes from an epoch, and the remaining pipeline
+    steps (e.g. LDA) classify them.
+
+    This lets TMI/LMI yes/no be decided during the miPrompt hold period; use
+    trial_decision with the start and stop times returned by miPrompt.
+
+    Attributes
+    ----------
+    decisions : list of dicts
+        Every decision made, with its time, prediction and probability of yes.
+    update_times : list of floats
+        Compute time of each update in seconds.
+    """
+    def __init__(self,
+                data,
+                pipeline,
+                window_seconds=1,
+                bandpass=(7., 30.),
+                channels=None,
+                update_interval=0.25,
+                recompute_every=100,
+                callback=None):
+        """
+        Parameters
+        ----------
+        data : obj
+            expData object which has started streaming with startBCI.
+        pipeline : obj or str
+            Fitted sklearn Pipeline with a CSP first step (as made by
+            data_postprocessing.CSP_LDA), or the filename of one saved with pickle.
+        window_seconds : float
+            Length of the rolling window; should match the epoch length the pipeline was trained on.
+        bandpass : tuple
+            Bandpass filter range used when training the pipeline.
+        channels : list of str
+            Channels the pipeline was trained on, in order; defaults to all 16 EEG channels.
+        update_interval : float
+            Seconds between decisions.
+        recompute_every : int
+            Number of updates between exact recomputations of the window sums,
+            which stops floating point error building up.
+        callback : function
+            Optional function called with each decision dictionary.
+        """
+        super().__init__(daemon=True)
+        if isinstance(pipeline, str):
+            with open(pipeline, 'rb') as f:
+                pipeline = pickle.load(f)
+
+        self.acquisition = data.acquisition
+        self.sfreq = data.sfreq
+        if channels is None:
+            self.rows = list(range(1, 17))
+        else:
+            self.rows = get_board_rows(channels, data.sensor_locations)
+
+        csp = pipeline.steps[0][1]
+        self.filters = csp.filters_[:csp.n_components]
+        self.log = True if csp.log is None else csp.log
+        if not self.log:
+            self.mean = csp.mean_
+            self.std = csp.std_
+
+        self.classifier = pipeline[1:]
+        self.window = int(window_seconds * self.sfreq)
+        self.update_interval = update_interval
+        self.recompute_every = recompute_every
+        self.callback = callback
+
+        n_channels = len(self.rows)
+        self.sos = signal.butter(4, bandpass, btype='bandpass', fs=self.sfreq, output='sos')
+        self.zi = np.zeros((self.sos.shape[0], n_channels, 2))
+        # ring buffer of filtered samples in the window and their running outer product sum
+        self.ring = np.zeros((n_channels, self.window))
+        self.ring_position = 0
+        self.n_filled = 0
+        self.outer_sum = np.zeros((n_channels, n_channels))
+        self.next_sample = self.acquisition.n_samples
+        self.n_updates = 0
+        self.n_samples_processed = 0
+        self.decisions = []
+        self.update_times = []
+        self.stop_event = threading.Event()
+
+    def _push(self, new_data):
+        """Adds filtered samples to the window, updating the outer product sum."""
+        n_new = new_data.shape[1]
+        if n_new >= self.window:
+            # the whole window is replaced, so recompute the sum from scratch
+            self.ring[:] = new_data[:, -self.window:]
+            self.ring_position = 0
+            self.n_filled = self.window
+            self.outer_sum = self.ring @ self.ring.T
+            return
+
+        idxs = (self.ring_position + np.arange(n_new)) % self.window
+        old = self.ring[:, idxs]
+        self.outer_sum += new_data @ new_data.T - old @ old.T
+        self.ring[:, idxs] = new_data
+        self.ring_position = (self.ring_position + n_new) % self.window
+        self.n_filled = min(self.n_filled + n_new, self.window)
+
+    def features(self):
+        """CSP features (log average power of each spatial filter) for the current window."""
+        covariance = self.outer_sum / self.window
+        power = np.einsum('ij,jk,ik->i', self.filters, covariance, self.filters)
+        if self.log:
+            return np.log(power)
+
+        return (power - self.mean) / self.std
+
+    def update(self):
+        """Processes the samples collected since the last update and makes a decision.
+
+        Returns
+        -------
+        dict or None
+            The decision, or None if a full window has not been collected yet.
+        """
+        start = time.perf_counter()
+        stop_sample = self.acquisition.n_samples
+        new_data = self.acquisition.get_samples(self.next_sample, stop_sample, rows=self.rows)
+        self.next_sample = stop_sample
+        if new_data.shape[1] > 0:
+            new_data, self.zi = signal.sosfilt(self.sos, new_data, axis=-1, zi=self.zi)
+            self._push(new_data)
+            self.n_samples_processed += new_data.shape[1]
+
+        if self.n_filled < self.window:
+            return None
+
+        self.n_updates += 1
+        if self.n_updates % self.recompute_every == 0:
+            self.outer_sum = self.ring @ self.ring.T
+
+        features = self.features()[np.newaxis, :]
+        prediction = self.classifier.predict(features)[0]
+        if hasattr(self.classifier, 'predict_proba'):
+            # True (yes) has the larger event id, so it is the last class
+            probability = self.classifier.predict_proba(features)[0, -1]
+        else:
+            probability = float(prediction == self.classifier.classes_[-1])
+
+        compute_time = time.perf_counter() - start
+        self.update_times.append(compute_time)
+        decision = {'time': time.time(),
+                    'sample': stop_sample,
+                    'prediction': prediction,
+                    'answer': bool(prediction == self.classifier.classes_[-1]),
+                    'probability': probability,
+                    'n_new_samples': new_data.shape[1],
+                    'compute_time': compute_time}
+        self.decisions.append(decision)
+        if self.callback is not None:
+            self.callback(decision)
+
+        return decision
+
+    def run(self):
+        while not self.stop_event.wait(self.update_interval):
+            self.update()
+
+    def stop(self):
+        self.stop_event.set()
+        self.join()
+
+    def trial_decision(self, start, stop, threshold=0.5):
+        """Decides yes/no for a trial from the updates made during its hold period.
+
+        Parameters
+        ----------
+        start : float
+            Start time of the hold period (time.time()), as returned by miPrompt.
+        stop : float
+            Stop time of the hold period.
+        threshold : float
+            Mean probability of yes above which the answer is yes.
+
+        Returns
+        -------
+        bool or None
+            The answer, or None if no updates were made during the hold period.
+        """
+        probabilities = [d['probability'] for d in self.decisions if start <= d['time'] <= stop]
+        if len(probabilities) == 0:
+            return None
+
+        return np.mean(probabilities) > threshold
+
+    def timing_report(self):
+        """Summarizes per-update compute times and whether they keep up with the stream.
+
+        real_time_factor is the number of samples processed per second of compute
+        divided by the sampling rate; it must stay well above 1 to keep up.
+        """
+        report = timing_report(self.update_times, self.update_interval)
+        total_time = np.sum(self.update_times)
+        if total_time > 0:
+            report['samples_per_second'] = self.n_samples_processed / total_time
+            report['real_time_factor'] = report['samples_per_second'] / self.sfreq
+
+        return report
@@ -0,0 +1,151 @@
+"""Stage-level profiling for the analysis pipeline.
+
+stageProfiler records the wall time, CPU time, peak memory (tracemalloc) and
+item counts of named stages, optionally per file, e.g.
+
+    profiler = stageProfiler()
+    with profiler.stage('clean_data', filename) as record:
+        data = clean_data(data)
+        record['n_samples'] = data.n_times
+
+    print(profiler.report())
+    profiler.to_json('profile.json')
+
+eegData(path, profile=True) uses one for all of its loading, cleaning,
+epoching and spectrogram stages. Memory is only traced while a stage is
+running, so nothing outside the stages pays for tracemalloc.
+"""
+import os
+import json
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+
+class stageProfiler:
+    """ Times stages and records their peak memory use.
+
+    Stages can be nested; each one's peak memory includes its nested stages.
+
+    Attributes
+    ----------
+    records : list of dicts
+        One record per stage run, with its name, file (if any), wall and CPU
+        seconds, peak memory in MB above the memory in use when it started
+        (None if memory isn't traced), item counts (keys starting with 'n_'),
+        the process it ran in and any error.
+    """
+    def __init__(self, trace_memory=True):
+        self.trace_memory = trace_memory
+        self.records = []
+        # running peak memory of the stages that are currently open, outermost first
+        self._open_peaks = []
+        # whether this profiler started tracemalloc, and so must stop it
+        self._started_tracing = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Stops tracing memory if this profiler started it."""
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    @contextmanager
+    def stage(self, name, filename=None):
+        """Profiles the body of a with block; the yielded dict can be given item counts.
+
+        Memory is only traced while stages are open: tracemalloc is started
+        (unless something else already started it) when the outermost stage
+        starts, and stopped when it ends, so code run between stages isn't slowed down.
+        """
+        record = {'stage': name, 'file': None if filename is None else os.path.basename(filename), 'pid': os.getpid()}
+        if self.trace_memory:
+            if not self._open_peaks and not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_tracing = True
+
+            if self._open_peaks:
+                # reset_peak below loses the enclosing stage's peak so far
+                self._open_peaks[-1] = max(self._open_peaks[-1], tracemalloc.get_traced_memory()[1])
+
+            tracemalloc.reset_peak()
+            start_memory = tracemalloc.get_traced_memory()[0]
+            self._open_peaks.append(start_memory)
+
+        start_cpu = time.process_time()
+        start = time.perf_counter()
+        try:
+            yield record
+        except Exception as e:
+            record['error'] = repr(e)
+            raise
+        finally:
+            record['wall_seconds'] = time.perf_counter() - start
+            record['cpu_seconds'] = time.process_time() - start_cpu
+            record['peak_mb'] = None
+            if self.trace_memory:
+                peak = max(self._open_peaks.pop(), tracemalloc.get_traced_memory()[1])
+                record['peak_mb'] = (peak - start_memory) / 2**20
+                if self._open_peaks:
+                    self._open_peaks[-1] = max(self._open_peaks[-1], peak)
+                else:
+                    self.close()
+
+            self.records.append(record)
+
+    def add_records(self, records):
+        """Adds records from another profiler, e.g. one in a worker process."""
+        self.records.extend(records)
+
+    def summary(self, by_file=False):
+        """Totals the records of each stage (or each stage and file) into one dict per stage.
+
+        Peak memory is the largest peak of any run of the stage.
+        """
+        summary = {}
+        for record in self.records:
+            key = (record['stage'], record['file']) if by_file else record['stage']
+            stage = summary.setdefault(key, {'wall_seconds': 0., 'cpu_seconds': 0., 'peak_mb': None, 'runs': 0})
+            stage['wall_seconds'] += record['wall_seconds']
+            stage['cpu_seconds'] += record['cpu_seconds']
+            stage['runs'] += 1
+            if record['peak_mb'] is not None:
+                stage['peak_mb'] = max(stage['peak_mb'] or 0, record['peak_mb'])
+
+            for name, value in record.items():
+                if name.startswith('n_'):
+                    stage[name] = stage.get(name, 0) + value
+
+            if 'error' in record:
+                stage['error'] = record['error']
+
+        return summary
+
+    def report(self, by_file=False):
+        """Returns the summary as a table, slowest stages first."""
+        summary = self.summary(by_file=by_file)
+        lines = [f"{'stage':40s} {'runs':>5s} {'wall (s)':>9s} {'cpu (s)':>9s} {'peak (MB)':>10s}  items"]
+        for key, stats in sorted(summary.items(), key=lambda item: -item[1]['wall_seconds']):
+            name = f'{key[0]} {key[1] or ""}' if by_file else key
+            peak = '' if stats['peak_mb'] is None else f"{stats['peak_mb']:.1f}"
+            items = ', '.join(f'{k[2:]} {v}' for k, v in stats.items() if k.startswith('n_'))
+            if 'error' in stats:
+                items += f"  error: {stats['error']}"
+
+            lines.append(f"{name:40s} {stats['runs']:5d} {stats['wall_seconds']:9.2f} {stats['cpu_seconds']:9.2f} {peak:>10s}  {items}")
+
+        return '\n'.join(lines)
+
+    def to_json(self, filename=None):
+        """Returns the records and summary as JSON, and writes them to filename if given."""
+        text = json.dumps({'records': self.records, 'summary': self.summary()}, indent=2)
+        if filename is not None:
+            with open(filename, 'w') as f:
+                f.write(text)
+
+        return text
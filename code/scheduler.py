@@ -0,0 +1,257 @@
+"""Cooperative asyncio scheduler for running the experiment.
+
+The experiment protocol in data_collection.py is written once, as coroutines
+(experimentAsync, trialsAsync, trialByTypeAsync, ...) that await their holds,
+pauses and key presses on a clock. data_collection.run_experiment runs them
+on a blockingClock, which just sleeps, with board draining in separate
+threads. experimentScheduler is a clock that runs everything as tasks on one
+event loop instead:
+    - the protocol awaits its holds and key presses against explicit
+      deadlines, and yields to the loop between frames
+    - board draining, live decoders or quality checks are periodic tasks
+      (experimentScheduler.every), run in a thread pool when they block
+    - session log writes (trials, markers, answers, flip times) are queued and written by
+      a writer task, so the frame loop never waits on disk
+
+The lateness (how long after its deadline a task woke up) and runtime of
+every task are recorded, e.g.
+
+    scheduler = experimentScheduler()
+    scheduler.every('drain', 0.25, data.acquisition.drain)
+    scheduler.run(experimentAsync, window, data)
+    print(scheduler.report())
+
+or run the whole experiment with run_experiment_async().
+"""
+import time
+import asyncio
+import threading
+import collections
+import concurrent.futures
+
+from psychopy import core
+
+from online_decoding import timing_report
+from data_collection import setupExperiment, experimentAsync, releaseStimuli
+
+
+class experimentScheduler:
+    """ Runs an experiment coroutine alongside periodic tasks and a log writer on one event loop.
+
+    Attributes
+    ----------
+    executor : obj
+        Thread pool blocking calls (board draining, disk writes) run in.
+    lateness : dict of deques
+        Seconds each task woke up after its deadline, for the latest runs, keyed by task name.
+    runtimes : dict of deques
+        Seconds each run of each task took, keyed by task name.
+    errors : dict
+        Number of failed runs of each periodic task.
+    """
+    def __init__(self, max_workers=2, history=10000):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self.history = history
+        self.periodic = []
+        self.lateness = {}
+        self.runtimes = {}
+        self.errors = collections.Counter()
+        self.loop = None
+        self.loop_thread = None
+        self.log_queue = None
+        self.deferred_stores = []
+
+    def every(self, name, interval, func, blocking=True):
+        """Runs func every interval seconds while the scheduler runs.
+
+        Parameters
+        ----------
+        name : str
+            Name the task's latency stats are kept under.
+        interval : float
+            Seconds between deadlines; deadlines missed by more than an interval are skipped.
+        func : callable
+            Called with no arguments.
+        blocking : bool
+            If True, func is run in the thread pool so it can't hold up the frame loop.
+        """
+        self.periodic.append((name, interval, func, blocking))
+
+    def record(self, name, lateness, runtime=None):
+        """Records how late a task woke up and how long it ran."""
+        if name not in self.lateness:
+            self.lateness[name] = collections.deque(maxlen=self.history)
+            self.runtimes[name] = collections.deque(maxlen=self.history)
+
+        self.lateness[name].append(lateness)
+        if runtime is not None:
+            self.runtimes[name].append(runtime)
+
+    async def sleep_until(self, deadline, name):
+        """Sleeps until a deadline (in time.time() seconds) and records the lateness under name."""
+        await asyncio.sleep(max(deadline - time.time(), 0))
+        lateness = time.time() - deadline
+        self.record(name, lateness)
+        return lateness
+
+    async def sleep(self, seconds, name):
+        """Sleeps for some seconds, with the deadline and lateness recorded like sleep_until."""
+        return await self.sleep_until(time.time() + seconds, name)
+
+    async def next_frame(self):
+        """Called by the protocol after each flip of an animation; lets other tasks run in the rest of the frame."""
+        await asyncio.sleep(0)
+
+    async def run_blocking(self, func, *args):
+        """Runs a blocking call in the thread pool and returns its result."""
+        return await self.loop.run_in_executor(self.executor, func, *args)
+
+    def defer(self, func, *args):
+        """Queues a blocking call (e.g. a disk write) for the writer task; returns right away.
+
+        Can be called from any thread, e.g. from a periodic task running in the thread pool.
+        """
+        item = (time.time(), func, args)
+        if threading.get_ident() == self.loop_thread:
+            self.log_queue.put_nowait(item)
+        else:
+            self.loop.call_soon_threadsafe(self.log_queue.put_nowait, item)
+
+    def defer_store_writes(self, store):
+        """Makes a sessionStore's log writes (trials, markers, answers) and flip time files go through the writer task while the scheduler runs."""
+        write = store.log
+        save_flip_times = store.add_flip_times
+        store.log = lambda record: self.defer(write, record)
+        store.add_flip_times = lambda trial, flip_times: self.defer(save_flip_times, trial, flip_times)
+        self.deferred_stores.append(store)
+
+    async def _run_periodic(self, name, interval, func, blocking):
+        deadline = time.time()
+        while True:
+            deadline += interval
+            await asyncio.sleep(max(deadline - time.time(), 0))
+            start = time.time()
+            try:
+                if blocking:
+                    await self.run_blocking(func)
+                else:
+                    func()
+            except Exception as e:
+                self.errors[name] += 1
+                print(f'{name} failed: {e!r}')
+
+            self.record(name, start - deadline, time.time() - start)
+            if time.time() > deadline + interval:
+                # don't run back to back to catch up on missed deadlines
+                deadline = time.time()
+
+    async def _write_log(self):
+        while True:
+            queued, func, args = await self.log_queue.get()
+            start = time.time()
+            try:
+                await self.run_blocking(func, *args)
+            except Exception as e:
+                self.errors['log_writer'] += 1
+                print(f'log write failed: {e!r}')
+            finally:
+                self.record('log_writer', start - queued, time.time() - start)
+                self.log_queue.task_done()
+
+    async def _main(self, main, *args, **kwargs):
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self.log_queue = asyncio.Queue()
+        periodic = [asyncio.ensure_future(self._run_periodic(*task)) for task in self.periodic]
+        writer = asyncio.ensure_future(self._write_log())
+        try:
+            return await main(self, *args, **kwargs)
+        finally:
+            for task in periodic:
+                task.cancel()
+
+            await asyncio.gather(*periodic, return_exceptions=True)
+            # let writes queued from the thread pool arrive, then write everything before stopping
+            await asyncio.sleep(0)
+            await self.log_queue.join()
+            writer.cancel()
+            await asyncio.gather(writer, return_exceptions=True)
+            # later writes go straight to disk again
+            for store in self.deferred_stores:
+                del store.log
+                del store.add_flip_times
+
+    def run(self, main, *args, **kwargs):
+        """Runs main(scheduler, *args, **kwargs) with the periodic tasks and log writer, and returns its result."""
+        try:
+            return asyncio.run(self._main(main, *args, **kwargs))
+        finally:
+            self.executor.shutdown(wait=True)
+
+    def latency_stats(self):
+        """Returns timing_report summaries of each task's lateness and runtime, in milliseconds."""
+        stats = {}
+        for name in self.lateness:
+            stats[name] = {'lateness': timing_report(list(self.lateness[name])),
+                           'runtime': timing_report(list(self.runtimes[name])),
+                           'errors': self.errors[name]}
+
+        return stats
+
+    def report(self):
+        """Returns the latency stats as a table."""
+        lines = [f"{'task':16s} {'runs':>6s} {'late mean':>10s} {'late p95':>9s} {'late max':>9s} {'run mean':>9s} {'run max':>8s}  (ms)"]
+        for name, stats in self.latency_stats().items():
+            late, run = stats['lateness'], stats['runtime']
+            run_mean = f"{run['mean_ms']:9.2f}" if run else f"{'':9s}"
+            run_max = f"{run['max_ms']:8.2f}" if run else f"{'':8s}"
+            lines.append(f"{name:16s} {late['n_updates']:6d} {late['mean_ms']:10.2f} {late['p95_ms']:9.2f} {late['max_ms']:9.2f} {run_mean} {run_max}")
+
+        return '\n'.join(lines)
+
+
+def run_experiment_async(debug=True, SSVEP_one_win=False, ssvep_mode='procedural', nTrials=2, drain_interval=0.25):
+    """Runs the experiment like data_collection.run_experiment, on an experimentScheduler.
+
+    The same protocol (data_collection.experimentAsync) runs, but the board
+    is drained and the signal quality checked by periodic tasks instead of
+    threads, and the session log is written by the scheduler's writer task.
+
+    Parameters
+    ----------
+    debug : bool
+        If True, makes the window non-fullscreen.
+    SSVEP_one_win : bool
+        If True, only the SSVEP stimulus of the correct answer is shown.
+    ssvep_mode : str
+        'procedural' or 'video'; see data_collection.ssvepVideoAsync.
+    nTrials : int
+        Number of trials of each type.
+    drain_interval : float
+        Seconds between drains of the board's ring buffer.
+
+    Returns
+    -------
+    obj
+        The scheduler, for its latency stats.
+    """
+    data, window = setupExperiment(debug=debug, ssvep_mode=ssvep_mode, startAcquisition=False)
+    if data is None:
+        return None
+
+    scheduler = experimentScheduler()
+    scheduler.every('drain', drain_interval, data.acquisition.drain)
+    scheduler.every('quality', data.quality.update_interval, data.quality.update)
+    scheduler.defer_store_writes(data.store)
+    scheduler.run(experimentAsync, window, data, nTrials=nTrials, debug=debug, SSVEP_one_win=SSVEP_one_win, ssvep_mode=ssvep_mode)
+    print(scheduler.report())
+
+    window.close()
+    releaseStimuli(window)
+    data.stopBCI()
+    return scheduler
+
+
+if __name__ == '__main__':
+    run_experiment_async(debug=False)
+    core.quit()
@@ -0,0 +1,379 @@
+"""Append-only, chunked on-disk store for a recording session.
+
+A session is a directory containing:
+    meta.json     - number of rows, sampling rate, block size, dtype and channel names
+    samples.dat   - raw board samples, sample-major (samples x rows), appended one block at a time
+    index.jsonl   - one line per block written, with its offset, length and timestamps
+    trials.jsonl  - one line per trial/annotation, written as soon as the trial is added,
+                    plus the markers inserted into the data stream, the answers given
+                    and the signal quality of each channel
+    flips/        - trial-<n>.npy with the flip times of each trial, in seconds from its first flip
+
+Everything is flushed to disk as it is written, so a session that crashes part
+way through can still be loaded, and samples.dat can be memory-mapped for analysis.
+"""
+import os
+import re
+import json
+import threading
+
+import numpy as np
+
+from montages import get_ch_names
+
+# trial blocks after the alpha trials, in the order the experiment runs them
+BLOCK_ORDER = ['SSVEP', 'TMI-a', 'TMI-i', 'LMI-a', 'LMI-i']
+
+class sessionStore:
+    """ Writes a session to disk incrementally while it is being recorded.
+
+    Attributes
+    ----------
+    path : str
+        Directory the session is written to.
+    n_rows : int
+        Number of rows in the board data (all BrainFlow channels, not just EEG).
+    block_size : int
+        Number of samples per block written to samples.dat.
+    n_samples : int
+        Number of samples written to disk so far.
+    """
+    def __init__(self, path, n_rows, sfreq, block_size=None, timestamp_row=-1, marker_row=None, sensor_locations='LMI2', board_id=None):
+        os.makedirs(path)
+        self.path = path
+        self.n_rows = n_rows
+        self.sfreq = sfreq
+        # one second of samples per block by default
+        self.block_size = block_size if block_size is not None else int(sfreq)
+        self.timestamp_row = timestamp_row
+        self.dtype = np.dtype('float64')
+        self.pending = np.empty((self.block_size, n_rows), dtype=self.dtype)
+        self.pending_fill = 0
+        self.n_samples = 0
+        self.n_blocks = 0
+        self.n_trials = 0
+
+        meta = {'n_rows': n_rows,
+                'sfreq': sfreq,
+                'block_size': self.block_size,
+                'dtype': self.dtype.str,
+                'timestamp_row': timestamp_row,
+                'marker_row': marker_row,
+                'board_id': board_id,
+                'sensor_locations': sensor_locations,
+                'ch_names': get_ch_names(sensor_locations)}
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+        self.samples_file = open(os.path.join(path, 'samples.dat'), 'ab')
+        self.index_file = open(os.path.join(path, 'index.jsonl'), 'a')
+        self.trials_file = open(os.path.join(path, 'trials.jsonl'), 'a')
+        # records come from the experiment and from monitor threads
+        self.log_lock = threading.Lock()
+
+    def append(self, data):
+        """Appends new board samples, writing every block as soon as it is full.
+
+        Parameters
+        ----------
+        data : np.array
+            Board data with shape (rows, samples), as returned by BrainFlow.
+        """
+        start = 0
+        n_new = data.shape[1]
+        while start < n_new:
+            n_copy = min(self.block_size - self.pending_fill, n_new - start)
+            self.pending[self.pending_fill:self.pending_fill + n_copy] = data[:, start:start + n_copy].T
+            self.pending_fill += n_copy
+            start += n_copy
+            if self.pending_fill == self.block_size:
+                self._write_block()
+
+    def _write_block(self):
+        """Writes the pending samples as one block and records it in the index."""
+        if self.pending_fill == 0:
+            return
+
+        block = self.pending[:self.pending_fill]
+        offset = self.samples_file.tell()
+        self.samples_file.write(block.tobytes())
+        self.samples_file.flush()
+        os.fsync(self.samples_file.fileno())
+
+        entry = {'block': self.n_blocks,
+                 'offset': offset,
+                 'first_sample': self.n_samples,
+                 'n_samples': self.pending_fill,
+                 'first_timestamp': float(block[0, self.timestamp_row]),
+                 'last_timestamp': float(block[-1, self.timestamp_row])}
+        self.index_file.write(json.dumps(entry) + '\n')
+        self.index_file.flush()
+
+        self.n_samples += self.pending_fill
+        self.n_blocks += 1
+        self.pending_fill = 0
+
+    def log(self, record):
+        """Appends one record to the trial/annotation log and flushes it."""
+        line = json.dumps(record) + '\n'
+        with self.log_lock:
+            self.trials_file.write(line)
+            self.trials_file.flush()
+
+    def add_trial(self, onset, duration, description, label, flag=""):
+        """Logs a trial as soon as it is added to the experiment data."""
+        self.log({'event': 'trial',
+                  'trial': self.n_trials,
+                  'onset': onset,
+                  'duration': duration,
+                  'description': description,
+                  'label': label,
+                  'flag': flag})
+        self.n_trials += 1
+
+    def update_trial(self, trial, **fields):
+        """Logs a change to an already written trial (e.g. its flag)."""
+        record = {'event': 'update', 'trial': trial}
+        record.update(fields)
+        self.log(record)
+
+    def add_marker(self, code, host_time):
+        """Logs a marker inserted into the board's data stream, with the host time it was inserted at."""
+        self.log({'event': 'marker', 'code': code, 'time': host_time})
+
+    def add_flip_times(self, trial, flip_times):
+        """Saves the flip times of a trial to flips/trial-<n>.npy."""
+        flips_dir = os.path.join(self.path, 'flips')
+        os.makedirs(flips_dir, exist_ok=True)
+        np.save(os.path.join(flips_dir, f'trial-{trial}.npy'), flip_times)
+
+    def close(self):
+        """Writes the last (partial) block and closes all files."""
+        self._write_block()
+        for f in [self.samples_file, self.index_file, self.trials_file]:
+            f.close()
+
+
+def read_jsonl(filename):
+    """Reads a JSON lines file, skipping a truncated last line from a crash."""
+    records = []
+    if not os.path.exists(filename):
+        return records
+
+    with open(filename) as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                break
+
+    return records
+
+
+def load_session(path, mmap=True):
+    """Loads a session written by sessionStore, including partial sessions.
+
+    Parameters
+    ----------
+    path : str
+        Session directory.
+    mmap : bool
+        If True, the samples are memory-mapped instead of read into memory.
+
+    Returns
+    -------
+    samples : np.array
+        Board data with shape (rows, samples), the same layout as BrainFlow's get_board_data().
+    meta : dict
+        Session metadata from meta.json.
+    trials : list of dicts
+        Trials from trials.jsonl with any later updates (e.g. flags) applied.
+    """
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+
+    dtype = np.dtype(meta['dtype'])
+    filename = os.path.join(path, 'samples.dat')
+    row_bytes = meta['n_rows'] * dtype.itemsize
+    # only use whole samples, in case the last write was cut off by a crash
+    n_samples = os.path.getsize(filename) // row_bytes
+    if n_samples == 0:
+        samples = np.empty((0, meta['n_rows']), dtype=dtype)
+    elif mmap:
+        samples = np.memmap(filename, dtype=dtype, mode='r', shape=(n_samples, meta['n_rows']))
+    else:
+        samples = np.fromfile(filename, dtype=dtype, count=n_samples * meta['n_rows'])
+        samples = samples.reshape(n_samples, meta['n_rows'])
+
+    trials = []
+    for record in read_jsonl(os.path.join(path, 'trials.jsonl')):
+        if record['event'] == 'trial':
+            trials.append(record)
+        elif record['event'] == 'update':
+            fields = {k: v for k, v in record.items() if k not in ['event', 'trial']}
+            trials[record['trial']].update(fields)
+
+    return samples.T, meta, trials
+
+
+def load_markers(path):
+    """Loads the markers (dicts with their code and host time) logged by a session."""
+    return [r for r in read_jsonl(os.path.join(path, 'trials.jsonl')) if r['event'] == 'marker']
+
+
+def load_flip_times(path):
+    """Loads the flip times saved for each trial of a session, as a dict keyed by trial number."""
+    flips_dir = os.path.join(path, 'flips')
+    if not os.path.isdir(flips_dir):
+        return {}
+
+    flip_times = {}
+    for name in os.listdir(flips_dir):
+        match = re.match(r'^trial-(\d+)\.npy$', name)
+        if match is not None:
+            flip_times[int(match.group(1))] = np.load(os.path.join(flips_dir, name))
+
+    return flip_times
+
+
+def load_bads(path, bad_fraction=0.2):
+    """Loads the bad channels found by the session's signal quality monitor.
+
+    These are the ones stopBCI saved; for a session that crashed before that,
+    the channels bad in more than bad_fraction of the monitor's updates so far.
+    """
+    bads = None
+    fractions = None
+    for record in read_jsonl(os.path.join(path, 'trials.jsonl')):
+        if record['event'] == 'bads':
+            bads = record['bads']
+        elif record['event'] == 'quality':
+            fractions = record['bad_fraction']
+
+    if bads is not None or fractions is None:
+        return bads or []
+
+    with open(os.path.join(path, 'meta.json')) as f:
+        ch_names = json.load(f)['ch_names']
+
+    return [c for c, f in zip(ch_names, fractions) if f > bad_fraction]
+
+
+def align_trials(timestamps, marker_channel, sfreq, markers, onsets, durations, tolerance=0.5):
+    """Places trial starts and stops at the samples of the markers inserted at them.
+
+    Each trial start and stop (host times) is matched to the marker inserted
+    closest to it in host time, and placed at the sample that marker landed on
+    in the data. Starts and stops with no marker within tolerance (e.g. the
+    board dropped the packet) fall back to their host time.
+
+    Parameters
+    ----------
+    timestamps : np.array
+        Host timestamps of the samples (BrainFlow's timestamp channel).
+    marker_channel : np.array
+        BrainFlow's marker channel; 0 except on samples with a marker.
+    sfreq : float
+        Sample rate in Hz.
+    markers : list of dicts
+        Markers inserted while recording, with their 'code' and host 'time'.
+    onsets, durations : lists of floats
+        Trial onsets (host time in seconds since the epoch) and durations.
+    tolerance : float
+        Seconds a marker's host time may be from a trial start or stop to be matched to it.
+
+    Returns
+    -------
+    onsets : np.array
+        Trial onsets in seconds from the first sample.
+    durations : np.array
+        Trial durations in seconds.
+    report : dict
+        Number of starts and stops matched to markers and that fell back to
+        host time, and statistics (in seconds) of the offsets between the
+        host times and the marker times of the matched ones.
+    """
+    host_starts = np.asarray(onsets, dtype=float)
+    host_stops = host_starts + np.asarray(durations, dtype=float)
+    # a marker is on the first sample received after it was inserted
+    marker_samples = {}
+    for sample in np.flatnonzero(marker_channel):
+        marker_samples.setdefault(marker_channel[sample], sample)
+
+    found = sorted((m['time'], marker_samples[m['code']]) for m in markers if m['code'] in marker_samples)
+    marker_host_times = np.array([f[0] for f in found])
+    marker_times = np.array([f[1] / sfreq for f in found])
+
+    def align(host_times):
+        aligned = host_times - timestamps[0]
+        matched = np.zeros(len(host_times), dtype=bool)
+        if len(found) > 0:
+            # the closest marker in host time, before or after
+            after = np.clip(np.searchsorted(marker_host_times, host_times), 0, len(found) - 1)
+            before = np.clip(after - 1, 0, len(found) - 1)
+            closer_before = np.abs(host_times - marker_host_times[before]) < np.abs(host_times - marker_host_times[after])
+            nearest = np.where(closer_before, before, after)
+            matched = np.abs(host_times - marker_host_times[nearest]) <= tolerance
+            aligned[matched] = marker_times[nearest[matched]]
+
+        return aligned, matched
+
+    starts, starts_matched = align(host_starts)
+    stops, stops_matched = align(host_stops)
+    offsets = np.concatenate([(host_starts - timestamps[0] - starts)[starts_matched],
+                              (host_stops - timestamps[0] - stops)[stops_matched]])
+    report = {'n_matched': int(len(offsets)),
+              'n_host_time': int(2 * len(host_starts) - len(offsets))}
+    if len(offsets) > 0:
+        report.update({'mean_offset': float(offsets.mean()),
+                       'std_offset': float(offsets.std()),
+                       'median_offset': float(np.median(offsets)),
+                       'max_abs_offset': float(np.abs(offsets).max())})
+
+    return starts, stops - starts, report
+
+
+def session_to_raw(path, sensor_locations=None):
+    """Creates an MNE raw object with annotations from a stored session.
+
+    This is the same object expData.stopBCI saves as a .fif.gz file, and can be
+    used to recover a session that crashed before stopBCI was called.
+
+    Parameters
+    ----------
+    path : str
+        Session directory.
+    sensor_locations : str
+        Sensor location dictionary to use; defaults to the one in meta.json.
+    """
+    import mne
+
+    samples, meta, trials = load_session(path)
+    if sensor_locations is None:
+        sensor_locations = meta['sensor_locations']
+
+    info = mne.create_info(ch_names=get_ch_names(sensor_locations),
+                           sfreq=meta['sfreq'],
+                           ch_types=['eeg'] * 16)
+    raw = mne.io.RawArray(np.array(samples[1:17]), info)
+    raw.info['bads'] = load_bads(path)
+
+    timestamps = samples[meta['timestamp_row']]
+    onsets_list = [t['onset'] for t in trials]
+    durations_list = [t['duration'] for t in trials]
+    if meta.get('marker_row') is not None:
+        onsets_list, durations_list, _ = align_trials(timestamps,
+                                                      samples[meta['marker_row']],
+                                                      meta['sfreq'],
+                                                      load_markers(path),
+                                                      onsets_list,
+                                                      durations_list)
+    else:
+        onsets_list = [onset - timestamps[0] for onset in onsets_list]
+
+    desc_list = ['-'.join([str(t['description']), t['label'], t['flag']]) for t in trials]
+    raw.set_annotations(mne.Annotations(onsets_list, durations_list, desc_list))
+
+    montage = mne.channels.make_standard_montage('standard_1020')
+    raw.set_montage(montage)
+    return raw
@@ -0,0 +1,244 @@
+"""Live per-channel signal-quality monitoring while recording.
+
+signalQualityMonitor reads the newest samples from the acquisition thread
+started by expData.startBCI, like the decoders in online_decoding.py, and
+keeps rolling statistics of every EEG channel over a short window:
+    - RMS of the high-passed signal, which is high for noisy or loose electrodes
+    - line-noise ratio, the fraction of that power at 60 Hz
+    - flatline, an RMS so low the electrode is probably disconnected
+    - saturation, the fraction of raw samples at the ADC rails
+
+Only the samples that arrived since the last update are processed, so an
+update costs the same however long the session is. Results are logged to the
+session store, and the channels that were bad for much of the session become
+the raw object's info['bads'] when it is saved.
+"""
+import time
+import threading
+
+import numpy as np
+from scipy import signal
+
+from montages import get_ch_names
+from online_decoding import timing_report
+
+# Cyton input range in microvolts at the default gain of 24 (4.5 V / 24)
+ADC_RANGE = 187500.
+LINE_FREQUENCY = 60
+
+
+class signalQualityMonitor(threading.Thread):
+    """ Tracks rolling RMS, 60 Hz line noise, flatlines and saturation of every EEG channel.
+
+    New samples are high-pass filtered causally as they arrive. A ring buffer
+    holds the window's filtered samples, their 60 Hz phasors and saturation
+    flags, and running sums of each are updated by adding the new samples and
+    subtracting the ones leaving the window.
+
+    Attributes
+    ----------
+    ch_names : list of str
+        Names of the monitored channels, in board row order.
+    latest_status : dict
+        The most recent status (see update), or None before the first full window.
+    n_bad_updates : np.array
+        Number of updates each channel was bad in.
+    n_status_updates : int
+        Number of updates with a full window.
+    update_times : list of floats
+        Compute time of each update in seconds.
+    """
+    def __init__(self,
+                data,
+                window_seconds=2,
+                update_interval=0.25,
+                highpass=1.,
+                max_rms=100.,
+                max_line_ratio=0.5,
+                flat_rms=0.5,
+                max_saturation=0.01,
+                log_every=20,
+                recompute_every=100,
+                store=None):
+        """
+        Parameters
+        ----------
+        data : obj
+            expData object which has started streaming with startBCI.
+        window_seconds : float
+            Length of the rolling window the statistics are computed over.
+        update_interval : float
+            Seconds between updates.
+        highpass : float
+            Cutoff in Hz of the high-pass filter removing the electrode offsets before the RMS.
+        max_rms : float
+            RMS in microvolts above which a channel is noisy.
+        max_line_ratio : float
+            Fraction of a channel's power at 60 Hz above which it is noisy.
+        flat_rms : float
+            RMS in microvolts below which a channel is flat.
+        max_saturation : float
+            Fraction of samples at the ADC rails above which a channel is saturated.
+        log_every : int
+            Number of updates between statuses logged to the store; statuses
+            are also logged whenever the set of bad channels changes.
+        recompute_every : int
+            Number of updates between exact recomputations of the window sums,
+            which stops floating point error building up.
+        store : obj
+            sessionStore the statuses are logged to.
+        """
+        super().__init__(daemon=True)
+        self.acquisition = data.acquisition
+        self.sfreq = data.sfreq
+        self.rows = list(range(1, 17))
+        self.ch_names = get_ch_names(data.sensor_locations)
+        self.window = int(window_seconds * self.sfreq)
+        self.update_interval = update_interval
+        self.max_rms = max_rms
+        self.max_line_ratio = max_line_ratio
+        self.flat_rms = flat_rms
+        self.max_saturation = max_saturation
+        self.log_every = log_every
+        self.recompute_every = recompute_every
+        self.store = store
+
+        n_channels = len(self.rows)
+        self.sos = signal.butter(2, highpass, btype='highpass', fs=self.sfreq, output='sos')
+        self.zi = np.zeros((self.sos.shape[0], n_channels, 2))
+        # ring buffers of the window's filtered samples, their 60 Hz phasors and saturation flags
+        self.ring = np.zeros((n_channels, self.window))
+        self.ring_phasors = np.zeros((n_channels, self.window), dtype=complex)
+        self.ring_saturated = np.zeros((n_channels, self.window), dtype=bool)
+        self.ring_position = 0
+        self.n_filled = 0
+        self.square_sum = np.zeros(n_channels)
+        self.line_sum = np.zeros(n_channels, dtype=complex)
+        self.saturated_count = np.zeros(n_channels)
+        self.next_sample = self.acquisition.n_samples
+        self.n_updates = 0
+        self.n_status_updates = 0
+        self.n_bad_updates = np.zeros(n_channels, dtype=int)
+        self.latest_status = None
+        self.last_logged_bads = None
+        self.update_times = []
+        self.stop_event = threading.Event()
+
+    def _phasors(self, first_sample, n_samples):
+        """60 Hz phasors e^(-i w n) of samples numbered from the start of the session."""
+        n = np.arange(first_sample, first_sample + n_samples)
+        # phase from the integer sample number, so precision doesn't degrade on long sessions
+        phase = 2 * np.pi * ((LINE_FREQUENCY * n) % self.sfreq) / self.sfreq
+        return np.exp(-1j * phase)
+
+    def _push(self, filtered, phasors, saturated):
+        """Adds new samples to the window, updating the running sums."""
+        n_new = filtered.shape[1]
+        if n_new >= self.window:
+            self.ring[:] = filtered[:, -self.window:]
+            self.ring_phasors[:] = phasors[:, -self.window:]
+            self.ring_saturated[:] = saturated[:, -self.window:]
+            self.ring_position = 0
+            self.n_filled = self.window
+            self._recompute()
+            return
+
+        idxs = (self.ring_position + np.arange(n_new)) % self.window
+        self.square_sum += np.einsum('ij,ij->i', filtered, filtered) - np.einsum('ij,ij->i', self.ring[:, idxs], self.ring[:, idxs])
+        self.line_sum += phasors.sum(axis=1) - self.ring_phasors[:, idxs].sum(axis=1)
+        self.saturated_count += saturated.sum(axis=1) - self.ring_saturated[:, idxs].sum(axis=1)
+        self.ring[:, idxs] = filtered
+        self.ring_phasors[:, idxs] = phasors
+        self.ring_saturated[:, idxs] = saturated
+        self.ring_position = (self.ring_position + n_new) % self.window
+        self.n_filled = min(self.n_filled + n_new, self.window)
+
+    def _recompute(self):
+        self.square_sum = np.einsum('ij,ij->i', self.ring, self.ring)
+        self.line_sum = self.ring_phasors.sum(axis=1)
+        self.saturated_count = self.ring_saturated.sum(axis=1).astype(float)
+
+    def update(self):
+        """Processes the samples collected since the last update and updates the channel statuses.
+
+        Returns
+        -------
+        dict or None
+            The status, with the time, sample number, each channel's rms (in
+            microvolts), line_ratio, saturation fraction, flat/noisy/saturated
+            flags, and the names of the bad channels; None if a full window has
+            not been collected yet.
+        """
+        start = time.perf_counter()
+        stop_sample = self.acquisition.n_samples
+        raw = self.acquisition.get_samples(self.next_sample, stop_sample, rows=self.rows)
+        first_sample = self.next_sample
+        self.next_sample = stop_sample
+        if raw.shape[1] > 0:
+            filtered, self.zi = signal.sosfilt(self.sos, raw, axis=-1, zi=self.zi)
+            phasors = filtered * self._phasors(first_sample, raw.shape[1])
+            saturated = np.abs(raw) >= 0.99 * ADC_RANGE
+            self._push(filtered, phasors, saturated)
+
+        if self.n_filled < self.window:
+            return None
+
+        self.n_updates += 1
+        if self.n_updates % self.recompute_every == 0:
+            self._recompute()
+
+        mean_square = np.maximum(self.square_sum, 0) / self.window
+        rms = np.sqrt(mean_square)
+        # a sinusoid with DFT coefficient X over N samples has mean square 2|X|^2 / N^2
+        line_power = 2 * np.abs(self.line_sum) ** 2 / self.window ** 2
+        line_ratio = np.divide(line_power, mean_square, out=np.zeros_like(line_power), where=mean_square > 0)
+        saturation = self.saturated_count / self.window
+        flat = rms < self.flat_rms
+        noisy = (rms > self.max_rms) | (line_ratio > self.max_line_ratio)
+        saturated = saturation > self.max_saturation
+        bad = flat | noisy | saturated
+        self.n_status_updates += 1
+        self.n_bad_updates += bad
+
+        compute_time = time.perf_counter() - start
+        self.update_times.append(compute_time)
+        status = {'time': time.time(),
+                  'sample': stop_sample,
+                  'rms': rms.round(2).tolist(),
+                  'line_ratio': line_ratio.round(3).tolist(),
+                  'saturation': saturation.round(3).tolist(),
+                  'flat': flat.tolist(),
+                  'noisy': noisy.tolist(),
+                  'saturated': saturated.tolist(),
+                  'bads': [c for c, b in zip(self.ch_names, bad) if b],
+                  'compute_time': compute_time}
+        self.latest_status = status
+        if self.store is not None and (status['bads'] != self.last_logged_bads or self.n_status_updates % self.log_every == 0):
+            self.store.log(dict(event='quality', bad_fraction=self.bad_fractions().round(3).tolist(), **status))
+            self.last_logged_bads = status['bads']
+
+        return status
+
+    def run(self):
+        while not self.stop_event.wait(self.update_interval):
+            self.update()
+
+    def stop(self):
+        """Stops updating after processing the last samples collected."""
+        self.stop_event.set()
+        if self.is_alive():
+            self.join()
+
+        self.update()
+
+    def bad_fractions(self):
+        """Fraction of updates each channel was bad in."""
+        return self.n_bad_updates / max(self.n_status_updates, 1)
+
+    def bad_channels(self, bad_fraction=0.2):
+        """Names of the channels that were bad in more than bad_fraction of the updates."""
+        return [c for c, f in zip(self.ch_names, self.bad_fractions()) if f > bad_fraction]
+
+    def timing_report(self):
+        """Summarizes per-update compute times against the update interval."""
+        return timing_report(self.update_times, self.update_interval)
@@ -0,0 +1,202 @@
+"""Generates realistic synthetic recording sessions for testing at scale.
+
+Sessions are in the same format expData.stopBCI saves: a .fif.gz file with
+the 16 LMI2 channels, the standard 10-20 montage, samples in the units
+BrainFlow returns (microvolts), and trial annotations like 'True-SSVEP-'.
+
+The signal is pink (1/f) background noise plus:
+    - alpha (10 Hz) over the occipital/parietal channels, much stronger
+      during eyes-closed (True-alpha) trials
+    - SSVEP at 10 Hz (True) or 15 Hz (False) and their second harmonics over
+      the occipital/parietal channels during SSVEP trials
+    - mu (11 Hz) over the central channels, suppressed during True motor and
+      laryngeal trials
+    - 60 Hz line noise and its harmonic on every channel
+
+Trials follow the experiment's order (alpha, then SSVEP, TMI-a, TMI-i,
+LMI-a and LMI-i blocks with shuffled True/False trials), repeated until the
+session is full. The signal is generated a chunk at a time, so hours-long
+sessions only need memory for the output array.
+
+Example
+-------
+    python synthetic_data.py --minutes 60 --sfreq 1000 --output ../data/BCIproject_trial-synthetic_raw.fif.gz
+"""
+import argparse
+
+import numpy as np
+import scipy.signal as spsig
+import mne
+
+from montages import get_ch_names
+from session_store import BLOCK_ORDER
+
+OCCIPITAL_CHANNELS = ['O1', 'O2', 'P3', 'P4', 'PO3', 'PO4']
+CENTRAL_CHANNELS = ['C3', 'C4', 'Cz', 'CP1', 'CP2', 'FC1', 'FC2', 'FC5', 'FC6']
+# SSVEP stimulus frequencies for True (right, yes) and False (left, no) trials
+SSVEP_FREQUENCIES = {True: 10, False: 15}
+# IIR approximation of a 1/f (pink) spectrum
+PINK_B = [0.049922035, -0.095993537, 0.050612699, -0.004408786]
+PINK_A = [1, -2.494956002, 2.017265875, -0.522189400]
+
+
+def trial_schedule(seconds, n_trials=2, trial_seconds=5, start_seconds=5, seed=42):
+    """Makes the list of trials in a session of the given length.
+
+    Parameters
+    ----------
+    seconds : float
+        Length of the session.
+    n_trials : int
+        Number of trials of each paradigm (and of alpha eyes open/closed pairs) per block.
+    trial_seconds : float
+        Nominal trial length; actual lengths jitter by a few milliseconds, like the host timing does.
+    start_seconds : float
+        Time before the first trial.
+
+    Returns
+    -------
+    list of tuples
+        (onset, duration, truth, label) of each trial, with onset in seconds from the start.
+    """
+    rng = np.random.default_rng(seed)
+    schedule = []
+    onset = start_seconds
+    while True:
+        block = []
+        for _ in range(n_trials):
+            # eyes open first, then eyes closed
+            block.extend([(False, 'alpha'), (True, 'alpha')])
+
+        for label in BLOCK_ORDER:
+            yes_nos = [True] * (n_trials // 2) + [False] * (n_trials - n_trials // 2)
+            rng.shuffle(yes_nos)
+            block.extend((yes, label) for yes in yes_nos)
+
+        for truth, label in block:
+            duration = trial_seconds + rng.normal(0, 0.01)
+            if onset + duration + 1 > seconds:
+                return schedule
+
+            schedule.append((onset, duration, truth, label))
+            # time for prompts, answers and the inter-trial pause
+            onset += duration + rng.uniform(2, 4)
+
+
+def generate_signal(schedule, n_samples, sfreq, ch_names, chunk_seconds=60, seed=42):
+    """Generates the EEG for a trial schedule, one chunk at a time.
+
+    Returns
+    -------
+    np.array
+        Data with shape (channels, samples), in microvolts.
+    """
+    rng = np.random.default_rng(seed)
+    n_channels = len(ch_names)
+    occipital = np.array([c in OCCIPITAL_CHANNELS for c in ch_names])
+    central = np.array([c in CENTRAL_CHANNELS for c in ch_names])
+    line_amplitude = rng.uniform(2, 10, size=(n_channels, 1))
+    line_phase = rng.uniform(0, 2 * np.pi, size=(n_channels, 1))
+    onsets = np.array([t[0] for t in schedule])
+    ends = np.array([t[0] + t[1] for t in schedule])
+
+    data = np.empty((n_channels, n_samples))
+    # filter state carries the pink noise across chunks
+    zi = np.zeros((n_channels, len(PINK_A) - 1))
+    chunk = int(chunk_seconds * sfreq)
+    for start in range(0, n_samples, chunk):
+        stop = min(start + chunk, n_samples)
+        t = np.arange(start, stop) / sfreq
+        out = data[:, start:stop]
+        out[:], zi = spsig.lfilter(PINK_B, PINK_A, rng.standard_normal((n_channels, stop - start)), axis=-1, zi=zi)
+        out *= 30
+        out += line_amplitude * np.sin(2 * np.pi * 60 * t + line_phase)
+        out += 0.2 * line_amplitude * np.sin(2 * np.pi * 120 * t + line_phase)
+
+        alpha = np.sin(2 * np.pi * 10 * t)
+        mu = np.sin(2 * np.pi * 11 * t + 1)
+        alpha_amplitude = np.full(t.shape, 2.)
+        mu_amplitude = np.full(t.shape, 3.)
+        ssvep = np.zeros(t.shape)
+        # only the trials that overlap this chunk
+        first, last = np.searchsorted(ends, t[0]), np.searchsorted(onsets, t[-1], side='right')
+        for onset, duration, truth, label in schedule[first:last]:
+            in_trial = (t >= onset) & (t < onset + duration)
+            if label == 'alpha' and truth:
+                alpha_amplitude[in_trial] = 10
+            elif label == 'SSVEP':
+                frequency = SSVEP_FREQUENCIES[truth]
+                ssvep[in_trial] = 4 * np.sin(2 * np.pi * frequency * (t[in_trial] - onset)) + \
+                                    1.5 * np.sin(2 * np.pi * 2 * frequency * (t[in_trial] - onset))
+            elif truth:
+                # event-related desynchronization during real or imagined movement
+                mu_amplitude[in_trial] = 1
+
+        out[occipital] += alpha_amplitude * alpha + ssvep
+        out[central] += mu_amplitude * mu
+
+    return data
+
+
+def make_raw(minutes=10, sfreq=1000, sensor_locations='LMI2', n_channels=16, n_trials=2, chunk_seconds=60, seed=42):
+    """Makes a synthetic session as an MNE raw object, like the one expData.stopBCI saves.
+
+    Parameters
+    ----------
+    minutes : float
+        Length of the session; anything from a few minutes to hours.
+    sfreq : float
+        Sample rate in Hz, e.g. 125 (Bluetooth), 250 (synthetic board) or 1000 (WiFi).
+    sensor_locations : str
+        Sensor location dictionary for the channel names; one of 'default', 'LMI1', 'LMI2'.
+    n_channels : int
+        Number of channels; more than 16 adds channels named 'EEG 017' and up,
+        which have no montage position.
+    n_trials : int
+        Trials of each paradigm per block; see trial_schedule.
+    chunk_seconds : float
+        Seconds of signal generated at a time.
+    seed : int
+        Random seed; the same arguments always make the same session.
+    """
+    ch_names = get_ch_names(sensor_locations)[:n_channels] + [f'EEG {i:03d}' for i in range(17, n_channels + 1)]
+    n_samples = int(minutes * 60 * sfreq)
+    schedule = trial_schedule(n_samples / sfreq, n_trials=n_trials, seed=seed)
+    data = generate_signal(schedule, n_samples, sfreq, ch_names, chunk_seconds=chunk_seconds, seed=seed)
+
+    info = mne.create_info(ch_names=ch_names,
+                           sfreq=sfreq,
+                           ch_types=['eeg'] * n_channels)
+    raw = mne.io.RawArray(data, info, verbose=0)
+
+    onsets_list = [t[0] for t in schedule]
+    durations_list = [t[1] for t in schedule]
+    desc_list = ['-'.join([str(t[2]), t[3], '']) for t in schedule]
+    raw.set_annotations(mne.Annotations(onsets_list, durations_list, desc_list))
+
+    montage = mne.channels.make_standard_montage('standard_1020')
+    raw.set_montage(montage, on_missing='ignore')
+    return raw
+
+
+def save_session(filename, **kwargs):
+    """Makes a synthetic session with make_raw and saves it as a .fif.gz file.
+
+    filename should end in _raw.fif.gz, like BCIproject_trial-<ID>_raw.fif.gz,
+    so the loaders in data_postprocessing find it.
+    """
+    raw = make_raw(**kwargs)
+    raw.save(filename, overwrite=True, verbose=0)
+    return filename
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', default='data/BCIproject_trial-synthetic_raw.fif.gz', help='file to save the session to')
+    parser.add_argument('--minutes', type=float, default=10, help='length of the session')
+    parser.add_argument('--sfreq', type=int, default=1000, help='sample rate in Hz')
+    parser.add_argument('--channels', type=int, default=16, help='number of channels')
+    parser.add_argument('--seed', type=int, default=42, help='random seed')
+    args = parser.parse_args()
+
+    save_session(args.output, minutes=args.minutes, sfreq=args.sfreq, n_channels=args.channels, seed=args.seed)